@@ -48,6 +48,7 @@ from director.ikparameters import IkParameters
 # spartan
 import spartan.utils.utils as spartanUtils
 import spartan.utils.ros_utils as spartanROSUtils
+from spartan.utils.image_capture_service import ImageCaptureService
 from spartan.utils.taskrunner import TaskRunner
 
 
@@ -164,6 +165,7 @@ class HandEyeCalibration(object):
         self.cameraSerialNumber = cameraSerialNumber
         self.setup()
         self.calibrationData = None
+        self.imageCaptureService = None
         self.setupConfig()
         
 
@@ -283,11 +285,25 @@ class HandEyeCalibration(object):
 
         return d
 
-    def saveSingleImage(self, topic, filename, encoding):
-        rosImageLoggerExecutable = os.path.join(spartanUtils.getSpartanSourceDir(), 'modules',"spartan",
-                                                'calibration','ros_image_logger.py')
-        cmd = "%s -t %s -f %s -e %s" % (rosImageLoggerExecutable, topic, filename, encoding)
-        os.system(cmd)
+    def getImageCaptureService(self):
+        if self.imageCaptureService is None:
+            self.imageCaptureService = ImageCaptureService()
+        return self.imageCaptureService
+
+    """
+    Saves the first image on the topic received after minStamp (defaults to now) to filename.
+    The image is captured in process, the topic stays subscribed for the next call.
+    """
+    def saveSingleImage(self, topic, filename, encoding, minStamp=None):
+        imageCaptureService = self.getImageCaptureService()
+        if not imageCaptureService.hasTopic(topic):
+            imageCaptureService.addTopic(topic, topic)
+
+        msg = imageCaptureService.getImage(topic, minStamp=minStamp)
+        imageCaptureService.saveImage(msg, filename, encoding=encoding)
+
+        # the chessboard detection reads the file straight away
+        imageCaptureService.flush()
 
     def displayChessboardDetection(self, filename, duration):
         chessboardDetetctionVisualizerExecutable = os.path.join(spartanUtils.getSpartanSourceDir(), 'modules',"spartan",
@@ -336,7 +352,7 @@ class HandEyeCalibration(object):
 
 
 
-            self.saveSingleImage(topic, fullImageFilename, encoding)
+            self.saveSingleImage(topic, fullImageFilename, encoding, minStamp=rosTime)
             # todo: sync this timeout with some variable
             self.displayChessboardDetection(fullImageFilename, duration=1.5)
 
@@ -454,9 +470,8 @@ class HandEyeCalibration(object):
 
 
 
-        #setup our passive subscribers to the IR or RGB data
+        #setup our persistent subscribers to the IR or RGB data, the images are captured from these
         topicName = None
-        self.passiveSubscriber = None
         if self.captureRGB:
             topicName = self.config['rgb_raw_topic']
 
@@ -464,8 +479,10 @@ class HandEyeCalibration(object):
             topicName = self.config['ir_raw_topic']
 
         if topicName:
-            self.passiveSubscriber = spartanROSUtils.SimpleSubscriber(topicName, sensor_msgs.msg.Image)
-            self.passiveSubscriber.start()
+            imageCaptureService = self.getImageCaptureService()
+            if not imageCaptureService.hasTopic(topicName):
+                imageCaptureService.addTopic(topicName, topicName)
+            imageCaptureService.start(keys=[topicName])
 
         unique_name = time.strftime("%Y%m%d-%H%M%S") + "_" + self.calibrationType
         self.calibrationFolderName = os.path.join(spartanUtils.getSpartanSourceDir(), 'calibration_data', unique_name)
@@ -504,8 +521,8 @@ class HandEyeCalibration(object):
 
         spartanUtils.saveToYaml(calibrationRunData, os.path.join(self.calibrationFolderName, 'robot_data.yaml'))
 
-        if self.passiveSubscriber:
-            self.passiveSubscriber.stop()
+        if topicName:
+            self.imageCaptureService.stop(keys=[topicName])
 
         self.moveHome()
 
@@ -550,7 +567,13 @@ class HandEyeCalibration(object):
 
         self.taskRunner.callOnThread(self.runROSCalibration, calibrationHeaderData)
 
-    def computeCalibrationPoses(self):
+    def computeCalibrationPoses(self, warmStart=True):
+        """
+        Solves IK over the yaw x pitch x distance grid of camera locations
+
+        :param warmStart: seed each solve from the closest camera location solved so far
+        (with the same 7th joint flip), rather than from the nominal pose
+        """
 
         config = self.calibrationPosesConfig
 
@@ -577,6 +600,9 @@ class HandEyeCalibration(object):
 
         previousCameraLocation = None
 
+        # flip -> (list of camera locations, list of solutions)
+        solvedPoses = {True: ([], []), False: ([], [])}
+
         counter = 0
         for dist in distances:
             for pitch in pitchAngles:
@@ -603,12 +629,21 @@ class HandEyeCalibration(object):
                     else:
                         flip = False
 
-                    ikResult = self.computeSingleCameraPose(cameraFrameLocation=cameraLocation, targetLocationWorld=config['target_location'], flip=flip)
+                    seedPose = None
+                    solvedLocations, solutions = solvedPoses[flip]
+                    if warmStart and len(solvedLocations) > 0:
+                        seedDistances = np.linalg.norm(np.array(solvedLocations) - cameraLocation, axis=1)
+                        seedPose = solutions[int(np.argmin(seedDistances))]
+
+                    ikResult = self.computeSingleCameraPose(cameraFrameLocation=cameraLocation, targetLocationWorld=config['target_location'], flip=flip, seedPose=seedPose)
 
                     returnData['cameraLocations'].append(cameraLocation)
 
 
                     if (ikResult['info'] == 1):
+                        solvedLocations.append(cameraLocation)
+                        solutions.append(ikResult['endPose'])
+
                         d = dict()
                         d['yaw'] = yaw
                         d['pitch'] = pitch
@@ -780,7 +815,10 @@ class HandEyeCalibration(object):
 
         return p
 
-    def computeSingleCameraPose(self, targetLocationWorld=[1,0,0], cameraFrameLocation=[0.22, 0, 0.89], flip=False):
+    def computeSingleCameraPose(self, targetLocationWorld=[1,0,0], cameraFrameLocation=[0.22, 0, 0.89], flip=False, seedPose=None):
+        """
+        :param seedPose: optional, joint positions to seed the IK with instead of the nominal pose
+        """
         cameraAxis = [0,0,1]
 
         linkName = self.handFrame
@@ -827,6 +865,11 @@ class HandEyeCalibration(object):
 
         constraintSet.seedPoseName = seedPoseName
 
+        if seedPose is not None:
+            seedPoseName = 'q_seed_calibration'
+            ikPlanner.addPose(seedPose, seedPoseName)
+            constraintSet.seedPoseName = seedPoseName
+
         endPose, info = constraintSet.runIk()
         returnData = dict()
         returnData['info'] = info
@@ -20,6 +20,7 @@ import spartan_grasp_msgs.srv
 import spartan.utils.utils as spartanUtils
 import spartan.utils.ros_utils as rosUtils
 import spartan.utils.director_utils as directorUtils
+from spartan.utils.image_capture_service import ImageCaptureService
 from spartan.manipulation.schunk_driver import SchunkDriver
 
 # director
@@ -80,17 +81,16 @@ class BackgroundSubtractionDataCapture(object):
 
 
     def startImageSubscribers(self):
-        self.imageSubscribers = dict()
-        msgType = sensor_msgs.msg.Image
+        # persistent subscribers, images are captured in process rather than
+        # by launching ros_image_logger.py for every image
+        self.imageCaptureService = ImageCaptureService()
         for key, topic in self.imageTopics.iteritems():
-            sub = rosUtils.SimpleSubscriber(topic, msgType)
-            sub.start()
-            self.imageSubscribers[key] = sub
+            self.imageCaptureService.addTopic(key, topic)
+        self.imageCaptureService.start()
 
 
     def stopImageSubscribers(self):
-        for key, value in self.imageTopics.iteritems():
-            self.imageSubscribers[key].stop()
+        self.imageCaptureService.close()
 
 
     def setupDataCapture(self, objectName):
@@ -115,14 +115,20 @@ class BackgroundSubtractionDataCapture(object):
             pose = self.poseData['poses'][poseName]
             self.robotService.moveToJointPosition(pose, maxJointDegreesPerSecond=self.config['maxJointDegreesPerSecond'])
 
-            self.captureImages(poseName, filenameExtension=filenameExtension)
-            self.captureCameraPose(poseName)
+            snapshot = self.captureImages(poseName, filenameExtension=filenameExtension)
+            self.captureCameraPose(poseName, snapshot=snapshot)
+
+        # make sure all the images are on disk
+        self.imageCaptureService.flush()
 
         rospy.loginfo("data capture finished for " + filenameExtension)
 
-    def captureCameraPose(self, poseName):
-        # tf stuff
-        cameraOpticalFrameToBase = self.tfBuffer.lookup_transform("base", self.cameraInfoDict['rgb_optical_frame'], rospy.Time(0))
+    def captureCameraPose(self, poseName, snapshot=None):
+        # tf stuff, at the time the images were taken if we have them
+        if snapshot is not None:
+            cameraOpticalFrameToBase = self.tfBuffer.lookup_transform("base", self.cameraInfoDict['rgb_optical_frame'], snapshot['stamp'], rospy.Duration(1.0))
+        else:
+            cameraOpticalFrameToBase = self.tfBuffer.lookup_transform("base", self.cameraInfoDict['rgb_optical_frame'], rospy.Time(0))
 
         # convert it to yaml
         cameraOpticalFrameToBaseVTK = directorUtils.transformFromROSTransformMsg(cameraOpticalFrameToBase.transform)
@@ -133,12 +139,18 @@ class BackgroundSubtractionDataCapture(object):
 
 
     def captureImages(self, poseName, filenameExtension='background'):
+        """
+        Captures one image from each of the topics, with matching timestamps, and
+        queues them to be written to disk
+
+        :return: the snapshot, see ImageCaptureService.captureSnapshot
+        """
         d = dict()
 
-        
-        for imageType, topic in self.imageTopics.iteritems():
+        rospy.loginfo("capture images on topics " + ", ".join(self.imageTopics.values()))
+        snapshot = self.imageCaptureService.captureSnapshot(keys=['rgb', 'depth'])
 
-            rospy.loginfo("capture image on topic " + topic)
+        for imageType, topic in self.imageTopics.iteritems():
 
             # use custom file type if warranted
 
@@ -157,20 +169,18 @@ class BackgroundSubtractionDataCapture(object):
                 encoding = self.cameraInfoDict['encoding'][imageType]
 
 
-            # depth images need special treatment
-            if imageType == "depth":
-                rosUtils.saveSingleDepthImage(topic, fullFilename, encoding)
-            else:
-                rosUtils.saveSingleImage(topic, fullFilename, encoding)
+            # depth images are written with cv2.FileStorage if the filetype is yaml
+            self.imageCaptureService.saveImage(snapshot['msgs'][imageType], fullFilename, encoding=encoding)
 
             d[imageType] = dict()
             d[imageType]['filename'] = filename
 
 
         self.data['images'][poseName][filenameExtension] = d
-        
+        return snapshot
 
     def saveData(self):
+        self.imageCaptureService.flush()
         filename = os.path.join(self.folderName, 'data.yaml')
         spartanUtils.saveToYaml(self.data, filename)
 
@@ -0,0 +1,329 @@
+# system
+import time
+import threading
+import collections
+import numpy as np
+
+# ROS
+import rospy
+
+# spartan ROS
+import pdc_ros_msgs.msg
+
+# spartan
+import spartan.utils.ros_utils as rosUtils
+
+
+class ActionFuture(object):
+    """
+    The result of an actionlib goal that is still being computed. The goal is sent in
+    the constructor, which returns right away, and the done callback stores the result on
+    the actionlib thread. The caller can move the robot in the meantime and only blocks
+    in result().
+
+    Only one goal per actionlib.SimpleActionClient can be active at a time, sending
+    another goal on the same client preempts this one.
+    """
+
+    def __init__(self, client, goal, name="action"):
+        self.client = client
+        self.name = name
+        self.condition = threading.Condition()
+        self.isDone = False
+        self.state = None
+        self.actionResult = None
+        self.doneTime = None
+
+        self.sentTime = time.time()
+        self.client.send_goal(goal, done_cb=self.onDone)
+
+    def onDone(self, state, result):
+        with self.condition:
+            self.state = state
+            self.actionResult = result
+            self.doneTime = time.time()
+            self.isDone = True
+            self.condition.notify_all()
+
+    def done(self):
+        with self.condition:
+            return self.isDone
+
+    def result(self, timeout=None):
+        """
+        Waits for the goal to finish. Raises rospy.ROSException if it doesn't finish
+        within timeout (seconds).
+
+        :return: the action result, None if the goal was aborted or preempted without one
+        """
+        with self.condition:
+            waitForDone = lambda: True if self.isDone else None
+            rosUtils.waitForCondition(self.condition, waitForDone, timeout=timeout,
+                description="the result of " + self.name)
+            return self.actionResult
+
+    def cancel(self):
+        if not self.done():
+            self.client.cancel_goal()
+
+
+class CycleTiming(object):
+    """
+    Wall clock timestamps of the stages of one grasp cycle. Stages overlap, perception
+    runs while the robot moves, so the breakdown has a line per stage and the 'wait_*'
+    stages show how long the cycle actually blocked on perception.
+    """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        self.startTime = time.time()
+        self.endTime = None
+        self.success = False
+
+        # list of (name, startTime, endTime)
+        self.stages = []
+
+    def addStage(self, name, startTime, endTime=None):
+        """
+        :param endTime: defaults to now
+        """
+        if endTime is None:
+            endTime = time.time()
+        self.stages.append((name, startTime, endTime))
+
+    def finish(self, success):
+        self.endTime = time.time()
+        self.success = success
+
+    def getDuration(self):
+        endTime = self.endTime
+        if endTime is None:
+            endTime = time.time()
+        return endTime - self.startTime
+
+    def getBreakdown(self):
+        """
+        :return: OrderedDict stage name -> seconds in the order the stages started,
+        repeated stages are summed
+        """
+        breakdown = collections.OrderedDict()
+        for name, startTime, endTime in sorted(self.stages, key=lambda stage: stage[1]):
+            breakdown[name] = breakdown.get(name, 0) + endTime - startTime
+        return breakdown
+
+    def toString(self):
+        lines = ["cycle %d: %s in %.2f seconds" %(self.cycle, "success" if self.success else "failed", self.getDuration())]
+        for name, startTime, endTime in sorted(self.stages, key=lambda stage: stage[1]):
+            lines.append("  %-24s %7.2f -> %7.2f  (%.2f)" %(name, startTime - self.startTime, endTime - self.startTime,
+                endTime - startTime))
+        return "\n".join(lines)
+
+
+class GraspCycleRunner(object):
+    """
+    Runs find best match -> grasp -> stow cycles on a GraspSupervisor, with the perception
+    requests overlapped with robot motion:
+
+    - while FindBestMatch is computing, the robot moves to the staging pose
+    - while Grasp3DLocation is computing, the gripper opens
+    - after the object is released at the stow pose the robot goes straight to scanning
+      for the next cycle and sends its FindBestMatch goal (prefetch), instead of moving
+      home first. If no cycle follows, cancelPrefetch() drops it.
+
+    Every stage is timestamped, see CycleTiming.
+
+    Example:
+
+        runner = GraspCycleRunner(graspSupervisor)
+        timings = runner.run(maxCycles=10)
+    """
+
+    def __init__(self, graspSupervisor, stowPose=None, stagingPoseName='above_table_pre_grasp', prefetch=True,
+                 perceptionTimeout=None):
+        """
+        :param stowPose: joint positions, defaults to the supervisor's stow pose
+        :param stagingPoseName: pose of the current grasping location to wait for perception at
+        :param perceptionTimeout: seconds, None waits forever
+        """
+        self.supervisor = graspSupervisor
+        self.stowPose = stowPose
+        self.stagingPoseName = stagingPoseName
+        self.prefetch = prefetch
+        self.perceptionTimeout = perceptionTimeout
+
+        # (FindBestMatch ActionFuture) sent at the end of the previous cycle
+        self.pendingBestMatch = None
+        self.timings = []
+
+    def getPose(self, poseName):
+        return self.supervisor.graspingParams[self.supervisor.state.graspingLocation]['poses'][poseName]
+
+    def moveToPose(self, poseName):
+        self.supervisor.robotService.moveToJointPosition(self.getPose(poseName),
+            maxJointDegreesPerSecond=self.supervisor.graspingParams['speed']['nominal'])
+
+    def scanAndRequestBestMatch(self, timing, stageName='scan'):
+        """
+        Collects the rgbd data and sends the FindBestMatch goal
+        :return: ActionFuture
+        """
+        startTime = time.time()
+        listOfRgbdWithPoseMsg = self.supervisor.collectRgbdData()
+        self.supervisor.list_rgbd_with_pose_msg = listOfRgbdWithPoseMsg
+        timing.addStage(stageName, startTime)
+
+        self.supervisor.find_best_match_client.wait_for_server()
+
+        goal = pdc_ros_msgs.msg.FindBestMatchGoal()
+        goal.rgbd_with_pose_list = listOfRgbdWithPoseMsg
+        goal.camera_info = self.supervisor.getCameraInfo()
+
+        rospy.loginfo("requesting best match from server")
+        return ActionFuture(self.supervisor.find_best_match_client, goal, name="FindBestMatch")
+
+    def waitForResult(self, future, timing, stageName):
+        """
+        Blocks on the future and records both how long the cycle waited (wait_<stageName>)
+        and how long the server took (<stageName>)
+        """
+        startTime = time.time()
+        result = future.result(timeout=self.perceptionTimeout)
+        timing.addStage("wait_" + stageName, startTime)
+        timing.addStage(stageName, future.sentTime, future.doneTime)
+        return result
+
+    def cancelPrefetch(self):
+        if self.pendingBestMatch is not None:
+            self.pendingBestMatch.cancel()
+            self.pendingBestMatch = None
+
+    def runCycle(self, cycle=0, prefetchNext=None):
+        """
+        Runs one cycle, the robot ends up at home, or at the last scan pose if the next
+        cycle was prefetched.
+
+        :param prefetchNext: whether to prefetch the next cycle's scan, defaults to self.prefetch
+        :return: CycleTiming
+        """
+        if prefetchNext is None:
+            prefetchNext = self.prefetch
+
+        timing = CycleTiming(cycle)
+        self.timings.append(timing)
+        supervisor = self.supervisor
+
+        # find best match, computing while the robot moves to the staging pose
+        if self.pendingBestMatch is not None:
+            bestMatchFuture = self.pendingBestMatch
+            self.pendingBestMatch = None
+        else:
+            startTime = time.time()
+            supervisor.moveHome()
+            timing.addStage("move_home", startTime)
+            bestMatchFuture = self.scanAndRequestBestMatch(timing)
+
+        startTime = time.time()
+        self.moveToPose(self.stagingPoseName)
+        timing.addStage("move_staging", startTime)
+
+        result = self.waitForResult(bestMatchFuture, timing, "find_best_match")
+        supervisor.best_match_result = result
+        if result is None or not result.match_found:
+            rospy.loginfo("no best match found")
+            return self.finishCycle(timing, False)
+
+        bestMatchLocation = supervisor.getBestMatchLocation(result)
+        if bestMatchLocation is None:
+            return self.finishCycle(timing, False)
+
+        # grasp 3D location, computing while the gripper opens
+        goal = supervisor.makeGrasp3DLocationGoal(bestMatchLocation)
+        graspFuture = ActionFuture(supervisor.grasp_3D_location_client, goal, name="Grasp3DLocation")
+
+        startTime = time.time()
+        supervisor.gripperDriver.sendOpenGripperCommand()
+        rospy.sleep(0.5) # wait for the gripper to open
+        timing.addStage("open_gripper", startTime)
+
+        result = self.waitForResult(graspFuture, timing, "grasp_3d_location")
+        supervisor.grasp_3D_location_result = result
+        if result is None or not supervisor.processGenerateGraspsResult(result):
+            rospy.loginfo("no grasp found")
+            return self.finishCycle(timing, False)
+
+        startTime = time.time()
+        graspSuccessful = supervisor.attemptGrasp(supervisor.graspFrame, openGripper=False)
+        timing.addStage("grasp", startTime)
+        if not graspSuccessful:
+            supervisor.gripperDriver.sendOpenGripperCommand()
+            rospy.loginfo("grasp attempt failed, resetting")
+            return self.finishCycle(timing, False)
+
+        startTime = time.time()
+        supervisor.pickupObject(stow=True, stow_pose=self.stowPose, returnHome=not prefetchNext)
+        timing.addStage("stow", startTime)
+
+        if prefetchNext:
+            self.pendingBestMatch = self.scanAndRequestBestMatch(timing, stageName="prefetch_scan")
+
+        timing.finish(True)
+        rospy.loginfo(timing.toString())
+        return timing
+
+    def finishCycle(self, timing, success):
+        """
+        Failed cycles end at home
+        """
+        startTime = time.time()
+        self.supervisor.moveHome()
+        timing.addStage("move_home", startTime)
+
+        timing.finish(success)
+        rospy.loginfo(timing.toString())
+        return timing
+
+    def run(self, maxCycles=None):
+        """
+        Runs cycles until one of them fails or maxCycles have run. The last of maxCycles
+        doesn't prefetch.
+
+        :return: list of CycleTiming
+        """
+        timings = []
+        cycle = 0
+        try:
+            while maxCycles is None or cycle < maxCycles:
+                prefetchNext = self.prefetch and (maxCycles is None or cycle < maxCycles - 1)
+                timing = self.runCycle(cycle, prefetchNext=prefetchNext)
+                timings.append(timing)
+                cycle += 1
+                if not timing.success:
+                    break
+        finally:
+            self.cancelPrefetch()
+
+        rospy.loginfo(GraspCycleRunner.summarize(timings))
+        return timings
+
+    @staticmethod
+    def summarize(timings):
+        """
+        Mean seconds per stage over the cycles and the pick rate
+        """
+        if len(timings) == 0:
+            return "no grasp cycles"
+
+        totalTime = sum(timing.getDuration() for timing in timings)
+        numPicks = sum(1 for timing in timings if timing.success)
+
+        stageTimes = collections.OrderedDict()
+        for timing in timings:
+            for name, duration in timing.getBreakdown().iteritems():
+                stageTimes.setdefault(name, []).append(duration)
+
+        lines = ["%d picks in %d cycles, %.2f seconds, %.1f picks per hour" %(numPicks, len(timings), totalTime,
+            3600.0*numPicks/totalTime)]
+        for name, durations in stageTimes.iteritems():
+            lines.append("  %-24s mean %.2f seconds over %d cycles" %(name, np.mean(durations), len(durations)))
+
+        return "\n".join(lines)
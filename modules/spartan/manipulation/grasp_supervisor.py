@@ -3,6 +3,8 @@ import os
 import numpy as np
 import random
 import copy
+import time
+from multiprocessing.pool import ThreadPool
 
 # ROS
 import rospy
@@ -27,8 +29,10 @@ import fusion_server.srv
 import spartan.utils.utils as spartanUtils
 import spartan.utils.ros_utils as rosUtils
 from spartan.manipulation.schunk_driver import SchunkDriver
+from spartan.manipulation.grasp_cycle import GraspCycleRunner
 import fusion_server
 from fusion_server.srv import *
+from fusion_server import numpy_pc2
 
 # director
 from director import transformUtils
@@ -120,10 +124,19 @@ class GraspSupervisor(object):
         self.config['end_effector_frame_id'] = "iiwa_link_ee"
         self.config['pick_up_distance'] = 0.25 # distance to move above the table after grabbing the object
 
-        self.config["sleep_time_for_sensor_collect"] = 0.1
         self.config['scan'] = dict()
         self.config['scan']['pose_list'] = ['scan_left_close', 'scan_above_table', 'scan_right']
         self.config['scan']['joint_speed'] = 45
+        self.config['scan']['sensor_timeout'] = 5.0 # seconds to wait for sensor data and transforms
+        self.config['scan']['publish_preview'] = True # publish each pose's point cloud as soon as it is captured
+
+        # the robot counts as settled at a scan pose once the joints have been still for
+        # settle_time, see rosUtils.MotionSettledDetector
+        self.config['scan']['settle'] = dict()
+        self.config['scan']['settle']['settle_time'] = 0.1 # seconds
+        self.config['scan']['settle']['max_joint_position_change'] = 1e-3 # radians
+        self.config['scan']['settle']['max_joint_velocity'] = 1e-2 # radians/second
+        self.config['scan']['settle']['timeout'] = 2.0 # seconds, capture anyway after this
         self.config['grasp_speed'] = 20
 
         normal_speed = 30
@@ -175,6 +188,18 @@ class GraspSupervisor(object):
         self.depthImageSubscriber.start()
         self.camera_info_subscriber.start()
 
+        # matched rgb and depth images
+        self.rgbdSynchronizer = rosUtils.MessageSynchronizer([self.rgbImageSubscriber, self.depthImageSubscriber])
+
+        # enough history to span the settle time at the joint_states rate
+        self.jointStatesSubscriber = rosUtils.SimpleSubscriber("/joint_states", sensor_msgs.msg.JointState, historySize=200)
+        self.jointStatesSubscriber.start()
+
+        settleConfig = self.config['scan']['settle']
+        self.motionSettledDetector = rosUtils.MotionSettledDetector(self.jointStatesSubscriber, self.robotService.jointNames,
+            settleTime=settleConfig['settle_time'], maxJointPositionChange=settleConfig['max_joint_position_change'],
+            maxJointVelocity=settleConfig['max_joint_velocity'])
+
         self.clicked_point_subscriber = rosUtils.SimpleSubscriber("/clicked_point", geometry_msgs.msg.PointStamped, self.on_clicked_point)
         self.clicked_point_subscriber.start()
 
@@ -184,6 +209,7 @@ class GraspSupervisor(object):
         """
 
         self.rviz_marker_publisher = rospy.Publisher("/spartan_grasp/visualization_marker", visualization_msgs.msg.Marker, queue_size=1)
+        self.scan_preview_publisher = rospy.Publisher("/spartan_grasp/scan_preview", sensor_msgs.msg.PointCloud2, queue_size=10)
 
 
     def on_clicked_point(self, clicked_point_msg):
@@ -253,25 +279,68 @@ class GraspSupervisor(object):
             self.tfListener = tf2_ros.TransformListener(self.tfBuffer)
 
 
-    def getDepthOpticalFrameToGraspFrameTransform(self):
-        depthOpticalFrameToGraspFrame = self.tfBuffer.lookup_transform(self.graspFrameName, self.depthOpticalFrameName, rospy.Time(0))
+    def getDepthOpticalFrameToGraspFrameTransform(self, stamp=None):
+        """
+        :param stamp: rospy.Time, defaults to the latest available transform
+        """
+        if stamp is None:
+            stamp = rospy.Time(0)
+
+        depthOpticalFrameToGraspFrame = self.tfBuffer.lookup_transform(self.graspFrameName, self.depthOpticalFrameName, stamp,
+            rospy.Duration(self.config['scan']['sensor_timeout']))
 
         print depthOpticalFrameToGraspFrame
         return depthOpticalFrameToGraspFrame
 
-    def getRgbOpticalFrameToGraspFrameTransform(self):
-        rgbOpticalFrameToGraspFrame = self.tfBuffer.lookup_transform(self.graspFrameName, self.rgbOpticalFrameName, rospy.Time(0))
+    def getRgbOpticalFrameToGraspFrameTransform(self, stamp=None):
+        """
+        :param stamp: rospy.Time, defaults to the latest available transform
+        """
+        if stamp is None:
+            stamp = rospy.Time(0)
+
+        rgbOpticalFrameToGraspFrame = self.tfBuffer.lookup_transform(self.graspFrameName, self.rgbOpticalFrameName, stamp,
+            rospy.Duration(self.config['scan']['sensor_timeout']))
 
         print  rgbOpticalFrameToGraspFrame
         return rgbOpticalFrameToGraspFrame
 
+    def getCameraInfo(self):
+        """
+        The camera info doesn't change, so this only waits if none has arrived yet
+        """
+        cameraInfo = self.camera_info_subscriber.lastMsg
+        if cameraInfo is None:
+            cameraInfo = self.camera_info_subscriber.waitForNextMessage(timeout=self.config['scan']['sensor_timeout'])
+        return cameraInfo
+
+    def waitForRobotToSettle(self):
+        """
+        Waits for the robot to come to rest, see rosUtils.MotionSettledDetector. If it
+        doesn't settle within the timeout this logs a warning and returns the current time.
+
+        :return: rospy.Time, sensor data with timestamp >= this was taken with the robot at rest
+        """
+        try:
+            return self.motionSettledDetector.waitUntilSettled(timeout=self.config['scan']['settle']['timeout'])
+        except rospy.ROSException as e:
+            if rospy.is_shutdown():
+                raise
+            rospy.logwarn(str(e) + ", capturing anyway")
+            return rospy.Time.now()
 
     """
-    Captures the current PointCloud2 from the sensor. Also records the pose of camera frame.
+    Captures the first PointCloud2 from the sensor with timestamp >= stamp (defaults to now).
+    Also records the pose of camera frame at the time the point cloud was taken.
     """
-    def capturePointCloudAndCameraTransform(self, cameraOrigin = [0,0,0]):
-    	# sleep to transforms can update
-    	
+    def capturePointCloudAndCameraTransform(self, cameraOrigin = [0,0,0], stamp=None):
+        if stamp is None:
+            stamp = rospy.Time.now()
+
+        pointCloud = self.pointCloudSubscriber.waitForMessageAfter(stamp, timeout=self.config['scan']['sensor_timeout'])
+        return self.makePointCloudWithTransformMsg(pointCloud, cameraOrigin=cameraOrigin)
+
+    def makePointCloudWithTransformMsg(self, pointCloud, cameraOrigin = [0,0,0]):
         msg = spartan_grasp_msgs.msg.PointCloudWithTransform()
         msg.header.stamp = rospy.Time.now()
 
@@ -279,23 +348,30 @@ class GraspSupervisor(object):
         msg.camera_origin.y = cameraOrigin[1]
         msg.camera_origin.z = cameraOrigin[2]
 
-        msg.point_cloud_to_base_transform = self.getDepthOpticalFrameToGraspFrameTransform()
-
-        msg.point_cloud = self.pointCloudSubscriber.waitForNextMessage()
+        msg.point_cloud_to_base_transform = self.getDepthOpticalFrameToGraspFrameTransform(stamp=pointCloud.header.stamp)
+        msg.point_cloud = pointCloud
 
         self.testData = msg # for debugging
         return msg
 
-    def captureRgbdAndCameraTransform(self, cameraOrigin = [0,0,0]):
-        # sleep to transforms can update
-        
+    def captureRgbdAndCameraTransform(self, cameraOrigin = [0,0,0], stamp=None):
+        """
+        Captures the first rgb and depth pair with matching timestamps >= stamp (defaults
+        to now), along with the pose of the rgb camera frame at that time.
+        """
+        if stamp is None:
+            stamp = rospy.Time.now()
+
+        rgbImage, depthImage = self.rgbdSynchronizer.waitForMatch(stamp=stamp, timeout=self.config['scan']['sensor_timeout'])
+        return self.makeRgbdWithPoseMsg(rgbImage, depthImage)
+
+    def makeRgbdWithPoseMsg(self, rgbImage, depthImage):
         msg = pdc_ros_msgs.msg.RGBDWithPose()
         msg.header.stamp = rospy.Time.now()
 
-        msg.camera_pose = self.getRgbOpticalFrameToGraspFrameTransform()
-
-        msg.rgb_image   = self.rgbImageSubscriber.waitForNextMessage()
-        msg.depth_image = self.depthImageSubscriber.waitForNextMessage()
+        msg.camera_pose = self.getRgbOpticalFrameToGraspFrameTransform(stamp=rgbImage.header.stamp)
+        msg.rgb_image = rgbImage
+        msg.depth_image = depthImage
 
         return msg
 
@@ -309,8 +385,104 @@ class GraspSupervisor(object):
         params = self.graspingParams[stow_location]
         return params['poses']['stow']
 
+    def scanPoses(self, poseNames, captureFunction, onPoseCaptured=None):
+        """
+        Moves through the scan poses and captures sensor data at each of them, pipelined
+        so the robot only stays at a pose as long as the sensor data needs:
+
+        - after the move, wait for the joints to settle instead of sleeping a fixed time
+        - captureFunction(stamp) waits for the messages with timestamp >= stamp, the time
+          the robot came to rest, and returns a function that turns them into the result.
+          This wait stays on the calling thread on purpose, the robot must not leave the
+          pose before a frame taken after it settled has arrived.
+        - that function (tf lookups at the message timestamps, building the messages) runs
+          on a worker thread while the robot is already moving to the next pose, followed
+          by onPoseCaptured(poseName, data) if given
+
+        The grasp and find best match servers take the whole list of poses in one goal, so
+        the results are only sent to them once the scan is done. onPoseCaptured is where
+        per pose streaming to them goes once their actions accept incremental goals, for
+        now collectSensorData and collectRgbdData use it to publish a preview of each pose.
+
+        :param captureFunction: stamp -> (function () -> data)
+        :param onPoseCaptured: (poseName, data) -> None, called on the worker thread in scan order
+        :return: list of (poseName, data) in scan order. Per pose timings are logged and stored
+        in self.scanTiming.
+        """
+        graspLocationData = self.graspingParams[self.state.graspingLocation]
+        pool = ThreadPool(1)
+        pending = []
+        timing = []
+
+        def processPose(poseName, process, poseTiming):
+            startTime = time.time()
+            data = process()
+            poseTiming['process'] = time.time() - startTime
+            if onPoseCaptured is not None:
+                onPoseCaptured(poseName, data)
+            return poseName, data
+
+        try:
+            for poseName in poseNames:
+                rospy.loginfo("moving to pose = " + poseName)
+                poseTiming = dict(pose=poseName)
+                timing.append(poseTiming)
+
+                startTime = time.time()
+                joint_positions = graspLocationData['poses'][poseName]
+                self.robotService.moveToJointPosition(joint_positions, maxJointDegreesPerSecond=self.config['scan']['joint_speed'])
+                poseTiming['move'] = time.time() - startTime
+
+                if self.debugMode:
+                    continue
+
+                startTime = time.time()
+                settledStamp = self.waitForRobotToSettle()
+                poseTiming['settle'] = time.time() - startTime
+
+                startTime = time.time()
+                process = captureFunction(settledStamp)
+                poseTiming['capture'] = time.time() - startTime
+
+                pending.append(pool.apply_async(processPose, (poseName, process, poseTiming)))
+
+            results = [asyncResult.get() for asyncResult in pending]
+        finally:
+            pool.close()
+            pool.join()
+
+        self.scanTiming = timing
+        self.logScanTiming(timing)
+        return results
+
+    def logScanTiming(self, timing):
+        lines = ["scan timing (seconds)"]
+        for poseTiming in timing:
+            line = "%s: move %.3f" %(poseTiming['pose'], poseTiming['move'])
+            for key in ['settle', 'capture', 'process']:
+                if key in poseTiming:
+                    line += ", %s %.3f" %(key, poseTiming[key])
+            lines.append(line)
+
+        rospy.loginfo("\n".join(lines))
+
+    def publishScanPreview(self, poseName, pointCloudWithTransformMsg):
+        """
+        Publishes the point cloud captured at one scan pose on /spartan_grasp/scan_preview,
+        it is in the camera frame so rviz places it using tf
+        """
+        if not self.config['scan']['publish_preview']:
+            return
+
+        rospy.loginfo("captured pose = " + poseName)
+        self.scan_preview_publisher.publish(pointCloudWithTransformMsg.point_cloud)
+
     # scans to several positions
-    def collectSensorData(self, saveToBagFile=False, **kwargs):
+    def collectSensorData(self, saveToBagFile=False, onPoseCaptured=None, **kwargs):
+        """
+        :param onPoseCaptured: (poseName, PointCloudWithTransform) -> None, called as soon as
+        each pose is captured. Defaults to publishing a preview, see publishScanPreview
+        """
 
         rospy.loginfo("collecting sensor data")
         graspLocationData = self.graspingParams[self.state.graspingLocation]
@@ -318,18 +490,17 @@ class GraspSupervisor(object):
         pointCloudListMsg = spartan_grasp_msgs.msg.PointCloudList()
         pointCloudListMsg.header.stamp = rospy.Time.now()
 
-        data = dict()
+        def capture(stamp):
+            pointCloud = self.pointCloudSubscriber.waitForMessageAfter(stamp, timeout=self.config['scan']['sensor_timeout'])
+            return lambda: self.makePointCloudWithTransformMsg(pointCloud)
 
-        for poseName in graspLocationData['scan_pose_list']:
-            rospy.loginfo("moving to pose = " + poseName)
-            joint_positions = graspLocationData['poses'][poseName]
-            self.robotService.moveToJointPosition(joint_positions, maxJointDegreesPerSecond=self.config['scan']['joint_speed'])
+        if onPoseCaptured is None:
+            onPoseCaptured = self.publishScanPreview
 
-            if self.debugMode:
-                continue
+        results = self.scanPoses(graspLocationData['scan_pose_list'], capture, onPoseCaptured=onPoseCaptured)
 
-            rospy.sleep(self.config["sleep_time_for_sensor_collect"])
-            pointCloudWithTransformMsg = self.capturePointCloudAndCameraTransform()
+        data = dict()
+        for poseName, pointCloudWithTransformMsg in results:
             pointCloudListMsg.point_cloud_list.append(pointCloudWithTransformMsg)
             data[poseName] = pointCloudWithTransformMsg
 
@@ -342,7 +513,12 @@ class GraspSupervisor(object):
         return pointCloudListMsg
 
     # scans to several positions
-    def collectRgbdData(self, saveToBagFile=False, **kwargs):
+    def collectRgbdData(self, saveToBagFile=False, onPoseCaptured=None, **kwargs):
+        """
+        :param onPoseCaptured: (poseName, (RGBDWithPose, PointCloudWithTransform)) -> None,
+        called as soon as each pose is captured. Defaults to publishing a preview of the
+        point cloud, see publishScanPreview
+        """
 
         rospy.loginfo("collecting rgbd sensor data")
         graspLocationData = self.graspingParams[self.state.graspingLocation]
@@ -352,22 +528,21 @@ class GraspSupervisor(object):
         pointCloudListMsg = spartan_grasp_msgs.msg.PointCloudList()
         pointCloudListMsg.header.stamp = rospy.Time.now()
 
-        for poseName in graspLocationData['find_best_match_pose_list']:
-            rospy.loginfo("moving to pose = " + poseName)
-            joint_positions = graspLocationData['poses'][poseName]
-            self.robotService.moveToJointPosition(joint_positions, maxJointDegreesPerSecond=self.config['scan']['joint_speed'])
+        def capture(stamp):
+            # the images and the point cloud all arrive at the frame rate, so waiting
+            # for one after the other costs about one frame, not two
+            timeout = self.config['scan']['sensor_timeout']
+            rgbImage, depthImage = self.rgbdSynchronizer.waitForMatch(stamp=stamp, timeout=timeout)
+            pointCloud = self.pointCloudSubscriber.waitForMessageAfter(stamp, timeout=timeout)
+            return lambda: (self.makeRgbdWithPoseMsg(rgbImage, depthImage), self.makePointCloudWithTransformMsg(pointCloud))
 
-            if self.debugMode:
-                continue
+        if onPoseCaptured is None:
+            onPoseCaptured = lambda poseName, data: self.publishScanPreview(poseName, data[1])
 
-            rospy.sleep(self.config["sleep_time_for_sensor_collect"])
-            # capture RGB
-            rgbdWithPoseMsg = self.captureRgbdAndCameraTransform()
+        results = self.scanPoses(graspLocationData['find_best_match_pose_list'], capture, onPoseCaptured=onPoseCaptured)
 
-            # capture Depth
-            pointCloudWithTransformMsg = self.capturePointCloudAndCameraTransform()
+        for poseName, (rgbdWithPoseMsg, pointCloudWithTransformMsg) in results:
             pointCloudListMsg.point_cloud_list.append(pointCloudWithTransformMsg)
-
             listOfRgbdWithPoseMsg.append(rgbdWithPoseMsg)
 
         
@@ -376,7 +551,8 @@ class GraspSupervisor(object):
 
         print "return listOfRgbdWithPoseMsg"
         print len(listOfRgbdWithPoseMsg)
-        print type(listOfRgbdWithPoseMsg[0])
+        if len(listOfRgbdWithPoseMsg) > 0:
+            print type(listOfRgbdWithPoseMsg[0])
         return listOfRgbdWithPoseMsg
 
 
@@ -398,7 +574,7 @@ class GraspSupervisor(object):
 
         goal = pdc_ros_msgs.msg.FindBestMatchGoal()
         goal.rgbd_with_pose_list = listOfRgbdWithPoseMsg
-        goal.camera_info = self.camera_info_subscriber.waitForNextMessage()
+        goal.camera_info = self.getCameraInfo()
 
         rospy.loginfo("requesting best match from server")
 
@@ -420,10 +596,17 @@ class GraspSupervisor(object):
 
         return result
 
-    def grasp_best_match(self):
-        assert self.best_match_result.match_found
+    def getBestMatchLocation(self, result=None):
+        """
+        :param result: FindBestMatchResult, defaults to self.best_match_result
+        :return: best match location as a numpy array, None if it is outside of the workspace
+        """
+        if result is None:
+            result = self.best_match_result
 
-        best_match_location_msg = self.best_match_result.best_match_location
+        assert result.match_found
+
+        best_match_location_msg = result.best_match_location
         best_match_location = np.zeros(3)
         best_match_location[0] = best_match_location_msg.x
         best_match_location[1] = best_match_location_msg.y
@@ -439,6 +622,13 @@ class GraspSupervisor(object):
         if not (greater_than_min and less_than_max):
             print "best match location is outside of workspace bounds"
             print "best_match_location:", best_match_location
+            return None
+
+        return best_match_location
+
+    def grasp_best_match(self):
+        best_match_location = self.getBestMatchLocation()
+        if best_match_location is None:
             return False
 
 
@@ -480,27 +670,31 @@ class GraspSupervisor(object):
         #stow_pose = self.graspingParams["poses"]["stow_in_bin"]
         self.pickupObject(stow=True, stow_pose=stow_pose)
 
+    def run_grasp_cycles(self, max_cycles=None):
+        """
+        Repeats find best match -> grasp -> stow with the perception requests overlapped
+        with robot motion, see GraspCycleRunner
+        :return: list of CycleTiming, one per cycle
+        """
+        stow_pose = self.graspingParams["poses"]["hand_to_human_right"]
+        self.grasp_cycle_runner = GraspCycleRunner(self, stowPose=stow_pose)
+        return self.grasp_cycle_runner.run(maxCycles=max_cycles)
+
 
     def request_best_match(self):
         goal = pdc_ros_msgs.msg.FindBestMatchGoal()
         goal.rgbd_with_pose_list = self.list_rgbd_with_pose_msg
-        goal.camera_info = self.camera_info_subscriber.waitForNextMessage()
+        goal.camera_info = self.getCameraInfo()
 
         self.find_best_match_client.send_goal(goal)
         self.moveHome()
     
-    # From: https://www.programcreek.com/python/example/99841/sensor_msgs.msg.PointCloud2
-    
     def pointcloud2_to_array(self, cloud_msg):
         ''' 
-        Converts a rospy PointCloud2 message to a numpy recordarray 
-        
-        Assumes all fields 32 bit floats, and there is no padding.
+        Converts a rospy PointCloud2 message to a flat numpy recordarray,
+        a view over cloud_msg.data, see fusion_server.numpy_pc2
         '''
-        dtype_list = [(f.name, np.float32) for f in cloud_msg.fields]
-        cloud_arr = np.fromstring(cloud_msg.data, dtype_list)
-        return cloud_arr
-        return np.reshape(cloud_arr, (cloud_msg.height, cloud_msg.width)) 
+        return numpy_pc2.pointcloud2_to_array(cloud_msg).reshape(-1)
 
 
     def processGenerateGraspsResult(self, result):
@@ -566,9 +760,10 @@ class GraspSupervisor(object):
 
 
     
-    def attemptGrasp(self, graspFrame):
+    def attemptGrasp(self, graspFrame, openGripper=True):
         """
         Attempt a grasp
+        :param openGripper: set to False if the gripper has already been opened
         return: boolean if it was successful or not
         """
 
@@ -605,8 +800,9 @@ class GraspSupervisor(object):
         self.preGraspFrame = preGraspFrame
         self.graspFrame = graspFrame
 
-        self.gripperDriver.sendOpenGripperCommand()
-        rospy.sleep(0.5) # wait for the gripper to open
+        if openGripper:
+            self.gripperDriver.sendOpenGripperCommand()
+            rospy.sleep(0.5) # wait for the gripper to open
         self.robotService.moveToJointPosition(preGraspPose, maxJointDegreesPerSecond=self.graspingParams['speed']['pre_grasp'])
         self.robotService.moveToJointPosition(graspPose, maxJointDegreesPerSecond=self.graspingParams['speed']['grasp'])
     	
@@ -626,7 +822,10 @@ class GraspSupervisor(object):
     """
     Moves the gripper up 15cm then moves home
     """
-    def pickupObject(self, stow=True, stow_pose=None):
+    def pickupObject(self, stow=True, stow_pose=None, returnHome=True):
+        """
+        :param returnHome: if False the robot stays where it released the object
+        """
 
         endEffectorFrame = self.tfBuffer.lookup_transform(self.config['base_frame_id'], self.config['end_effector_frame_id'], rospy.Time(0))
 
@@ -664,7 +863,8 @@ class GraspSupervisor(object):
         rospy.sleep(0.5)
 
         # move Home
-        self.moveHome()
+        if returnHome:
+            self.moveHome()
 
     def pickup_object_and_reorient_on_table(self):
         """
@@ -1032,12 +1232,20 @@ class GraspSupervisor(object):
         Sends a request to grasp a specific 3D location
         :param : grasp_point is numpy array or list of size [3]
         """
+        goal = self.makeGrasp3DLocationGoal(grasp_point, pointCloudListMsg=pointCloudListMsg)
+        self.grasp_3D_location_client.send_goal(goal)
+
+    def makeGrasp3DLocationGoal(self, grasp_point, pointCloudListMsg=None):
+        """
+        :param : grasp_point is numpy array or list of size [3]
+        :param pointCloudListMsg: defaults to self.pointCloudListMsg
+        """
         params = self.getParamsForCurrentLocation()
         goal = spartan_grasp_msgs.msg.Grasp3DLocationGoal()
 
         if pointCloudListMsg is None:
-            goal.point_clouds = self.pointCloudListMsg
-        
+            pointCloudListMsg = self.pointCloudListMsg
+        goal.point_clouds = pointCloudListMsg
 
         goal.grasp_point.x = grasp_point[0]
         goal.grasp_point.y = grasp_point[1]
@@ -1058,8 +1266,7 @@ class GraspSupervisor(object):
                 rectangle = GraspSupervisor.rectangleMessageFromYamlNode(val)
                 goal.params.collision_objects.append(rectangle)
 
-
-        self.grasp_3D_location_client.send_goal(goal)
+        return goal
 
 
     def grasp_3D_location(self):
@@ -1168,6 +1375,9 @@ class GraspSupervisor(object):
     def test_find_best_match_and_grasp_and_stow(self):
         self.taskRunner.callOnThread(self.find_best_match_and_grasp_and_stow)
 
+    def test_grasp_cycles(self, max_cycles=None):
+        self.taskRunner.callOnThread(self.run_grasp_cycles, max_cycles)
+
     def test_best_match_no_data(self):
         self.taskRunner.callOnThread(self.request_best_match)
 
@@ -0,0 +1,156 @@
+# ROS
+import rospy
+import sensor_msgs.msg
+from cv_bridge import CvBridge
+
+# spartan
+import spartan.utils.ros_utils as rosUtils
+from spartan.utils.image_writer import ImageWriter
+
+
+class ImageCaptureService(object):
+    """
+    Captures images from ROS topics in process. Each topic gets one persistent
+    SimpleSubscriber that keeps the most recent messages around, so a capture doesn't
+    pay for starting a new interpreter and ROS node the way ros_image_logger.py
+    does. Images are converted and written to disk on a pool of threads.
+
+    Requires rospy.init_node to have been called in this process.
+
+    Example:
+
+        service = ImageCaptureService(tfBuffer=tfBuffer)
+        service.addTopic('rgb', '/camera_carmine_1/rgb/image_rect_color')
+        service.addTopic('depth', '/camera_carmine_1/depth_registered/sw_registered/image_rect')
+        service.start()
+
+        snapshot = service.captureSnapshot(tfFrames=[('base', 'camera_carmine_1_rgb_optical_frame')])
+        service.saveImage(snapshot['msgs']['rgb'], 'rgb.png', encoding='bgr8')
+        service.saveImage(snapshot['msgs']['depth'], 'depth.yaml')
+        service.flush()
+    """
+
+    def __init__(self, tfBuffer=None, bufferSize=30, numWriterThreads=2):
+        """
+        :param tfBuffer: tf2_ros.Buffer, only needed for snapshots that include transforms
+        :param bufferSize: number of recent messages kept for each topic
+        :param numWriterThreads: number of threads writing images to disk
+        """
+        self.tfBuffer = tfBuffer
+        self.bufferSize = bufferSize
+        self.bridge = CvBridge()
+        self.imageWriter = ImageWriter(num_threads=numWriterThreads)
+
+        # key -> rosUtils.SimpleSubscriber
+        self.subscribers = dict()
+
+    def addTopic(self, key, topic, msgType=sensor_msgs.msg.Image):
+        self.subscribers[key] = rosUtils.SimpleSubscriber(topic, msgType, historySize=self.bufferSize)
+
+    def hasTopic(self, key):
+        return key in self.subscribers
+
+    def start(self, keys=None):
+        """
+        Subscribes to the topics (all of them by default) that aren't subscribed yet
+        """
+        if keys is None:
+            keys = self.subscribers.keys()
+
+        for key in keys:
+            if not self.subscribers[key].isStarted():
+                self.subscribers[key].start(queue_size=1)
+
+    def stop(self, keys=None):
+        if keys is None:
+            keys = self.subscribers.keys()
+
+        for key in keys:
+            if self.subscribers[key].isStarted():
+                self.subscribers[key].stop()
+
+    def close(self):
+        """
+        Unsubscribes from everything and waits for the queued images to be written
+        """
+        self.stop()
+        self.imageWriter.close()
+
+    def getImage(self, key, minStamp=None, timeout=5.0):
+        """
+        Returns the first message on the topic with timestamp >= minStamp, waiting
+        for it if necessary. Subscribes to the topic if that hasn't been done yet.
+
+        :param minStamp: rospy.Time, defaults to now, i.e. the next message
+        """
+        if minStamp is None:
+            minStamp = rospy.Time.now()
+
+        self.start(keys=[key])
+        return self.subscribers[key].waitForMessageAfter(minStamp, timeout=timeout)
+
+    def captureSnapshot(self, keys=None, minStamp=None, maxTimeDifference=0.05, timeout=5.0, tfFrames=None):
+        """
+        Captures one message from each of the topics with timestamps within
+        maxTimeDifference of each other. The first key is the reference topic, its
+        message is the first one with timestamp >= minStamp that has a match on every
+        other topic, see rosUtils.MessageSynchronizer. Optionally looks up transforms at
+        the timestamp of the reference message.
+
+        :param keys: list of topic keys, defaults to all the topics
+        :param minStamp: rospy.Time, defaults to now
+        :param maxTimeDifference: in seconds
+        :param tfFrames: list of (target_frame, source_frame) tuples
+        :return: dict with
+            'stamp': timestamp of the reference message
+            'msgs': dict key -> msg
+            'transforms': dict (target_frame, source_frame) -> geometry_msgs.msg.TransformStamped
+        """
+        if keys is None:
+            keys = sorted(self.subscribers.keys())
+        if minStamp is None:
+            minStamp = rospy.Time.now()
+
+        self.start(keys=keys)
+        synchronizer = rosUtils.MessageSynchronizer([self.subscribers[key] for key in keys],
+            maxTimeDifference=maxTimeDifference)
+        try:
+            msgs = synchronizer.waitForMatch(stamp=minStamp, timeout=timeout)
+        finally:
+            synchronizer.close()
+
+        stamp = rosUtils.getMessageStamp(msgs[0])
+
+        transforms = dict()
+        if tfFrames is not None:
+            for targetFrame, sourceFrame in tfFrames:
+                transforms[(targetFrame, sourceFrame)] = self.tfBuffer.lookup_transform(targetFrame, sourceFrame, stamp, rospy.Duration(timeout))
+
+        snapshot = dict()
+        snapshot['stamp'] = stamp
+        snapshot['msgs'] = dict(zip(keys, msgs))
+        snapshot['transforms'] = transforms
+        return snapshot
+
+    def imageMsgToCv2(self, msg, encoding=None):
+        if encoding is None:
+            encoding = "passthrough"
+        return self.bridge.imgmsg_to_cv2(msg, desired_encoding=encoding)
+
+    def saveImage(self, msg, filename, encoding=None):
+        """
+        Converts the image and queues it to be written to filename, returns immediately.
+        Filenames ending in .yaml, .yml or .xml are written with cv2.FileStorage, same as
+        ros_image_logger.py -fs. Call flush() before reading the file back.
+
+        :return: the cv2 image
+        """
+        cv2Img = self.imageMsgToCv2(msg, encoding=encoding)
+        self.imageWriter.write(filename, cv2Img)
+        return cv2Img
+
+    def flush(self):
+        """
+        Blocks until all the images passed to saveImage have been written
+        """
+        self.imageWriter.flush()
@@ -0,0 +1,126 @@
+# system
+import threading
+import Queue
+
+import cv2
+
+
+FILE_STORAGE_EXTENSIONS = (".yaml", ".yml", ".xml")
+
+
+class ImageWriter(object):
+    """
+    Encodes and writes images to disk on a pool of worker threads. cv2.imwrite
+    releases the GIL, so PNG compression runs in parallel with the caller.
+    Filenames ending in .yaml, .yml or .xml are written with cv2.FileStorage
+    instead, under the name "data".
+
+    The queue is bounded, write() blocks once max_queue_size images are waiting,
+    so a fast producer can't buffer an unbounded number of images in memory.
+    Call flush() before writing anything that refers to the images (e.g.
+    pose_data.yaml), it waits until every queued image is on disk and re-raises
+    the first error hit by a worker.
+
+    Example:
+
+        with ImageWriter(num_threads=4) as image_writer:
+            image_writer.write("000000_rgb.png", rgb_img)
+            image_writer.flush()
+    """
+
+    def __init__(self, num_threads=4, max_queue_size=32, png_compression=3):
+        """
+        :param num_threads: number of worker threads
+        :param max_queue_size: max number of images waiting to be written
+        :param png_compression: cv2.IMWRITE_PNG_COMPRESSION level, 0 (fastest) to 9 (smallest)
+        """
+        self.png_compression = png_compression
+        self.queue = Queue.Queue(maxsize=max_queue_size)
+        self.error_lock = threading.Lock()
+        self.errors = []
+        self.num_images_written = 0
+
+        self.threads = []
+        for i in xrange(num_threads):
+            thread = threading.Thread(target=self._worker, name="ImageWriter-%d" %(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't mask an exception that is already propagating
+        self.close(raise_errors=(exc_type is None))
+
+    def _get_params(self, filename):
+        if filename.lower().endswith(".png"):
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        return []
+
+    def _write(self, filename, img):
+        if filename.lower().endswith(FILE_STORAGE_EXTENSIONS):
+            fs_write = cv2.FileStorage(filename, cv2.FILE_STORAGE_WRITE)
+            fs_write.write("data", img)
+            fs_write.release()
+        elif not cv2.imwrite(filename, img, self._get_params(filename)):
+            raise IOError("cv2.imwrite failed to write %s" %(filename))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+
+                filename, img = item
+                self._write(filename, img)
+
+                with self.error_lock:
+                    self.num_images_written += 1
+            except Exception as e:
+                with self.error_lock:
+                    self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _raise_errors(self):
+        with self.error_lock:
+            errors = self.errors
+            self.errors = []
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def write(self, filename, img):
+        """
+        Queues img to be written to filename, blocks if the queue is full.
+        The caller must not modify img afterwards.
+        """
+        if len(self.threads) == 0:
+            raise ValueError("ImageWriter is closed")
+
+        self._raise_errors()
+        self.queue.put((filename, img))
+
+    def flush(self):
+        """
+        Blocks until all the queued images have been written
+        """
+        self.queue.join()
+        self._raise_errors()
+
+    def close(self, raise_errors=True):
+        """
+        Writes out the remaining images and stops the worker threads
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+        if raise_errors:
+            self._raise_errors()
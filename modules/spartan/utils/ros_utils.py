@@ -4,6 +4,8 @@ import time
 import random
 import os
 import math
+import threading
+import collections
 import numpy as np
 
 import cv2
@@ -19,6 +21,7 @@ import tf
 
 # spartan
 import spartan.utils.utils as spartanUtils
+from spartan.utils.image_writer import FILE_STORAGE_EXTENSIONS
 import robot_msgs.srv
 
 
@@ -181,33 +184,45 @@ def depth_image_to_cv2_uint16(depth_image_msg, bridge=None):
 
     return cv_img
 
+_imageCaptureService = None
+
+"""
+Returns the process wide ImageCaptureService used by saveSingleImage and saveSingleDepthImage
+"""
+
+def getImageCaptureService():
+    global _imageCaptureService
+    if _imageCaptureService is None:
+        # image_capture_service imports this module
+        from spartan.utils.image_capture_service import ImageCaptureService
+        _imageCaptureService = ImageCaptureService()
+    return _imageCaptureService
+
 """
-Saves a single image to a filename using an external executable
+Saves the next image on the topic to a filename. The topic stays subscribed
+afterwards, so later calls only wait for the next image. Requires rospy.init_node
+to have been called in this process.
 """
 
 def saveSingleImage(topic, filename, encoding=None):
-        rosImageLoggerExecutable = os.path.join(spartanUtils.getSpartanSourceDir(), 'modules',"spartan",
-                                                'calibration','ros_image_logger.py')
-        cmd = "%s -t %s -f %s" % (rosImageLoggerExecutable, topic, filename)
-        if encoding is not None:
-            cmd += " -e " + encoding
+        imageCaptureService = getImageCaptureService()
+        if not imageCaptureService.hasTopic(topic):
+            imageCaptureService.addTopic(topic, topic)
 
-        os.system(cmd)
+        msg = imageCaptureService.getImage(topic)
+        imageCaptureService.saveImage(msg, filename, encoding=encoding)
+        imageCaptureService.flush()
 
 """
-Saves a single image to a filename using an external executable
+Saves the next depth image on the topic to a filename using cv2.FileStorage,
+the filename must be of type yaml or xml
 """
 
 def saveSingleDepthImage(topic, filename, encoding=None):
-        rosImageLoggerExecutable = os.path.join(spartanUtils.getSpartanSourceDir(), 'modules',"spartan",
-                                                'calibration','ros_image_logger.py')
-        cmd = "%s -t %s -f %s" % (rosImageLoggerExecutable, topic, filename)
-        if encoding is not None:
-            cmd += " -e " + encoding
-
-        cmd += " -fs"
+        if not filename.lower().endswith(FILE_STORAGE_EXTENSIONS):
+            raise ValueError("depth images are saved with cv2.FileStorage, filename must be of type yaml or xml")
 
-        os.system(cmd)
+        saveSingleImage(topic, filename, encoding=encoding)
 
 def getRGBOpticalFrameName(camera_name):
     return "camera_" +  camera_name + "_rgb_optical_frame"
@@ -278,32 +293,352 @@ def setup_tf_transformer_from_ros_bag(bag, cache_time_secs=3600, verbose=False):
     return tf_t
 
 
+"""
+Waits until predicate(), which is called with condition held, returns something
+other than None and returns that. The caller must hold condition and whatever
+predicate depends on must notify it.
+
+A python 2 Condition.wait with a timeout polls (sleeping up to 50 ms), so the
+timeout is implemented with a timer that notifies the condition and the wait
+itself is a plain Condition.wait, which wakes up as soon as it is notified.
+
+Raises rospy.ROSException if timeout (seconds) expires or ROS shuts down.
+"""
+
+def waitForCondition(condition, predicate, timeout=None, description="a message"):
+    timedOut = []
+    timer = None
+    if timeout is not None:
+        def onTimeout():
+            with condition:
+                timedOut.append(True)
+                condition.notify_all()
+
+        timer = threading.Timer(timeout, onTimeout)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        while True:
+            result = predicate()
+            if result is not None:
+                return result
+
+            if len(timedOut) > 0:
+                raise rospy.ROSException("timed out waiting for %s" %(description))
+            if rospy.is_shutdown():
+                raise rospy.ROSException("ROS shutdown while waiting for %s" %(description))
+
+            condition.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+"""
+Timestamp of a message, its header stamp if it has one, otherwise the time it was received
+"""
+
+def getMessageStamp(msg, receiveTime=None):
+    header = getattr(msg, 'header', None)
+    if header is not None:
+        return header.stamp
+
+    if receiveTime is None:
+        receiveTime = rospy.Time.now()
+    return receiveTime
+
+
 class SimpleSubscriber(object):
-    def __init__(self, topic, messageType, externalCallback=None):
+    """
+    Subscribes to a topic and keeps the last historySize messages along with their
+    timestamps. The wait methods block on a threading.Condition that is notified by
+    the subscriber callback, so they return as soon as the message arrives.
+    """
+
+    def __init__(self, topic, messageType, externalCallback=None, historySize=10):
         self.topic = topic
         self.messageType = messageType
         self.externalCallback = externalCallback
         self.hasNewMessage = False
         self.lastMsg = None
+        self.numMessages = 0
+        self.subscriber = None
+
+        # (stamp, msg), guarded by condition
+        self.history = collections.deque(maxlen=historySize)
+        self.condition = threading.Condition()
+
+        # functions called without arguments after every message
+        self.listeners = []
 
     def start(self, queue_size=None):
         self.subscriber = rospy.Subscriber(self.topic, self.messageType, self.callback, queue_size=queue_size)
+        rospy.on_shutdown(self.notifyWaiters)
         
     def stop(self):
         self.subscriber.unregister()
+        self.subscriber = None
+
+    def isStarted(self):
+        return self.subscriber is not None
+
+    def notifyWaiters(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
 
     def callback(self, msg):
-        self.lastMsg = msg
-        self.hasNewMessage = True
+        stamp = getMessageStamp(msg)
+        with self.condition:
+            self.lastMsg = msg
+            self.hasNewMessage = True
+            self.numMessages += 1
+            self.history.append((stamp, msg))
+            self.condition.notify_all()
+
+        for listener in list(self.listeners):
+            listener()
 
         if self.externalCallback is not None:
             self.externalCallback(msg)
 
-    def waitForNextMessage(self):
-        self.hasNewMessage = False
-        while not self.hasNewMessage:
-            rospy.sleep(0.1)
-        return self.lastMsg
+    def getHistory(self):
+        """
+        Returns a list of (stamp, msg), oldest first
+        """
+        with self.condition:
+            return list(self.history)
+
+    def waitForNextMessage(self, timeout=None):
+        """
+        Waits for the next message to arrive after this call
+        """
+        with self.condition:
+            self.hasNewMessage = False
+            numMessages = self.numMessages
+
+            def getNextMessage():
+                if self.numMessages > numMessages:
+                    return self.lastMsg
+                return None
+
+            return waitForCondition(self.condition, getNextMessage, timeout=timeout,
+                description="a message on topic %s" %(self.topic))
+
+    def getMessageAfter(self, stamp):
+        """
+        Returns the oldest message in the history with timestamp >= stamp, None if there isn't one
+        """
+        with self.condition:
+            for msgStamp, msg in self.history:
+                if msgStamp >= stamp:
+                    return msg
+        return None
+
+    def waitForMessageAfter(self, stamp, timeout=None):
+        """
+        Returns the oldest message with timestamp >= stamp, waiting for it if necessary
+        """
+        with self.condition:
+            return waitForCondition(self.condition, lambda: self.getMessageAfter(stamp), timeout=timeout,
+                description="a message on topic %s after %s" %(self.topic, stamp))
+
+    def getClosest(self, stamp, maxTimeDifference=None):
+        """
+        Returns the message in the history with timestamp closest to stamp. None if the history
+        is empty or the closest message is more than maxTimeDifference (rospy.Duration) away.
+        """
+        with self.condition:
+            closest = None
+            closestDifference = None
+            for msgStamp, msg in self.history:
+                difference = abs(msgStamp - stamp)
+                if closestDifference is None or difference < closestDifference:
+                    closest = msg
+                    closestDifference = difference
+
+        if closest is None:
+            return None
+        if maxTimeDifference is not None and closestDifference > maxTimeDifference:
+            return None
+        return closest
+
+
+class MessageSynchronizer(object):
+    """
+    Matches messages from several SimpleSubscribers by timestamp. The first subscriber
+    is the reference, a match is a message from it together with, for each of the other
+    subscribers, the message closest in time, if that is within maxTimeDifference.
+
+    Example:
+
+        synchronizer = MessageSynchronizer([rgbSubscriber, depthSubscriber])
+        rgbMsg, depthMsg = synchronizer.waitForMatch(stamp=rospy.Time.now(), timeout=5.0)
+    """
+
+    def __init__(self, subscribers, maxTimeDifference=0.05):
+        """
+        :param maxTimeDifference: in seconds
+        """
+        self.subscribers = list(subscribers)
+        self.maxTimeDifference = rospy.Duration(maxTimeDifference)
+        self.condition = threading.Condition()
+
+        for subscriber in self.subscribers:
+            subscriber.addListener(self.notifyWaiters)
+
+    def close(self):
+        """
+        Stops listening to the subscribers
+        """
+        for subscriber in self.subscribers:
+            subscriber.removeListener(self.notifyWaiters)
+
+    def notifyWaiters(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def getMatch(self, stamp=None):
+        """
+        Returns a tuple with one message per subscriber, None if there is no match. If stamp
+        is None this is the most recent match, otherwise the oldest match whose reference
+        message has timestamp >= stamp.
+        """
+        history = self.subscribers[0].getHistory()
+        if stamp is None:
+            history = reversed(history)
+
+        for referenceStamp, referenceMsg in history:
+            if stamp is not None and referenceStamp < stamp:
+                continue
+
+            msgs = [referenceMsg]
+            for subscriber in self.subscribers[1:]:
+                msg = subscriber.getClosest(referenceStamp, maxTimeDifference=self.maxTimeDifference)
+                if msg is None:
+                    break
+                msgs.append(msg)
+
+            if len(msgs) == len(self.subscribers):
+                return tuple(msgs)
+
+        return None
+
+    def waitForMatch(self, stamp=None, timeout=None):
+        """
+        Same as getMatch, but waits until there is a match
+        """
+        with self.condition:
+            return waitForCondition(self.condition, lambda: self.getMatch(stamp=stamp), timeout=timeout,
+                description="synchronized messages on topics %s" %(", ".join(s.topic for s in self.subscribers)))
+
+
+class MotionSettledDetector(object):
+    """
+    Decides from the joint_states history of a SimpleSubscriber when the robot has come
+    to rest. The robot counts as settled once, over the last settleTime seconds, every
+    joint stayed within maxJointPositionChange (radians) and, if the messages carry
+    velocities, every joint velocity stayed below maxJointVelocity (radians/second).
+    Messages that don't contain all of jointNames (e.g. from the gripper) are ignored.
+
+    The subscriber's history has to span settleTime, if the robot has already been still
+    for that long waitUntilSettled returns immediately.
+
+    Example:
+
+        jointStatesSubscriber = SimpleSubscriber('/joint_states', sensor_msgs.msg.JointState, historySize=100)
+        jointStatesSubscriber.start()
+        detector = MotionSettledDetector(jointStatesSubscriber, robotService.jointNames)
+
+        robotService.moveToJointPosition(q)
+        stamp = detector.waitUntilSettled(timeout=1.0)
+        # sensor data with timestamp >= stamp was taken with the robot at rest
+    """
+
+    def __init__(self, jointStatesSubscriber, jointNames, settleTime=0.1, maxJointPositionChange=1e-3,
+                 maxJointVelocity=1e-2):
+        """
+        :param settleTime: in seconds
+        """
+        self.subscriber = jointStatesSubscriber
+        self.jointNames = list(jointNames)
+        self.settleTime = rospy.Duration(settleTime)
+        self.maxJointPositionChange = maxJointPositionChange
+        self.maxJointVelocity = maxJointVelocity
+        self.condition = threading.Condition()
+
+        self.subscriber.addListener(self.notifyWaiters)
+
+    def close(self):
+        """
+        Stops listening to the subscriber
+        """
+        self.subscriber.removeListener(self.notifyWaiters)
+
+    def notifyWaiters(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def getJointPositionsAndVelocities(self, msg):
+        """
+        :return: positions and velocities of jointNames, velocities is None if the message
+        has none. None if the message doesn't have all the joints.
+        """
+        try:
+            idx = [msg.name.index(name) for name in self.jointNames]
+        except ValueError:
+            return None
+
+        positions = np.array([msg.position[i] for i in idx])
+        velocities = None
+        if len(msg.velocity) == len(msg.name):
+            velocities = np.array([msg.velocity[i] for i in idx])
+
+        return positions, velocities
+
+    def getSettledStamp(self):
+        """
+        Returns the start of the settleTime window over which the robot has been at rest,
+        None if it isn't settled or the history doesn't span settleTime yet
+        """
+        window = []
+        windowCovered = False
+        for stamp, msg in reversed(self.subscriber.getHistory()):
+            joints = self.getJointPositionsAndVelocities(msg)
+            if joints is None:
+                continue
+
+            window.append((stamp, joints))
+            if window[0][0] - stamp >= self.settleTime:
+                windowCovered = True
+                break
+
+        if not windowCovered:
+            return None
+
+        positions = np.array([positions for _, (positions, _) in window])
+        if np.max(np.ptp(positions, axis=0)) > self.maxJointPositionChange:
+            return None
+
+        for _, (_, velocities) in window:
+            if velocities is not None and np.max(np.abs(velocities)) > self.maxJointVelocity:
+                return None
+
+        return window[-1][0]
+
+    def waitUntilSettled(self, timeout=None):
+        """
+        Same as getSettledStamp, but waits until the robot is settled. Raises
+        rospy.ROSException if it doesn't settle within timeout (seconds).
+        """
+        with self.condition:
+            return waitForCondition(self.condition, self.getSettledStamp, timeout=timeout,
+                description="the robot to settle, joint_states on topic %s" %(self.subscriber.topic))
 
 '''
 Simple wrapper around the robot_control/MoveToJointPosition service
@@ -363,6 +698,38 @@ class RobotService(object):
         rospy.loginfo("ik was successful = %s", response.success)
         return response
 
+    def runIKBatch(self, poseStampedList, seedPose=None, nominalPose=None, timeout=10):
+        """
+        Solves IK for all the targets in one call of the robot_control/IkBatchService,
+        see IkService.onIkBatchServiceRequest. Targets solved before come back from the
+        service's cache without solving again.
+
+        :param seedPose: optional, joint positions for all the targets or a list with one per target
+        :param nominalPose: optional, same as seedPose
+        :return: RunIKBatchResponse with joint_state and success lists, one entry per target
+        """
+        req = robot_msgs.srv.RunIKBatchRequest()
+        req.pose_stamped = list(poseStampedList)
+
+        def addJointStates(jointStates, q):
+            if q is None or len(q) == 0:
+                return
+            if np.ndim(q) == 1:
+                q = [q]
+            for jointPositions in q:
+                jointStates.append(RobotService.jointPositionToJointStateMsg(self.jointNames, jointPositions))
+
+        addJointStates(req.seed_pose, seedPose)
+        addJointStates(req.nominal_pose, nominalPose)
+
+        ikBatchServiceName = 'robot_control/IkBatchService'
+        rospy.wait_for_service(ikBatchServiceName, timeout=timeout)
+        s = rospy.ServiceProxy(ikBatchServiceName, robot_msgs.srv.RunIKBatch)
+        response = s(req)
+
+        rospy.loginfo("ik was successful for %d of %d targets", sum(response.success), len(response.success))
+        return response
+
     @staticmethod
     def jointPositionToJointStateMsg(jointNames, jointPositions):
         assert len(jointNames) == len(jointPositions)
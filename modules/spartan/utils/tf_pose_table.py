@@ -0,0 +1,350 @@
+"""
+Pose tables built from the tf messages in a rosbag.
+
+Rather than replaying every /tf message into a tf.Transformer and querying it
+once per image, TFPoseTable resolves the chain between two frames once, in a
+single pass over the bag, into sorted arrays of timestamps, translations and
+quaternions. Lookups for whole arrays of timestamps are then vectorized
+(lerp for the translation, slerp for the rotation).
+
+Quaternions are (w,x,y,z), the same convention as spartan.utils.transformations.
+Timestamps are integer nanoseconds, i.e. rospy.Time.to_nsec().
+"""
+
+# system
+import os
+import numpy as np
+
+
+def quaternion_multiply(q1, q0):
+    """
+    Vectorized quaternion product q1*q0, q0 and q1 are (...,4)
+    """
+    w0, x0, y0, z0 = np.rollaxis(np.asarray(q0), -1)
+    w1, x1, y1, z1 = np.rollaxis(np.asarray(q1), -1)
+    return np.stack([-x1*x0 - y1*y0 - z1*z0 + w1*w0,
+                     x1*w0 + y1*z0 - z1*y0 + w1*x0,
+                     -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+                     x1*y0 - y1*x0 + z1*w0 + w1*z0], axis=-1)
+
+
+def quaternion_conjugate(q):
+    q = np.array(q, dtype=np.float64)
+    q[..., 1:] *= -1
+    return q
+
+
+def quaternion_rotate(q, v):
+    """
+    Rotates the (...,3) vectors v by the (...,4) unit quaternions q
+    """
+    q = np.asarray(q)
+    w = q[..., :1]
+    u = q[..., 1:]
+    t = 2*np.cross(u, v)
+    return v + w*t + np.cross(u, t)
+
+
+def quaternion_slerp(q0, q1, fraction):
+    """
+    Vectorized spherical linear interpolation, always along the shortest path.
+    q0, q1 are (N,4), fraction is (N,)
+    """
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.array(q1, dtype=np.float64)
+    fraction = np.asarray(fraction, dtype=np.float64)[:, np.newaxis]
+
+    d = np.sum(q0*q1, axis=1)
+    flip = d < 0
+    q1[flip] *= -1
+    d = np.abs(d)[:, np.newaxis]
+
+    # fall back to normalized lerp when the quaternions are (nearly) the same
+    nearly_parallel = d > 1.0 - 1e-8
+    angle = np.arccos(np.clip(d, -1.0, 1.0))
+    sin_angle = np.where(nearly_parallel, 1.0, np.sin(angle))
+    w0 = np.where(nearly_parallel, 1.0 - fraction, np.sin((1.0 - fraction)*angle)/sin_angle)
+    w1 = np.where(nearly_parallel, fraction, np.sin(fraction*angle)/sin_angle)
+
+    q = w0*q0 + w1*q1
+    return q/np.linalg.norm(q, axis=1)[:, np.newaxis]
+
+
+def quaternion_to_rotation_matrix(q):
+    """
+    (...,4) unit quaternions to (...,3,3) rotation matrices
+    """
+    w, x, y, z = np.rollaxis(np.asarray(q), -1)
+    R = np.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w),
+                  2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w),
+                  2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1)
+    return R.reshape(np.shape(w) + (3,3))
+
+
+def compose_transforms(t1, q1, t0, q0):
+    """
+    (t1,q1)*(t0,q0), i.e. apply (t0,q0) first
+    """
+    return quaternion_rotate(q1, t0) + t1, quaternion_multiply(q1, q0)
+
+
+def invert_transform(t, q):
+    q_inv = quaternion_conjugate(q)
+    return -quaternion_rotate(q_inv, t), q_inv
+
+
+def interpolate_transforms(stamps, translations, quaternions, query_stamps):
+    """
+    Interpolates a sorted series of transforms at query_stamps
+    :return: translations (M,3), quaternions (M,4), valid (M,) which is False for
+    stamps outside of [stamps[0], stamps[-1]]
+    """
+    query_stamps = np.asarray(query_stamps, dtype=np.int64)
+    num_stamps = len(stamps)
+    valid = (query_stamps >= stamps[0]) & (query_stamps <= stamps[-1])
+
+    if num_stamps == 1:
+        num_queries = len(query_stamps)
+        return (np.tile(translations[0], (num_queries, 1)), np.tile(quaternions[0], (num_queries, 1)), valid)
+
+    idx = np.clip(np.searchsorted(stamps, query_stamps, side='right') - 1, 0, num_stamps - 2)
+    fraction = (query_stamps - stamps[idx]).astype(np.float64)/(stamps[idx+1] - stamps[idx])
+    fraction = np.clip(fraction, 0.0, 1.0)
+
+    t = translations[idx] + fraction[:, np.newaxis]*(translations[idx+1] - translations[idx])
+    q = quaternion_slerp(quaternions[idx], quaternions[idx+1], fraction)
+    return t, q, valid
+
+
+def transform_msg_to_arrays(msg_tf):
+    """
+    geometry_msgs/TransformStamped to translation (3,) and quaternion (w,x,y,z)
+    """
+    translation = msg_tf.transform.translation
+    rotation = msg_tf.transform.rotation
+    return [translation.x, translation.y, translation.z], [rotation.w, rotation.x, rotation.y, rotation.z]
+
+
+class TFPoseTable(object):
+    """
+    The transform from source_frame to target_frame (i.e. the pose of source_frame
+    in target_frame, same as tf lookupTransform(target_frame, source_frame, stamp))
+    sampled at sorted timestamps.
+    """
+
+    def __init__(self, target_frame, source_frame, stamps, translations, quaternions, is_static=False):
+        """
+        :param stamps: (N,) int64 nanoseconds, sorted
+        :param translations: (N,3)
+        :param quaternions: (N,4), (w,x,y,z)
+        :param is_static: if True the single transform is valid at all times
+        """
+        self.target_frame = target_frame
+        self.source_frame = source_frame
+        self.stamps = np.asarray(stamps, dtype=np.int64)
+        self.translations = np.asarray(translations, dtype=np.float64)
+        self.quaternions = np.asarray(quaternions, dtype=np.float64)
+        self.is_static = is_static
+
+    def __len__(self):
+        return len(self.stamps)
+
+    @property
+    def transforms(self):
+        """
+        (N,4,4) homogeneous transforms
+        """
+        T = np.tile(np.eye(4), (len(self.stamps), 1, 1))
+        T[:, :3, :3] = quaternion_to_rotation_matrix(self.quaternions)
+        T[:, :3, 3] = self.translations
+        return T
+
+    def lookup(self, query_stamps):
+        """
+        Vectorized interpolated lookup
+        :param query_stamps: (M,) int nanoseconds
+        :return: translations (M,3), quaternions (M,4) (w,x,y,z), valid (M,). Queries outside
+        the time range of the table (tf would throw an ExtrapolationException) are not valid.
+        """
+        query_stamps = np.atleast_1d(np.asarray(query_stamps, dtype=np.int64))
+        t, q, valid = interpolate_transforms(self.stamps, self.translations, self.quaternions, query_stamps)
+        if self.is_static:
+            valid = np.ones(len(query_stamps), dtype=bool)
+        return t, q, valid
+
+    def lookup_transforms(self, query_stamps):
+        """
+        Same as lookup, returns (M,4,4) homogeneous transforms and the valid mask
+        """
+        t, q, valid = self.lookup(query_stamps)
+        T = np.tile(np.eye(4), (len(t), 1, 1))
+        T[:, :3, :3] = quaternion_to_rotation_matrix(q)
+        T[:, :3, 3] = t
+        return T, valid
+
+    def lookup_transform(self, stamp):
+        """
+        Drop in replacement for tf.Transformer.lookupTransform(target_frame, source_frame, stamp)
+        :param stamp: rospy.Time or int nanoseconds
+        :return: (trans, rot) with rot (x,y,z,w), None if the stamp is outside the table
+        """
+        if hasattr(stamp, 'to_nsec'):
+            stamp = stamp.to_nsec()
+
+        t, q, valid = self.lookup([stamp])
+        if not valid[0]:
+            return None
+
+        # plain floats, these end up in yaml files
+        w, x, y, z = [float(v) for v in q[0]]
+        return [float(v) for v in t[0]], [x, y, z, w]
+
+    def save(self, filename):
+        np.savez(filename, target_frame=self.target_frame, source_frame=self.source_frame, stamps=self.stamps,
+                 translations=self.translations, quaternions=self.quaternions, is_static=self.is_static)
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        return TFPoseTable(str(data['target_frame']), str(data['source_frame']), data['stamps'],
+                           data['translations'], data['quaternions'], is_static=bool(data['is_static']))
+
+    @staticmethod
+    def get_cache_filename(bag_filename, target_frame, source_frame):
+        """
+        The cache lives beside the bag
+        """
+        return "%s.pose_table.%s.%s.npz" %(os.path.splitext(bag_filename)[0], target_frame.strip('/'),
+                                            source_frame.strip('/'))
+
+    @staticmethod
+    def from_ros_bag_cached(bag, target_frame, source_frame):
+        """
+        Same as from_ros_bag but loads the table from the cache file beside the bag
+        if there is an up to date one, otherwise builds it and writes the cache.
+        """
+        cache_filename = TFPoseTable.get_cache_filename(bag.filename, target_frame, source_frame)
+        if os.path.exists(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(bag.filename):
+            print "loading pose table from", cache_filename
+            return TFPoseTable.load(cache_filename)
+
+        pose_table = TFPoseTable.from_ros_bag(bag, target_frame, source_frame)
+        try:
+            pose_table.save(cache_filename)
+        except (IOError, OSError) as e:
+            print "couldn't write pose table cache %s: %s" %(cache_filename, e)
+
+        return pose_table
+
+    @staticmethod
+    def from_ros_bag(bag, target_frame, source_frame):
+        """
+        Reads /tf_static and /tf once and resolves the chain from source_frame to
+        target_frame. The table is sampled at the union of the timestamps of the
+        dynamic transforms on the chain, restricted to the time range where all of
+        them are available.
+        """
+        # child frame -> (parent frame, translation, quaternion)
+        static_edges = dict()
+        for topic, msg, t in bag.read_messages(topics=['/tf_static']):
+            for msg_tf in msg.transforms:
+                child_frame_id = msg_tf.child_frame_id.strip('/')
+                if child_frame_id in static_edges:
+                    continue
+                translation, quaternion = transform_msg_to_arrays(msg_tf)
+                static_edges[child_frame_id] = (msg_tf.header.frame_id.strip('/'), translation, quaternion)
+
+        # child frame -> dict with the parent frame and lists of stamps, translations, quaternions
+        dynamic_edges = dict()
+        for topic, msg, t in bag.read_messages(topics=['/tf']):
+            for msg_tf in msg.transforms:
+                child_frame_id = msg_tf.child_frame_id.strip('/')
+                if child_frame_id not in dynamic_edges:
+                    dynamic_edges[child_frame_id] = {'parent': msg_tf.header.frame_id.strip('/'), 'stamps': [],
+                                                     'translations': [], 'quaternions': []}
+                edge = dynamic_edges[child_frame_id]
+                translation, quaternion = transform_msg_to_arrays(msg_tf)
+                edge['stamps'].append(msg_tf.header.stamp.to_nsec())
+                edge['translations'].append(translation)
+                edge['quaternions'].append(quaternion)
+
+        return TFPoseTable.from_edges(static_edges, dynamic_edges, target_frame, source_frame)
+
+    @staticmethod
+    def from_edges(static_edges, dynamic_edges, target_frame, source_frame):
+        target_frame = target_frame.strip('/')
+        source_frame = source_frame.strip('/')
+
+        def get_parent(frame):
+            if frame in dynamic_edges:
+                return dynamic_edges[frame]['parent']
+            if frame in static_edges:
+                return static_edges[frame][0]
+            return None
+
+        def chain_to_root(frame):
+            chain = [frame]
+            while get_parent(chain[-1]) is not None:
+                chain.append(get_parent(chain[-1]))
+                if len(chain) > len(static_edges) + len(dynamic_edges) + 1:
+                    raise ValueError("tf tree has a cycle at frame %s" %(frame))
+            return chain
+
+        source_chain = chain_to_root(source_frame)
+        target_chain = chain_to_root(target_frame)
+        if source_chain[-1] != target_chain[-1]:
+            raise ValueError("frames %s and %s aren't connected in the tf tree" %(source_frame, target_frame))
+
+        # drop the common ancestors, keep only the child frame of each edge on the path
+        while len(source_chain) > 1 and len(target_chain) > 1 and source_chain[-2] == target_chain[-2]:
+            source_chain.pop()
+            target_chain.pop()
+        source_edges = source_chain[:-1]
+        target_edges = target_chain[:-1]
+
+        # sort the dynamic edges on the path and find the stamps to sample at
+        dynamic_series = dict()
+        for frame in source_edges + target_edges:
+            if frame not in dynamic_edges:
+                continue
+            edge = dynamic_edges[frame]
+            stamps, unique_idx = np.unique(np.asarray(edge['stamps'], dtype=np.int64), return_index=True)
+            dynamic_series[frame] = (stamps, np.asarray(edge['translations'])[unique_idx],
+                                     np.asarray(edge['quaternions'])[unique_idx])
+
+        is_static = len(dynamic_series) == 0
+        if is_static:
+            stamps = np.zeros(1, dtype=np.int64)
+        else:
+            start = max(series[0][0] for series in dynamic_series.values())
+            end = min(series[0][-1] for series in dynamic_series.values())
+            if start > end:
+                raise ValueError("the transforms between %s and %s never overlap in time" %(source_frame, target_frame))
+            stamps = np.unique(np.concatenate([series[0] for series in dynamic_series.values()]))
+            stamps = stamps[(stamps >= start) & (stamps <= end)]
+
+        num_stamps = len(stamps)
+
+        def edge_transforms(frame):
+            if frame in dynamic_series:
+                t, q, _ = interpolate_transforms(dynamic_series[frame][0], dynamic_series[frame][1],
+                                                 dynamic_series[frame][2], stamps)
+                return t, q
+            _, translation, quaternion = static_edges[frame]
+            return np.tile(translation, (num_stamps, 1)), np.tile(quaternion, (num_stamps, 1))
+
+        def chain_transforms(edges):
+            # pose of edges[0] in the common ancestor frame
+            t = np.zeros((num_stamps, 3))
+            q = np.tile([1.0, 0.0, 0.0, 0.0], (num_stamps, 1))
+            for frame in edges:
+                t_edge, q_edge = edge_transforms(frame)
+                t, q = compose_transforms(t_edge, q_edge, t, q)
+            return t, q
+
+        source_to_ancestor = chain_transforms(source_edges)
+        target_to_ancestor = chain_transforms(target_edges)
+        ancestor_to_target = invert_transform(*target_to_ancestor)
+        t, q = compose_transforms(ancestor_to_target[0], ancestor_to_target[1], *source_to_ancestor)
+
+        return TFPoseTable(target_frame, source_frame, stamps, t, q, is_static=is_static)
@@ -0,0 +1,78 @@
+import numpy as np
+import time
+
+NUM_FRICTION_CONE_BASIS_VECTORS = 4
+
+
+def stackJacobianToFrictionCone(linkJacobians, J_alpha):
+    """
+    Computes the jacobian to friction cone matrices for a batch of problems in one shot.
+    This is the batched version of ContactFilter.computeJacobianToFrictionCone
+    :param linkJacobians: (numProblems, numContacts, 6, nv) geometric jacobian of the link
+    each contact point lives on, expressed in that link's frame
+    :param J_alpha: (numProblems, numContacts, 6, NUM_FRICTION_CONE_BASIS_VECTORS)
+    :return: H, (numProblems, nv, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS). The block
+    H[k,:,4*i:4*(i+1)] is the jacobian to friction cone of contact i in problem k
+    """
+    numProblems, numContacts, _, nv = np.shape(linkJacobians)
+    H = np.einsum('nkwv,nkwj->nvkj', linkJacobians, J_alpha)
+    return H.reshape(numProblems, nv, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS)
+
+
+class BatchMeasurementUpdate(object):
+    """
+    Evaluates the measurement model for many candidate contact configurations at once.
+    All problems in a batch share the same residual and the same number of contact points,
+    which is exactly the situation in a particle set measurement update.
+    """
+
+    def __init__(self, qpSolver, weightMatrix, covarianceMatrixInverse, solverType):
+        """
+        :param qpSolver: qpsolver.QPSolver
+        :param weightMatrix: nv x nv weight matrix of the QP
+        :param covarianceMatrixInverse: nv x nv inverse covariance of the measurement model
+        :param solverType: one of the solver types supported by qpSolver
+        """
+        self.qpSolver = qpSolver
+        self.weightMatrix = weightMatrix
+        self.covarianceMatrixInverse = covarianceMatrixInverse
+        self.solverType = solverType
+
+    def computeLikelihoods(self, residual, H, rotatedFrictionCones):
+        """
+        Solves the QP's and computes implied residuals, squared errors and likelihoods
+        for the whole batch.
+        :param residual: (nv,) measured residual
+        :param H: (numProblems, nv, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS), see stackJacobianToFrictionCone
+        :param rotatedFrictionCones: (numProblems, numContacts, 3, NUM_FRICTION_CONE_BASIS_VECTORS)
+        :return: dict of numpy arrays, the leading dimension is always numProblems
+        """
+        numProblems, nv, numVars = np.shape(H)
+        numContacts = numVars//NUM_FRICTION_CONE_BASIS_VECTORS
+
+        startTime = time.time()
+        qpSolnData = self.qpSolver.solveBatch(numContacts, residual, H, self.weightMatrix,
+                                              solverType=self.solverType)
+        solveTime = time.time() - startTime
+
+        alphaVals = qpSolnData['alphaVals']
+        impliedResidual = np.einsum('nvj,nj->nv', H, alphaVals.reshape(numProblems, numVars))
+        residualBar = residual - impliedResidual
+
+        squaredError = np.einsum('nv,vw,nw->n', residualBar, self.weightMatrix, residualBar)
+        likelihoodExponent = np.einsum('nv,vw,nw->n', residualBar, self.covarianceMatrixInverse, residualBar)
+        likelihood = np.exp(-1/2.0*likelihoodExponent)
+
+        # force at each contact point, in link frame
+        forces = np.einsum('nkij,nkj->nki', rotatedFrictionCones, alphaVals)
+
+        d = dict()
+        d['alphaVals'] = alphaVals
+        d['forces'] = forces
+        d['impliedResidual'] = impliedResidual
+        d['squaredError'] = squaredError
+        d['likelihoodExponent'] = likelihoodExponent
+        d['likelihood'] = likelihood
+        d['qpObjValue'] = qpSolnData['objectiveValue']
+        d['solveTime'] = solveTime
+        return d
@@ -35,6 +35,12 @@ import cpf_lcmtypes
 import contactpointlocator
 import contactfilterutils as cfUtils
 import qpsolver
+import batchmeasurementupdate
+import motionmodel
+import resampling
+import particlearrays
+import parallelmeasurementupdate
+import multicontactsearch
 from pythondrakemodel import PythonDrakeModel
 
 
@@ -103,6 +109,11 @@ class ContactFilter(object):
     def stop(self):
         self.running = False
 
+    # stops the filter and the worker processes of the parallel measurement update
+    def shutdown(self):
+        self.stop()
+        self.closeParallelMeasurementUpdate()
+
 
     def addSubscribers(self):
         if self.options['debug']['useTrueResidual']:
@@ -147,6 +158,14 @@ class ContactFilter(object):
         self.debugInfo['jacobianTime'] = 0.0
         self.debugInfo['measurementUpdateTime'] = 0.0
         self.debugInfo['avgQPSolveTime'] = 0.0
+        self.debugInfo['jacobianCacheHitRate'] = None
+        self.debugInfo['motionModelSetupTime'] = 0.0
+        self.debugInfo['motionModelTime'] = 0.0
+        self.debugInfo['effectiveSampleSize'] = None
+        self.debugInfo['numResamplingSkipped'] = 0
+        self.debugInfo['stepPhaseTimes'] = dict()
+        self.debugInfo['multiContactSearchNumQPs'] = None
+        self.debugInfo['multiContactSearchNumCombinations'] = None
         self.debugInfo['haveShownLikelihoodPlot'] = False
 
     def printDebugInfo(self):
@@ -154,6 +173,13 @@ class ContactFilter(object):
         print "avg QP Solve Time: ", self.debugInfo['avgQPSolveTime']
         print "total QP Solve Time ", self.debugInfo['totalQPSolveTime']
         print "measurement update time: ", self.debugInfo['measurementUpdateTime']
+        print "jacobian cache hit rate: ", self.debugInfo['jacobianCacheHitRate']
+        print "motion model time: ", self.debugInfo['motionModelTime']
+        print "motion model setup time: ", self.debugInfo['motionModelSetupTime']
+        print "effective sample size: ", self.debugInfo['effectiveSampleSize']
+        print "num times resampling skipped: ", self.debugInfo['numResamplingSkipped']
+        print "multi contact search QP's: ", self.debugInfo['multiContactSearchNumQPs'], "for", \
+            self.debugInfo['multiContactSearchNumCombinations'], "combinations"
         print ""
 
 
@@ -279,73 +305,67 @@ class ContactFilter(object):
 
 
 
-    # TODO (manuelli): DEPRECATED, remove this
     def setupMotionModelData(self, withinLinkOnly=False):
+        """
+        Builds the sparse transition table used by the contact point table motion model,
+        see motionmodel.SparseMotionModel
+        :param withinLinkOnly: only allow the motion model to move particles to other
+        contact points on the same link
+        :return: None
+        """
         # need to make sure you call loadContactFilterPointsFromFile before you get here
+        startTime = time.time()
 
-        self.motionModelData = {}
-        var = self.options['motionModel']['var']
-
+        # the probability of moving between cfp's depends only on the cartesian distance between
+        # them in the world frame evaluated at the zero pose of the robot q = zeros.
+        # This is just a rough approximation for now
+        q = np.zeros(self.drakeModel.numJoints)
+        self.drakeModel.setJointPositions(q)
+
+        # link frames at the zero pose, also needed to locate cfp's that aren't in the table
+        self.zeroPoseLinkFrames = {}
+        for linkName in self.drakeModel.model.getLinkNames():
+            linkName = str(linkName)
+            linkToWorld = vtk.vtkTransform()
+            self.drakeModel.model.getLinkToWorld(linkName, linkToWorld)
+            self.zeroPoseLinkFrames[linkName] = linkToWorld
+
+        numCFP = len(self.contactFilterPointListAll)
+        worldPositions = np.zeros((numCFP, 3))
+        linkIds = np.zeros(numCFP, dtype=int)
+        self.motionModelCFPIdx = {}
+        for idx, cfp in enumerate(self.contactFilterPointListAll):
+            worldPositions[idx] = self.getCFPLocationAtZeroPose(cfp)
+            linkIds[idx] = cfp.bodyId
+            self.motionModelCFPIdx[cfp] = idx
+
+        groupIds = None
         if withinLinkOnly:
-            # only allows motion modle to put positive probability on other particles in the
-            # same link
-            for linkName, cfpList in self.contactFilterPointDict.iteritems():
-                for cfp in cfpList:
-                    numCFP = len(cfpList)
-                    xk = np.arange(0,numCFP)
-                    pk = np.zeros(numCFP)
-
-                    for idx, cfpNext in enumerate(cfpList):
-                        distance = np.linalg.norm(cfp.contactLocation - cfpNext.contactLocation)
-                        prob = np.exp(-1.0/(2*var)*distance**2) # note that this is not properly normalized
-                        pk[idx] = prob
-
-                    pk = pk/np.sum(pk) #normalize the distribution so it is really a probability
-                    rv = scipy.stats.rv_discrete(values=(xk,pk))
-                    d = {'cfpList': cfpList, 'randomVar': rv}
-                    self.motionModelData[cfp] = d
-
-
-        else: # in this case we allow motion model to move any particle to any other with a given
-            # probability. The probability depends only on the cartesian distance between particles
-            # in the world frame evaluated at the zero pose of the robot q = zeros.
-
-            # default pose of zeros where we can run doKinematics to figure out
-            # the distances between the different cfp's for use in the motion model
-            q = np.zeros(self.drakeModel.numJoints)
-            self.drakeModel.model.setJointPositions(q)
-
-            # compute location, in world frame of all
-            worldPosition = {}
-            for linkName, cfpList in self.contactFilterPointDict.iteritems():
-                linkToWorld = vtk.vtkTransform()
-                self.drakeModel.model.getLinkToWorld(linkName, linkToWorld)
-
-                for cfp in cfpList:
-                    contactPointInWorld = linkToWorld.TransformPoint(cfp.contactLocation)
-                    worldPosition[cfp] = np.array(contactPointInWorld)
-
-
-            numCFP = len(self.contactFilterPointListAll)
-            for cfp in self.contactFilterPointListAll:
-
-                cfpList = self.contactFilterPointListAll
-                xk = np.arange(0,numCFP)
-                pk = np.zeros(numCFP)
-
-                # compute distance to all other cfp's in the list. This is the distance between
-                # them in world frame evaluated at the zero pose. This is just a rough approximation for
-                # now
-                for idx, cfpNext in enumerate(cfpList):
-                    distance = np.linalg.norm(worldPosition[cfp] - worldPosition[cfpNext])
-                    prob = np.exp(-1.0/(2*var)*distance**2) # note that this is not properly normalized
-                    pk[idx] = prob
-
-                pk = pk/np.sum(pk)
-                rv = scipy.stats.rv_discrete(values=(xk,pk))
-                d = {'cfpList': cfpList, 'randomVar': rv}
-                self.motionModelData[cfp] = d
+            groupIds = linkIds
+
+        self.motionModel = motionmodel.SparseMotionModel(worldPositions, self.options['motionModel']['var'],
+                                                         cutoffNumStdDevs=self.options['motionModel']['tableCutoffNumStdDevs'],
+                                                         groupIds=groupIds)
+
+        self.debugInfo['motionModelSetupTime'] = time.time() - startTime
 
+    def getCFPLocationAtZeroPose(self, cfp):
+        linkToWorld = self.zeroPoseLinkFrames[cfp.linkName]
+        return np.array(linkToWorld.TransformPoint(cfp.contactLocation))
+
+    def getMotionModelTableIdx(self, cfpList):
+        """
+        Index of each cfp in the motion model table. Cfp's that aren't in the table,
+        e.g. ones created by the contact point locator, get the index of the nearest table entry.
+        """
+        idx = np.zeros(len(cfpList), dtype=int)
+        for i, cfp in enumerate(cfpList):
+            if cfp in self.motionModelCFPIdx:
+                idx[i] = self.motionModelCFPIdx[cfp]
+            else:
+                idx[i] = self.motionModel.findNearest(self.getCFPLocationAtZeroPose(cfp))[0]
+
+        return idx
 
     def initializeGurobiModel(self):
         import contactfiltergurobi
@@ -358,6 +378,47 @@ class ContactFilter(object):
         # numContactsList = [1,2,3,4]
         numContactsList = [1,2,3,4]
         self.qpSolver = qpsolver.QPSolver(numContactsList, self.options)
+        self.batchMeasurementUpdate = batchmeasurementupdate.BatchMeasurementUpdate(self.qpSolver,
+                                                                                    self.weightMatrix,
+                                                                                    self.covarianceMatrixInverse,
+                                                                                    self.options['solver']['solverType'])
+
+        self.multiContactSearch = multicontactsearch.MultiContactSearch(self.qpSolver, self.options['solver']['solverType'],
+                                                                        topK=self.options['multiContactSearch']['topK'])
+
+        self.parallelMeasurementUpdate = None
+        self.updateParallelMeasurementUpdate()
+
+    def useParallelMeasurementUpdate(self):
+        return self.options['parallel']['enabled']
+
+    def setParallelMeasurementUpdateEnabled(self, enabled):
+        self.options['parallel']['enabled'] = enabled
+        self.updateParallelMeasurementUpdate()
+
+    def updateParallelMeasurementUpdate(self):
+        """
+        Starts the worker pool if parallel/enabled is set and closes it if not, so that
+        toggling the option doesn't leave worker processes behind
+        """
+        if not self.useParallelMeasurementUpdate():
+            self.closeParallelMeasurementUpdate()
+            return
+
+        if self.parallelMeasurementUpdate is None:
+            parallelOptions = self.options['parallel']
+            self.parallelMeasurementUpdate = parallelmeasurementupdate.ParallelMeasurementUpdate(
+                self.options, self.qpSolver.numContactsList, numWorkers=parallelOptions['numWorkers'],
+                chunkSize=parallelOptions['chunkSize'])
+
+    def closeParallelMeasurementUpdate(self):
+        if self.parallelMeasurementUpdate is not None:
+            self.parallelMeasurementUpdate.close()
+            self.parallelMeasurementUpdate = None
+
+    def useBatchMeasurementUpdate(self):
+        # the workers in the parallel measurement update always use the batch update
+        return (self.options['measurementModel']['updateType'] == 'batch') or self.useParallelMeasurementUpdate()
 
     def initializeTestParticleSet(self):
         # creates a particle set with all particles
@@ -392,8 +453,7 @@ class ContactFilter(object):
 
     # make sure you call doKinematics before getting here
     def computeJacobianToFrictionCone(self, contactPoint):
-        linkJacobian = self.drakeModel.geometricJacobian(0, contactPoint.bodyId, contactPoint.bodyId,
-                                                         0, False)
+        linkJacobian = self.drakeModel.getLinkJacobian(contactPoint.bodyId)
 
         H = np.dot(linkJacobian.transpose(), contactPoint.J_alpha)
         return H
@@ -452,20 +512,113 @@ class ContactFilter(object):
                     'likelihood': likelihood, 'likelihoodExponent': likelihoodExponent, 'time': self.currentTime}
         return solnData
 
+    # batched version of computeSingleLikelihood, all lists in cfpLists must have the same length
+    # should have already called doKinematics before you get here
+    def computeLikelihoodBatch(self, residual, cfpLists):
+        """
+        Solves the QP's for many contact configurations at once
+        :param residual:
+        :param cfpLists: list of lists of ContactFilterPoints, all of the same length
+        :return: list of solnData dicts, same format as computeSingleLikelihood
+        """
+        numProblems = len(cfpLists)
+        if numProblems == 0:
+            return []
+
+        if self.useParallelMeasurementUpdate():
+            handle = self.submitLikelihoodBatch(residual, cfpLists)
+            return self.collectLikelihoodBatch(cfpLists, handle)
+
+        bodyIds, J_alpha, rotatedFrictionCones = self.getLikelihoodBatchArrays(cfpLists)
+        numContacts = len(cfpLists[0])
+        nv = self.drakeModel.numJoints
+
+        linkJacobians = np.zeros((numProblems, numContacts, 6, nv))
+        for i in xrange(0, numProblems):
+            for j in xrange(0, numContacts):
+                linkJacobians[i,j] = self.drakeModel.getLinkJacobian(bodyIds[i,j])
+
+        H = batchmeasurementupdate.stackJacobianToFrictionCone(linkJacobians, J_alpha)
+        batchData = self.batchMeasurementUpdate.computeLikelihoods(residual, H, rotatedFrictionCones)
+        return self.createSolnDataListFromBatchData(cfpLists, batchData)
+
+    def getLikelihoodBatchArrays(self, cfpLists):
+        """
+        :return: bodyIds (numProblems, numContacts), J_alpha and rotatedFrictionCones stacked
+        in the shapes expected by batchmeasurementupdate
+        """
+        numProblems = len(cfpLists)
+        numContacts = len(cfpLists[0])
+
+        bodyIds = np.zeros((numProblems, numContacts), dtype=int)
+        J_alpha = np.zeros((numProblems, numContacts, 6, FRICTION_CONE_APPROX_SIZE))
+        rotatedFrictionCones = np.zeros((numProblems, numContacts, 3, FRICTION_CONE_APPROX_SIZE))
+
+        for i, cfpList in enumerate(cfpLists):
+            for j, cfp in enumerate(cfpList):
+                bodyIds[i,j] = cfp.bodyId
+                J_alpha[i,j] = cfp.J_alpha
+                rotatedFrictionCones[i,j] = cfp.rotatedFrictionCone
+
+        return bodyIds, J_alpha, rotatedFrictionCones
+
+    # starts computeLikelihoodBatch in the worker pool without waiting for the result
+    def submitLikelihoodBatch(self, residual, cfpLists):
+        self.updateParallelMeasurementUpdate()
+        bodyIds, J_alpha, rotatedFrictionCones = self.getLikelihoodBatchArrays(cfpLists)
+        return self.parallelMeasurementUpdate.submit(self.drakeModel.q, residual, bodyIds, J_alpha,
+                                                     rotatedFrictionCones)
+
+    def collectLikelihoodBatch(self, cfpLists, handle):
+        batchData = self.parallelMeasurementUpdate.collect(handle)
+        return self.createSolnDataListFromBatchData(cfpLists, batchData)
+
+    def createSolnDataListFromBatchData(self, cfpLists, batchData):
+        """
+        Converts the output of BatchMeasurementUpdate.computeLikelihoods into a list
+        of solnData dicts, same format as computeSingleLikelihood
+        """
+        numProblems = len(cfpLists)
+        numContacts = len(cfpLists[0])
+
+        self.debugInfo['totalQPSolveTime'] += batchData['solveTime']
+        self.debugInfo['numQPSolves'] += numProblems
+
+        solnDataList = [None]*numProblems
+        for i, cfpList in enumerate(cfpLists):
+            cfpData = []
+            for j, cfp in enumerate(cfpList):
+                d = {'ContactFilterPoint': cfp}
+                d['force'] = batchData['forces'][i,j]
+                d['alpha'] = batchData['alphaVals'][i,j]
+                cfpData.append(d)
+
+            solnData = {'cfpData': cfpData, 'impliedResidual': batchData['impliedResidual'][i],
+                        'squaredError': batchData['squaredError'][i], "numContactPoints": numContacts,
+                        'qpObjValue': batchData['qpObjValue'][i], 'likelihood': batchData['likelihood'][i],
+                        'likelihoodExponent': batchData['likelihoodExponent'][i], 'time': self.currentTime}
+            solnDataList[i] = solnData
+
+        return solnDataList
+
     def computeLikelihoodFull(self, residual, publish=True, verbose=False):
 
 
         q = self.getCurrentPose()
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
 
         startTime = time.time()
         # this stores the current measurement update information
         self.measurementUpdateSolnDataList = []
 
         if not self.doMultiContactEstimate:
-            for linkName, cfpList in self.contactFilterPointDict.iteritems():
-                for cfp in cfpList:
-                    self.measurementUpdateSolnDataList.append(self.computeSingleLikelihood(residual, [cfp]))
+            if self.useBatchMeasurementUpdate():
+                cfpLists = [[cfp] for cfpList in self.contactFilterPointDict.itervalues() for cfp in cfpList]
+                self.measurementUpdateSolnDataList = self.computeLikelihoodBatch(residual, cfpLists)
+            else:
+                for linkName, cfpList in self.contactFilterPointDict.iteritems():
+                    for cfp in cfpList:
+                        self.measurementUpdateSolnDataList.append(self.computeSingleLikelihood(residual, [cfp]))
 
 
         if self.doMultiContactEstimate:
@@ -476,9 +629,20 @@ class ContactFilter(object):
             for linkName in self.linksWithExternalForce:
                 activeLinkContactPointList.append(self.contactFilterPointDict[linkName])
 
-            for cfpList in itertools.product(*activeLinkContactPointList):
-                solnData = self.computeSingleLikelihood(residual, cfpList)
-                self.measurementUpdateSolnDataList.append(solnData)
+            if self.options['multiContactSearch']['method'] == 'branchAndBound':
+                cfpLists = self.searchMultiContactCombinations(residual, activeLinkContactPointList)
+                if self.useBatchMeasurementUpdate():
+                    self.measurementUpdateSolnDataList = self.computeLikelihoodBatch(residual, cfpLists)
+                else:
+                    for cfpList in cfpLists:
+                        self.measurementUpdateSolnDataList.append(self.computeSingleLikelihood(residual, cfpList))
+            elif self.useBatchMeasurementUpdate():
+                cfpLists = list(itertools.product(*activeLinkContactPointList))
+                self.measurementUpdateSolnDataList = self.computeLikelihoodBatch(residual, cfpLists)
+            else:
+                for cfpList in itertools.product(*activeLinkContactPointList):
+                    solnData = self.computeSingleLikelihood(residual, cfpList)
+                    self.measurementUpdateSolnDataList.append(solnData)
 
         elapsedTime = time.time() - startTime
         if verbose:
@@ -489,12 +653,42 @@ class ContactFilter(object):
             self.publishMostLikelyEstimate()
 
 
+    # should have already called doKinematics before you get here
+    def searchMultiContactCombinations(self, residual, activeLinkContactPointList):
+        """
+        Branch and bound search for the multiContactSearch/topK best combinations in
+        itertools.product(*activeLinkContactPointList), see multicontactsearch.py
+        :return: list of cfp lists, sorted by squared error
+        """
+        linkH = []
+        for cfpList in activeLinkContactPointList:
+            linkH.append(np.array([self.computeJacobianToFrictionCone(cfp) for cfp in cfpList]))
+
+        searchData = self.multiContactSearch.search(residual, self.weightMatrix, linkH)
+
+        # the caller solves the QP's of the returned combinations again to get the full
+        # solution data, count those as well
+        self.debugInfo['multiContactSearchNumQPs'] = searchData['numQPs'] + len(searchData['combinations'])
+        self.debugInfo['multiContactSearchNumCombinations'] = int(np.prod([len(cfpList) for cfpList in
+                                                                          activeLinkContactPointList]))
+
+        cfpLists = []
+        for combination in searchData['combinations']:
+            cfpLists.append([activeLinkContactPointList[l][idx] for l, idx in enumerate(combination)])
+
+        return cfpLists
+
     def measurementUpdateSingleParticleSet(self, residual, particleSet, externalParticles = []):
         q = self.getCurrentPose()
 
         # be careful here, this doKinematics call could be the slow thing? But hopefully not because
         # this call is ultimately getting pushed through to c++
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
+
+        if self.useBatchMeasurementUpdate():
+            self.measurementUpdateSingleParticleSetBatch(residual, particleSet, externalParticles=externalParticles)
+            return
+
         # be smart about it, see if we have already computed the QP for a particle with the same cfp!!!
 
         alreadySolved = {} # should be a dict with ContactFilterPoint as key, solnData as key
@@ -531,14 +725,86 @@ class ContactFilter(object):
         # note this doesn't update the most likely particle
         # only do that after doing importance resampling
 
+    # should have already called doKinematics before you get here
+    def measurementUpdateSingleParticleSetBatch(self, residual, particleSet, externalParticles=[]):
+        """
+        Same as measurementUpdateSingleParticleSet but solves the QP's for all the unique
+        cfp's in the particle set with a single call to computeLikelihoodBatch
+        """
+        uniqueParticles, cfpLists = self.getUniqueParticleProblems(particleSet, externalParticles)
+        solnDataList = self.computeLikelihoodBatch(residual, cfpLists)
+        self.setParticleSetSolnData(particleSet, uniqueParticles, solnDataList, externalParticles)
+
+    def getUniqueParticleProblems(self, particleSet, externalParticles):
+        """
+        :return: list with the first particle for each unique cfp in the particle set, and the
+        cfp list (particle cfp followed by the external cfp's) that needs to be solved for each
+        """
+        externalCFPList = [particle.cfp for particle in externalParticles]
+
+        # the first particle with a given cfp is the one that gets recorded in the solnData
+        uniqueParticles = []
+        uniqueCFP = set()
+        for particle in particleSet.particleList:
+            if particle.cfp not in uniqueCFP:
+                uniqueCFP.add(particle.cfp)
+                uniqueParticles.append(particle)
+
+        cfpLists = [[particle.cfp] + externalCFPList for particle in uniqueParticles]
+        return uniqueParticles, cfpLists
+
+    def setParticleSetSolnData(self, particleSet, uniqueParticles, solnDataList, externalParticles):
+        alreadySolved = {}
+        for particle, solnData in zip(uniqueParticles, solnDataList):
+            solnData['force'] = solnData['cfpData'][0]['force']
+
+            # this just makes sure we record the particle in addition to the cfp in the soln data
+            particleList = [particle] + externalParticles
+            for idx, d in enumerate(solnData['cfpData']):
+                d['particle'] = particleList[idx]
+
+            alreadySolved[particle.cfp] = solnData
+
+        for particle in particleSet.particleList:
+            particle.solnData = alreadySolved[particle.cfp]
+
+    def measurementUpdateParallel(self, residual, externalParticlesList):
+        """
+        Submits the measurement updates for all the particle sets to the worker pool at
+        once and then collects them in particle set order
+        :param externalParticlesList: external particles for each particle set
+        """
+        self.drakeModel.setJointPositions(self.getCurrentPose())
+
+        submitted = []
+        for particleSet, externalParticles in zip(self.particleSetList, externalParticlesList):
+            uniqueParticles, cfpLists = self.getUniqueParticleProblems(particleSet, externalParticles)
+            handle = None
+            if len(cfpLists) > 0:
+                handle = self.submitLikelihoodBatch(residual, cfpLists)
+            submitted.append((uniqueParticles, cfpLists, handle))
+
+        for particleSet, externalParticles, (uniqueParticles, cfpLists, handle) in zip(self.particleSetList,
+                                                                                    externalParticlesList,
+                                                                                    submitted):
+            if handle is None:
+                continue
+            solnDataList = self.collectLikelihoodBatch(cfpLists, handle)
+            self.setParticleSetSolnData(particleSet, uniqueParticles, solnDataList, externalParticles)
+
     def computeMeasurementUpdate(self, residual, publish=True):
 
         self.debugInfo['numQPSolves'] = 0.0
         self.debugInfo['totalQPSolveTime'] = 0.0
         self.debugInfo['jacobianTime'] = 0.0
+        jacobianCacheStatsStart = self.drakeModel.jacobianCache.getStatistics()
+
+        # picks up changes to parallel/enabled made directly in self.options
+        self.updateParallelMeasurementUpdate()
 
         startTime = time.time()
 
+        externalParticlesList = []
         for particleSet in self.particleSetList:
             otherParticleSets = copy.copy(self.particleSetList)
             otherParticleSets.remove(particleSet)
@@ -549,7 +815,13 @@ class ContactFilter(object):
                 if otherHistoricalMostLikely['particle'] is not None:
                     externalParticles.append(otherHistoricalMostLikely['particle'])
 
-            self.measurementUpdateSingleParticleSet(residual, particleSet, externalParticles=externalParticles)
+            externalParticlesList.append(externalParticles)
+
+        if self.useParallelMeasurementUpdate():
+            self.measurementUpdateParallel(residual, externalParticlesList)
+        else:
+            for particleSet, externalParticles in zip(self.particleSetList, externalParticlesList):
+                self.measurementUpdateSingleParticleSet(residual, particleSet, externalParticles=externalParticles)
 
 
         self.debugInfo['measurementUpdateTime'] = time.time() - startTime
@@ -559,6 +831,15 @@ class ContactFilter(object):
         else:
             self.debugInfo['avgQPSolveTime'] = None
 
+        # hit rate of the jacobian cache during this measurement update
+        jacobianCacheStats = self.drakeModel.jacobianCache.getStatistics()
+        numHits = jacobianCacheStats['numHits'] - jacobianCacheStatsStart['numHits']
+        numLookups = numHits + jacobianCacheStats['numMisses'] - jacobianCacheStatsStart['numMisses']
+        if numLookups > 0:
+            self.debugInfo['jacobianCacheHitRate'] = 1.0*numHits/numLookups
+        else:
+            self.debugInfo['jacobianCacheHitRate'] = None
+
         if publish:
             self.publishMostLikelyEstimate()
 
@@ -722,27 +1003,43 @@ class ContactFilter(object):
 
 
 
-    def applyMotionModelSingleParticleSet(self, particleSet, useNewMotionModel=True, particleList=None):
-
+    def applyMotionModelSingleParticleSet(self, particleSet, useNewMotionModel=None, particleList=None):
+        """
+        Moves every particle in particleList according to the motion model
+        :param useNewMotionModel: if True sample in world frame and snap back to the mesh
+        with the contact point locator, otherwise sample from the contact point table. If None
+        this is taken from the config
+        """
         if particleList is None:
             particleList = particleSet.particleList
 
-        for particle in particleList:
-            cfp = particle.cfp
-            if useNewMotionModel:
-                cfpNext = self.motionModelSingleCFP(cfp, visualize=False)
-            else:
-                motionData = self.motionModelData[cfp]
-                cfpNextIdx = motionData['randomVar'].rvs()
-                cfpNext = motionData['cfpList'][cfpNextIdx]
+        if useNewMotionModel is None:
+            useNewMotionModel = not self.options['motionModel']['useContactPointTable']
+
+        numParticles = len(particleList)
+        if numParticles == 0:
+            return
 
+        if useNewMotionModel:
+            # draw the perturbations for the whole particle set at once
+            variance = self.getMotionModelVariance()
+            deltas = np.random.normal(scale=np.sqrt(variance), size=(numParticles, 3))
+            locations = np.array([self.getCFPLocationInWorld(particle.cfp) for particle in particleList])
+            closestPointsData = self.contactPointLocator.findClosestPoints(locations + deltas)
+            cfpNextList = self.createContactFilterPointsFromClosestPointsData(closestPointsData)
+        else:
+            tableIdx = self.getMotionModelTableIdx([particle.cfp for particle in particleList])
+            tableIdxNext = self.motionModel.sample(tableIdx)
+            cfpNextList = [self.contactFilterPointListAll[idx] for idx in tableIdxNext]
+
+        for particle, cfpNext in zip(particleList, cfpNextList):
             particle.cfp = cfpNext
             particle.proposalData['weight'] = 1
 
     def sampleFromProposalDistributionSingleParticleSet(self, particleSet):
         # if no solution data found do standard thing
         if (particleSet.historicalMostLikely is None) or (particleSet.historicalMostLikely['particle'] is None):
-            self.applyMotionModelSingleParticleSet(particleSet, useNewMotionModel=True)
+            self.applyMotionModelSingleParticleSet(particleSet)
             return
 
 
@@ -756,7 +1053,7 @@ class ContactFilter(object):
         normalSampleParticleList = particleList[0:normalSampleMaxIdx]
         historicalSampleParticleList = particleList[normalSampleMaxIdx:]
 
-        self.applyMotionModelSingleParticleSet(particleSet, useNewMotionModel=True, particleList=normalSampleParticleList)
+        self.applyMotionModelSingleParticleSet(particleSet, particleList=normalSampleParticleList)
         self.sampleFromHistoricalMostLikelyProposalDistribution(particleSet, historicalSampleParticleList)
 
 
@@ -804,15 +1101,24 @@ class ContactFilter(object):
         variance = self.options['proposal']['historical']['variance']
         rv = scipy.stats.multivariate_normal(mean=historicalMostLikelyPositionInWorld,
                                              cov=variance*np.eye(3))
-        for particle in particleList:
-            newLocation = rv.rvs()
-            proposalLikelihood = rv.pdf(newLocation)*proposalFraction
-            closestPointData = self.contactPointLocator.findClosestPoint(newLocation)
-            newCFP = self.createContactFilterPointFromClosestPointData(closestPointData)
-            particle.setContactFilterPoint(newCFP)
+
+        # sample and evaluate the densities for all the particles at once
+        numParticles = len(particleList)
+        if numParticles > 0:
+            newLocations = np.random.multivariate_normal(historicalMostLikelyPositionInWorld,
+                                                         variance*np.eye(3), size=numParticles)
+            proposalLikelihoods = np.atleast_1d(rv.pdf(newLocations))*proposalFraction
+            motionModelLikelihoods = np.atleast_1d(motionModelRV.pdf(newLocations))
+
+            closestPointsData = self.contactPointLocator.findClosestPoints(newLocations)
+            newCFPList = self.createContactFilterPointsFromClosestPointsData(closestPointsData)
+
+        for idx, particle in enumerate(particleList):
+            proposalLikelihood = proposalLikelihoods[idx]
+            particle.setContactFilterPoint(newCFPList[idx])
 
             # compute the weight
-            motionModelLikelihood = motionModelRV.pdf(newLocation)
+            motionModelLikelihood = motionModelLikelihoods[idx]
 
             particle.proposalData['proposalLikelihood'] = proposalLikelihood
             particle.proposalData['motionModelLikelihood'] = motionModelLikelihood
@@ -832,26 +1138,28 @@ class ContactFilter(object):
 
     # applies the motion model to each particle set
     def applyMotionModel(self):
+        startTime = time.time()
         for particleSet in self.particleSetList:
 
             # change to sample from proposal distribution that includes the historical most likely thing
             # self.applyMotionModelSingleParticleSet(particleSet)
             self.sampleFromProposalDistributionSingleParticleSet(particleSet)
 
+        self.debugInfo['motionModelTime'] = time.time() - startTime
+
 
     def importanceResamplingSingleParticleSet(self, particleSet, numParticles=None):
         if numParticles is None:
             # numParticles = len(particleSet.particleList)
             numParticles = self.options['numParticles']
-        newParticleList = []
         numExistingParticles = len(particleSet.particleList)
-        xk = np.arange(0,numExistingParticles)
         pk = np.zeros(numExistingParticles)
         pkHack = np.zeros(numExistingParticles)
 
         for idx, particle in enumerate(particleSet.particleList):
-            pk[idx] = particle.solnData['likelihood']*particle.proposalData['weight']
-            pkHack[idx] = 1/particle.solnData['squaredError']*particle.proposalData['weight']
+            weight = particle.proposalData['weight']*particle.importanceWeight
+            pk[idx] = particle.solnData['likelihood']*weight
+            pkHack[idx] = 1/particle.solnData['squaredError']*weight
 
         # normalize the probabilities
         # having some numerical issues here, I think it is because we essentially dividing by zero or something
@@ -861,18 +1169,25 @@ class ContactFilter(object):
         tol = 1e-6
         if sumProb < tol:
             print "sum of probabilities really small, falling back to drawing randomly"
-            pk = 1.0/numExistingParticles * np.ones(numExistingParticles)
             pk = pkHack/np.sum(pkHack)
         else:
             pk = pk/np.sum(pk)
-        rv = scipy.stats.rv_discrete(values=(xk,pk)) # the random variable with importance weights
 
-        for i in xrange(0,numParticles):
-            # draw new particle
-            randomIdx = rv.rvs()
-            newParticle = particleSet.particleList[randomIdx].deepCopy(keepSolnData=True)
-            newParticleList.append(newParticle)
+        # if the weights are still well spread out we can skip resampling, the weights are
+        # then carried along on the particles and folded into the next resampling step
+        options = self.options['resampling']
+        ess = resampling.effectiveSampleSize(pk)
+        self.debugInfo['effectiveSampleSize'] = ess
+        if (options['adaptive'] and numExistingParticles == numParticles
+                and ess > options['essThresholdFraction']*numExistingParticles):
+            for idx, particle in enumerate(particleSet.particleList):
+                particle.importanceWeight = numExistingParticles*pk[idx]
+            self.debugInfo['numResamplingSkipped'] += 1
+            return
 
+        # duplicate draws all point to the same ContactFilterPoint, only the particle is new
+        randomIdx = resampling.resample(pk, numParticles, method=options['method'])
+        newParticleList = [particleSet.particleList[idx].deepCopy(keepSolnData=True) for idx in randomIdx]
         particleSet.particleList = newParticleList
 
 
@@ -904,7 +1219,7 @@ class ContactFilter(object):
             externalParticles = self.getExternalMostLikelyParticles(newParticleSet)
 
         if applyMotionModel:
-            self.applyMotionModelSingleParticleSet(newParticleSet, useNewMotionModel=True)
+            self.applyMotionModelSingleParticleSet(newParticleSet)
 
         self.measurementUpdateSingleParticleSet(self.residual, particleSet=newParticleSet,
                                                 externalParticles=externalParticles)
@@ -1176,13 +1491,19 @@ class ContactFilter(object):
         if residual is None:
             residual = self.residual
 
+        # wall clock time spent in each phase of the step, see cpf_benchmark.py
+        phaseTimes = dict()
+        startTime = time.time()
 
         # update the frames
         # doing this for performance, basically just caching frames
         self.linkFrameContainer.updateLinkFrames()
+        phaseTimes['updateLinkFrames'] = time.time() - startTime
 
+        startTime = time.time()
         if applyMotionModel:
             self.applyMotionModel()
+        phaseTimes['motionModel'] = time.time() - startTime
 
         # publish just after motion model step
         # DEBUGGING
@@ -1192,20 +1513,35 @@ class ContactFilter(object):
         # if len(self.particleSetList) == 0:
         #     self.manageParticleSets(verbose=True)
 
+        startTime = time.time()
         self.computeMeasurementUpdate(self.residual, publish=False)
+        phaseTimes['measurementUpdate'] = time.time() - startTime
+
+        startTime = time.time()
         self.applyImportanceResampling()
+        phaseTimes['importanceResampling'] = time.time() - startTime
+
+        startTime = time.time()
         self.updateAllParticleSetsMostLikelyParticle()
         self.updateMostLikelySolnData()
+        phaseTimes['updateMostLikely'] = time.time() - startTime
+
+        startTime = time.time()
         self.publishMostLikelyEstimate()
         if self.options['vis']['publishVisualizationData']:
             self.publishVisualizationData()
+        phaseTimes['publish'] = time.time() - startTime
 
         # this is where we add/remove particle sets . . .
+        startTime = time.time()
         self.manageParticleSets(verbose=True) # there are timeouts inside of this
+        phaseTimes['manageParticleSets'] = time.time() - startTime
 
         if drawParticleSets:
             self.testParticleSetDrawAll(drawMostLikely=True, drawHistoricalMostLikely=True)
 
+        self.debugInfo['stepPhaseTimes'] = phaseTimes
+
 
 
     def onExternalForceTorque(self, msg):
@@ -1433,7 +1769,7 @@ class ContactFilter(object):
         residual = np.zeros(self.drakeModel.numJoints)
         # since we aren't calling it via computeLikelihoodFull we need to manually call doKinematics
         q = self.getCurrentPose()
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
         solnData = self.computeSingleLikelihood(residual, cfpList)
 
         return solnData
@@ -1665,26 +2001,30 @@ class ContactFilter(object):
         self.testCFP = self.contactFilterPointDict['l_uarm'][0]
 
 
-    def motionModelSingleCFP(self, cfp, visualize=False, tangentSampling=False):
-
-        linkToWorld = self.linkFrameContainer.getLinkFrame(cfp.linkName)
-        contactLocationWorldFrame = linkToWorld.TransformPoint(cfp.contactLocation)
-        contactNormalWorldFrame = linkToWorld.TransformVector(cfp.contactNormal)
-
-
+    # variance of the motion model, interpolates between varMin and varMax based on the squared error
+    def getMotionModelVariance(self):
         variance = self.options['motionModel']['varMax']
         if self.mostLikelySolnData is not None:
             squaredError = self.mostLikelySolnData['squaredError']
             alpha = min(squaredError/self.options['motionModel']['varMaxSquaredErrorCutoff'], 1.0)
             variance = alpha*self.options['motionModel']['varMax'] + (1-alpha)*self.options['motionModel']['varMin']
 
+        return variance
+
+    def motionModelSingleCFP(self, cfp, visualize=False, tangentSampling=False):
+
+        linkToWorld = self.linkFrameContainer.getLinkFrame(cfp.linkName)
+        contactLocationWorldFrame = linkToWorld.TransformPoint(cfp.contactLocation)
+        contactNormalWorldFrame = linkToWorld.TransformVector(cfp.contactNormal)
+
+        variance = self.getMotionModelVariance()
         if tangentSampling:
             # the tangent vector should just be something orthogonal to it
             tangentVector = cfUtils.getPerpendicularVector(contactNormalWorldFrame)
             deltaToNewContactLocation = tangentVector*np.random.normal(scale=variance, size=1)
         else:
-            # deltaToNewContactLocation = np.random.normal(scale=variance, size=3)
-            deltaToNewContactLocation = scipy.stats.multivariate_normal(cov=variance*np.eye(3)).rvs()
+            # same distribution as multivariate_normal(cov=variance*np.eye(3))
+            deltaToNewContactLocation = np.random.normal(scale=np.sqrt(variance), size=3)
 
         closestPointLookupLocation = contactLocationWorldFrame + deltaToNewContactLocation
 
@@ -1731,6 +2071,23 @@ class ContactFilter(object):
 
         return newCFP
 
+    def createContactFilterPointsFromClosestPointsData(self, closestPointsData):
+        """
+        :param closestPointsData: output of ContactPointLocator.findClosestPoints
+        :return: list of ContactFilterPoints
+        """
+        cfpList = []
+        linkNames = self.contactPointLocator.linkNames
+        for idx, linkId in enumerate(closestPointsData['linkIds']):
+            linkName = linkNames[linkId]
+            cfp = self.createContactFilterPoint(linkName=linkName,
+                                                contactLocation=closestPointsData['closestPoints'][idx],
+                                                contactNormal=closestPointsData['normals'][idx],
+                                                bodyId=self.drakeModel.model.findLinkID(linkName))
+            cfpList.append(cfp)
+
+        return cfpList
+
     def createContactFilterParticleFromClosestPointData(self, closestPointData, containingParticleSet=None):
         if containingParticleSet is None:
             raise ValueError('must specify a containing particle set')
@@ -1816,6 +2173,9 @@ class ContactFilter(object):
 
     @staticmethod
     def encodeParticleSet(utime, particleSet):
+        if type(particleSet) is particlearrays.ParticleSetArrays:
+            return particleSet.encode(utime)
+
         assert type(particleSet) is SingleContactParticleSet
 
         msg = cpf_lcmtypes.CPF_particle_set_t()
@@ -1851,15 +2211,22 @@ class ContactFilter(object):
 
 
     @staticmethod
-    def decodeCPFData(msg):
+    def decodeCPFData(msg, useParticleArrays=False):
         particleSetList = []
         for particleSetMsg in msg.particle_sets:
-            particleSetList.append(ContactFilter.decodeParticleSet(particleSetMsg))
+            particleSetList.append(ContactFilter.decodeParticleSet(particleSetMsg, useParticleArrays=useParticleArrays))
 
         return particleSetList
 
     @staticmethod
-    def decodeParticleSet(msg):
+    def decodeParticleSet(msg, useParticleArrays=False):
+        """
+        :param useParticleArrays: if True decode straight into a particlearrays.ParticleSetArrays
+        instead of creating a ContactFilterParticle per particle
+        """
+        if useParticleArrays:
+            return particlearrays.ParticleSetArrays.decode(msg)
+
         particleSet = SingleContactParticleSet()
         particleSet.color = msg.color
         particleSet.mostLikelyParticle = ContactFilter.decodeParticle(msg.most_likely_particle)
@@ -1939,6 +2306,10 @@ class ContactFilterParticle(object):
         self.proposalData = dict()
         self.proposalData['weight'] = 1.0
 
+        # weight carried over from the previous step when resampling was skipped,
+        # always 1 right after resampling
+        self.importanceWeight = 1.0
+
     def setContactFilterPoint(self, cfp):
         assert type(cfp) is ContactFilterPoint, "cfp is not of type ContactFilterPoint"
         self.cfp = cfp
@@ -2081,9 +2452,7 @@ class SingleContactParticleSetWithRandomSampling(SingleContactParticleSet):
         :return:
         """
         numParticles = len(self.particleList)
-        xk = np.arange(numParticles)
-        pk = 1.0/numParticles*np.ones(numParticles)
-        self.samplingRandomVariable = scipy.stats.rv_discrete(values=(xk, pk))
+        self.samplingWeights = 1.0/numParticles*np.ones(numParticles)
 
     def drawRandomParticles(self, numRandomSamples):
         """
@@ -2091,7 +2460,7 @@ class SingleContactParticleSetWithRandomSampling(SingleContactParticleSet):
         :param numRandomSamples:
         :return: list of partilces
         """
-        randomIdx = self.samplingRandomVariable.rvs(size=numRandomSamples)
+        randomIdx = resampling.multinomialResampling(self.samplingWeights, numRandomSamples)
         randomParticleList = []
         for idx in randomIdx:
             randomParticleList.append(self.particleList[idx].deepCopy())
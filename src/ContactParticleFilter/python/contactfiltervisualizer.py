@@ -150,7 +150,7 @@ class ContactFilterVisualizer(object):
                                      drawMostLikely=drawMostLikely, drawHistoricalMostLikely=drawHistoricalMostLikely)
 
     def onContactFilterMsg(self, msg):
-        particleSetList = ContactFilter.decodeCPFData(msg)
+        particleSetList = ContactFilter.decodeCPFData(msg, useParticleArrays=True)
 
         self.drawParticleSetList(particleSetList)
 
@@ -61,20 +61,116 @@ class ContactPointLocator(object):
             self.locatorData[linkName] = {'locator':locator, 'polyData': polyData, 'meshToWorld': meshToWorld,
                                           'worldToMesh': worldToMesh, 'cellData': cellData, 'normals': normals}
 
-
-     # should return a dict with linkName, contactLocation, contactNormal, etc.
+        self.createBoundingSpheres()
+
+    def createBoundingSpheres(self):
+        """
+        Computes a link frame bounding sphere around the contact cells of each link. These
+        give a lower bound on the distance from a query point to a link, so that only the
+        links that could contain the closest point need to be queried.
+        """
+        self.linkNames = sorted(self.locatorData.keys())
+        numLinks = len(self.linkNames)
+        self.meshToWorldMatrices = np.zeros((numLinks, 4, 4))
+        self.worldToMeshMatrices = np.zeros((numLinks, 4, 4))
+        self.boundingSphereCenters = np.zeros((numLinks, 3))
+        self.boundingSphereRadii = np.zeros(numLinks)
+        self.normalsInMeshFrame = []
+
+        for linkId, linkName in enumerate(self.linkNames):
+            data = self.locatorData[linkName]
+            meshToWorld = transformUtils.getNumpyFromTransform(data['meshToWorld'])
+            worldToMesh = np.linalg.inv(meshToWorld)
+            self.meshToWorldMatrices[linkId] = meshToWorld
+            self.worldToMeshMatrices[linkId] = worldToMesh
+
+            # the cell points, expressed in link frame
+            points = numpy_support.vtk_to_numpy(data['polyData'].GetPoints().GetData())
+            points = np.dot(points, worldToMesh[:3,:3].T) + worldToMesh[:3,3]
+
+            center = 0.5*(np.min(points, axis=0) + np.max(points, axis=0))
+            self.boundingSphereCenters[linkId] = center
+            self.boundingSphereRadii[linkId] = np.max(np.linalg.norm(points - center, axis=1))
+
+            # same normal hack as in findClosestPointSingleLink
+            self.normalsInMeshFrame.append(-numpy_support.vtk_to_numpy(data['normals']))
+
+
+    # should return a dict with linkName, contactLocation, contactNormal, etc.
     def findClosestPoint(self, pointInWorldFrame):
-        closestPointData = None
+        data = self.findClosestPoints(pointInWorldFrame)
+        linkName = self.linkNames[data['linkIds'][0]]
+        closestPointData = {'linkName': linkName, 'closestPoint': tuple(data['closestPoints'][0]),
+                            'cellId': data['cellIds'][0], 'normal': tuple(data['normals'][0]),
+                            'dist2': data['dist2'][0]}
 
-        for linkName in self.locatorData:
-            worldToLink = self.linkFrameContainer.getLinkFrame(linkName).GetLinearInverse()
-            pointInLinkFrame = worldToLink.TransformPoint(pointInWorldFrame)
-            tempClosestPointData = self.findClosestPointSingleLink(linkName, pointInLinkFrame)
+        return closestPointData
 
-            if closestPointData is None or (tempClosestPointData['dist2'] < closestPointData['dist2']):
-                closestPointData = tempClosestPointData
+    def getWorldToLinkMatrices(self):
+        """
+        :return: (numLinks, 4, 4) array of the current world to link transforms
+        """
+        worldToLink = np.zeros((len(self.linkNames), 4, 4))
+        for linkId, linkName in enumerate(self.linkNames):
+            linkToWorld = transformUtils.getNumpyFromTransform(self.linkFrameContainer.getLinkFrame(linkName))
+            worldToLink[linkId] = np.linalg.inv(linkToWorld)
+        return worldToLink
+
+    def findClosestPoints(self, pointsInWorldFrame):
+        """
+        Snaps each point to the closest contact cell across all links. Links are queried in
+        order of their bounding sphere lower bound and we stop as soon as that lower bound
+        exceeds the best distance found so far, so usually only one or two links are queried.
+        The result is the same as querying every link.
+        :param pointsInWorldFrame: (N,3) array
+        :return: dict of arrays, 'linkIds' (N,) index into self.linkNames, 'closestPoints' (N,3)
+        and 'normals' (N,3) in link frame, 'cellIds' (N,), 'dist2' (N,)
+        """
+        points = np.atleast_2d(np.asarray(pointsInWorldFrame, dtype=float))
+        numPoints = len(points)
+
+        worldToLink = self.getWorldToLinkMatrices()
+        pointsInLinkFrame = np.einsum('lij,nj->lni', worldToLink[:,:3,:3], points) + worldToLink[:,np.newaxis,:3,3]
+        pointsInMeshFrame = (np.einsum('lij,lnj->lni', self.meshToWorldMatrices[:,:3,:3], pointsInLinkFrame)
+                             + self.meshToWorldMatrices[:,np.newaxis,:3,3])
+
+        distanceToCenter = np.linalg.norm(pointsInLinkFrame - self.boundingSphereCenters[:,np.newaxis,:], axis=2)
+        lowerBound = np.maximum(distanceToCenter - self.boundingSphereRadii[:,np.newaxis], 0.0)
+        lowerBoundSquared = lowerBound**2
+        linkOrder = np.argsort(lowerBound, axis=0)
+
+        linkIds = np.zeros(numPoints, dtype=int)
+        cellIds = np.zeros(numPoints, dtype=int)
+        dist2 = np.inf*np.ones(numPoints)
+        closestPointsInMeshFrame = np.zeros((numPoints, 3))
 
-        return closestPointData
+        cellId = vtk.mutable(0)
+        subId = vtk.mutable(0)
+        tempDist2 = vtk.mutable(0)
+        closestPoint = [0.0, 0.0, 0.0]
+
+        for n in xrange(numPoints):
+            for linkId in linkOrder[:,n]:
+                if lowerBoundSquared[linkId, n] > dist2[n]:
+                    break
+
+                locator = self.locatorData[self.linkNames[linkId]]['locator']
+                locator.FindClosestPoint(pointsInMeshFrame[linkId, n], closestPoint, cellId, subId, tempDist2)
+                if float(tempDist2) < dist2[n]:
+                    dist2[n] = float(tempDist2)
+                    linkIds[n] = linkId
+                    cellIds[n] = int(cellId)
+                    closestPointsInMeshFrame[n] = closestPoint
+
+        # convert back to link frame so that they are portable across different robot poses
+        worldToMesh = self.worldToMeshMatrices[linkIds]
+        closestPoints = np.einsum('nij,nj->ni', worldToMesh[:,:3,:3], closestPointsInMeshFrame) + worldToMesh[:,:3,3]
+        normalsInMeshFrame = np.array([self.normalsInMeshFrame[linkId][cellIdx]
+                                       for linkId, cellIdx in zip(linkIds, cellIds)]).reshape(numPoints, 3)
+        normals = np.einsum('nij,nj->ni', worldToMesh[:,:3,:3], normalsInMeshFrame)
+
+        return {'linkIds': linkIds, 'closestPoints': closestPoints, 'normals': normals, 'cellIds': cellIds,
+                'dist2': dist2}
 
     # point should be in world frame
     def findClosestPointSingleLink(self, linkName, pointInLinkFrame):
@@ -0,0 +1,279 @@
+__author__ = 'manuelli'
+
+"""
+Headless throughput benchmark for the contact particle filter. Runs
+ContactFilter.contactParticleFilterStep as fast as possible, either replaying an lcm log
+or on residuals synthesized with ExternalForce.computeSingleContactPointResidual, and
+writes a JSON summary (steps/sec, QP solves per step, time per phase, localization error).
+
+Usage
+-------
+Replay a log that contains EST_ROBOT_STATE, RESIDUAL_OBSERVER_STATE, EXTERNAL_FORCE_TORQUE
+and EXTERNAL_CONTACT_LOCATION:
+
+directorPython cpf_benchmark.py --director_config $SPARTAN_SOURCE_DIR/drake/drake/examples/kuka_iiwa_arm/director_config.json --log cpf.lcmlog --output cpf_benchmark.json
+
+Synthesize residuals from random contact points instead:
+
+directorPython cpf_benchmark.py --director_config $SPARTAN_SOURCE_DIR/drake/drake/examples/kuka_iiwa_arm/director_config.json --synthetic --numScenarios 10 --numSteps 50 --output cpf_benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+
+import lcm
+import bot_core as lcmbotcore
+import robotlocomotion as robotlocomotion_lcmtypes
+import cpf_lcmtypes
+
+from director import drcargs
+from director import mainwindowapp
+from director import robotsystem
+from director import robotstate
+
+import contactfilter
+import externalforce
+
+
+class CPFBenchmark(object):
+
+    def __init__(self, robotSystem, configFilename="contact_particle_filter_config.yaml"):
+        self.robotSystem = robotSystem
+        self.contactFilter = contactfilter.ContactFilter(robotSystem.robotStateModel,
+                                                         robotSystem.robotStateJointController,
+                                                         configFilename=configFilename)
+
+        # nothing to draw when running headless
+        self.contactFilter.options['vis']['draw'] = False
+        self.contactFilter.options['vis']['publishVisualizationData'] = False
+
+        self.contactFilter.linksWithExternalForce = []
+        self.contactFilter.onExternalContactLocation(self.createContactLocationMsg([]))
+        self.groundTruthMsg = None
+        self.stepData = []
+
+    @staticmethod
+    def createContactLocationMsg(contactMsgList, utime=0):
+        msg = cpf_lcmtypes.multiple_contact_location_t()
+        msg.utime = utime
+        msg.num_contacts = len(contactMsgList)
+        msg.contacts = contactMsgList
+        return msg
+
+    def runStep(self, residual):
+        """
+        Runs a single filter step and records the timing and localization error
+        """
+        startTime = time.time()
+        self.contactFilter.contactParticleFilterStep(residual, drawParticleSets=False, applyMotionModel=True)
+        elapsed = time.time() - startTime
+
+        debugInfo = self.contactFilter.debugInfo
+        d = dict()
+        d['time'] = self.contactFilter.currentTime
+        d['stepTime'] = elapsed
+        d['numQPSolves'] = int(debugInfo['numQPSolves'])
+        d['phaseTimes'] = dict(debugInfo['stepPhaseTimes'])
+        d['numParticleSets'] = len(self.contactFilter.particleSetList)
+        d['localizationError'] = self.computeLocalizationError()
+        self.stepData.append(d)
+
+    def getEstimatedContactLocationsInWorld(self):
+        solnData = self.contactFilter.mostLikelySolnData
+        if solnData is None:
+            return []
+
+        return [np.array(self.contactFilter.getCFPLocationInWorld(cfpData['ContactFilterPoint']))
+                for cfpData in solnData['cfpData']]
+
+    def computeLocalizationError(self):
+        """
+        For each ground truth contact the distance to the closest estimated contact, in world frame.
+        :return: list of errors, None if there is no ground truth or no estimate
+        """
+        if self.groundTruthMsg is None or self.groundTruthMsg.num_contacts == 0:
+            return None
+
+        estimatedLocations = self.getEstimatedContactLocationsInWorld()
+        if len(estimatedLocations) == 0:
+            return None
+
+        errors = []
+        for contactMsg in self.groundTruthMsg.contacts:
+            trueLocation = np.array(contactMsg.contact_position_in_world)
+            errors.append(min(np.linalg.norm(trueLocation - location) for location in estimatedLocations))
+
+        return errors
+
+    def replayLog(self, filename, maxNumSteps=None):
+        """
+        Replays the log in order, every residual message triggers one filter step
+        """
+        if self.contactFilter.options['debug']['useTrueResidual']:
+            residualChannel = 'RESIDUAL_ACTUAL'
+        else:
+            residualChannel = 'RESIDUAL_OBSERVER_STATE'
+
+        jointController = self.robotSystem.robotStateJointController
+        log = lcm.EventLog(filename, 'r')
+
+        for event in log:
+            if event.channel == 'EST_ROBOT_STATE':
+                msg = lcmbotcore.robot_state_t.decode(event.data)
+                jointController.setPose('EST_ROBOT_STATE', robotstate.convertStateMessageToDrakePose(msg))
+            elif event.channel == 'EXTERNAL_FORCE_TORQUE':
+                self.contactFilter.onExternalForceTorque(cpf_lcmtypes.external_force_torque_t.decode(event.data))
+            elif event.channel == 'EXTERNAL_CONTACT_LOCATION':
+                self.groundTruthMsg = cpf_lcmtypes.multiple_contact_location_t.decode(event.data)
+                self.contactFilter.onExternalContactLocation(self.groundTruthMsg)
+            elif event.channel == residualChannel:
+                msg = robotlocomotion_lcmtypes.residual_observer_state_t.decode(event.data)
+
+                # the filter isn't running, this just records the residual and the time
+                self.contactFilter.onResidualObserverState(msg)
+                self.runStep(self.contactFilter.residual)
+
+                if maxNumSteps is not None and len(self.stepData) >= maxNumSteps:
+                    break
+
+        log.close()
+
+    def runSynthetic(self, numScenarios=10, numSteps=50, numContacts=1, dt=0.01, seed=0):
+        """
+        Each scenario picks numContacts random contact points from the initial particle
+        locations, computes the true residual with ExternalForce and runs numSteps filter
+        steps on it, starting from an empty filter.
+        """
+        np.random.seed(seed)
+        externalForce = externalforce.ExternalForce(self.robotSystem)
+        externalForce.stopPublishing()
+
+        q = self.contactFilter.getCurrentPose()
+        externalForce.drakeModel.setJointPositions(q)
+        forceMagnitude = self.contactFilter.options['externalForce']['initialForceMagnitude']
+        cfpListAll = self.contactFilter.contactFilterPointListAll
+
+        utime = 0
+        for scenario in xrange(numScenarios):
+            self.contactFilter.resetParticleFilter()
+            externalForce.removeAllForces()
+
+            residual = np.zeros(self.contactFilter.drakeModel.numJoints)
+            contactMsgList = []
+            cfpIdx = np.random.choice(len(cfpListAll), size=numContacts, replace=False)
+            for idx in cfpIdx:
+                cfp = cfpListAll[idx]
+                externalForce.addForce(cfp.linkName, forceDirection=cfp.contactNormal, forceMagnitude=forceMagnitude,
+                                       forceLocation=cfp.contactLocation)
+                wrench = externalForce.externalForces[cfp.linkName]['wrench']
+                residual += externalForce.computeSingleContactPointResidual(cfp.linkName, wrench)
+
+                contactMsg = cpf_lcmtypes.single_contact_filter_estimate_t()
+                contactMsg.body_name = cfp.linkName
+                contactMsg.contact_position = cfp.contactLocation
+                contactMsg.contact_position_in_world = self.contactFilter.getCFPLocationInWorld(cfp)
+                contactMsgList.append(contactMsg)
+
+            self.groundTruthMsg = self.createContactLocationMsg(contactMsgList, utime=utime)
+            self.contactFilter.onExternalContactLocation(self.groundTruthMsg)
+            self.contactFilter.linksWithExternalForce = [cfpListAll[idx].linkName for idx in cfpIdx]
+            self.contactFilter.residual = residual
+
+            for step in xrange(numSteps):
+                utime += int(dt*1e6)
+                self.contactFilter.setCurrentUtime(utime)
+                self.runStep(residual)
+
+            # leave a gap so that the add/remove timeouts don't carry over between scenarios
+            utime += int(10*1e6)
+
+    def getSummary(self):
+        numSteps = len(self.stepData)
+        if numSteps == 0:
+            return {'numSteps': 0}
+
+        stepTimes = np.array([d['stepTime'] for d in self.stepData])
+        numQPSolves = np.array([d['numQPSolves'] for d in self.stepData])
+
+        phaseTimes = dict()
+        for phase in self.stepData[0]['phaseTimes']:
+            times = np.array([d['phaseTimes'][phase] for d in self.stepData])
+            phaseTimes[phase] = {'total': float(np.sum(times)), 'mean': float(np.mean(times)),
+                                 'fraction': float(np.sum(times)/np.sum(stepTimes))}
+
+        errors = [error for d in self.stepData if d['localizationError'] is not None
+                  for error in d['localizationError']]
+
+        summary = dict()
+        summary['numSteps'] = numSteps
+        summary['totalTime'] = float(np.sum(stepTimes))
+        summary['stepsPerSecond'] = float(numSteps/np.sum(stepTimes))
+        summary['stepTime'] = {'mean': float(np.mean(stepTimes)), 'median': float(np.median(stepTimes)),
+                               'max': float(np.max(stepTimes))}
+        summary['qpSolvesPerStep'] = {'mean': float(np.mean(numQPSolves)), 'max': int(np.max(numQPSolves))}
+        summary['phaseTimes'] = phaseTimes
+
+        if len(errors) > 0:
+            summary['localizationError'] = {'mean': float(np.mean(errors)), 'median': float(np.median(errors)),
+                                            'max': float(np.max(errors)), 'numSamples': len(errors)}
+        else:
+            summary['localizationError'] = None
+
+        # the options that matter most for performance
+        options = self.contactFilter.options
+        summary['options'] = {'numParticles': options['numParticles'],
+                              'solverType': options['solver']['solverType'],
+                              'updateType': options['measurementModel']['updateType'],
+                              'parallel': options['parallel']['enabled']}
+        return summary
+
+    def writeJSON(self, filename, includeSteps=False):
+        data = self.getSummary()
+        if includeSteps:
+            data['steps'] = self.stepData
+
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = drcargs.getGlobalArgParser().getParser()
+    parser.add_argument('--log', type=str, default=None, help='lcm log to replay')
+    parser.add_argument('--synthetic', action='store_true', help='synthesize residuals instead of replaying a log')
+    parser.add_argument('--numScenarios', type=int, default=10)
+    parser.add_argument('--numSteps', type=int, default=None,
+                        help='steps per scenario (default 50), or max number of steps to replay from the log')
+    parser.add_argument('--numContacts', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', type=str, default='contact_particle_filter_config.yaml')
+    parser.add_argument('--output', type=str, default='cpf_benchmark.json')
+    parser.add_argument('--includeSteps', action='store_true', help='also write the per step data')
+    args = drcargs.args()
+
+    if (args.log is None) == (not args.synthetic):
+        raise ValueError("must specify exactly one of --log or --synthetic")
+
+    # the window is never shown, we just need the robot model
+    app = mainwindowapp.construct()
+    robotSystem = robotsystem.create(app.view, planningOnly=True)
+
+    benchmark = CPFBenchmark(robotSystem, configFilename=args.config)
+    try:
+        if args.synthetic:
+            numSteps = 50 if args.numSteps is None else args.numSteps
+            benchmark.runSynthetic(numScenarios=args.numScenarios, numSteps=numSteps,
+                                   numContacts=args.numContacts, seed=args.seed)
+        else:
+            benchmark.replayLog(args.log, maxNumSteps=args.numSteps)
+    finally:
+        benchmark.contactFilter.shutdown()
+
+    benchmark.writeJSON(args.output, includeSteps=args.includeSteps)
+    print json.dumps(benchmark.getSummary(), indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -215,7 +215,7 @@ class ExternalForce(object):
     # WARNING: make sure you call doKinematics before you get here
     def computeSingleContactPointResidual(self, linkName, wrench):
         linkId = self.drakeModel.model.findLinkID(linkName)
-        geometricJacobian = self.drakeModel.geometricJacobian(0,linkId,linkId,0,False)
+        geometricJacobian = self.drakeModel.getLinkJacobian(linkId)
         singleContactResidual = np.dot(geometricJacobian.transpose(), wrench)
         return singleContactResidual
 
@@ -287,10 +287,7 @@ class ExternalForce(object):
         # make sure we call doKinematics before we do all the geometricJacobian stuff
         if self.options['debug']['publishTrueResidual']:
             q = self.getCurrentPose()
-            self.drakeModel.model.setJointPositions(q)
-
-            # alternatively can just do setJointPositions
-            # self.drakeModel.model.setJointPositions(q)
+            self.drakeModel.setJointPositions(q)
 
 
         for key, val in self.externalForces.iteritems():
@@ -0,0 +1,83 @@
+import numpy as np
+import scipy.spatial
+
+
+class SparseMotionModel(object):
+    """
+    Discrete motion model over a fixed set of contact points. The probability of moving
+    from point i to point j is proportional to exp(-d_ij^2/(2*var)), truncated to zero
+    beyond cutoffNumStdDevs standard deviations. The neighbor lists are found with a
+    KD-tree and stored in CSR format together with cumulative weights, so memory is
+    O(number of neighbors) rather than O(N^2) and a whole particle set can be sampled
+    with a single vectorized draw.
+    """
+
+    def __init__(self, positions, variance, cutoffNumStdDevs=3.0, groupIds=None):
+        """
+        :param positions: (N,3) location of each contact point
+        :param variance: variance of the gaussian motion model
+        :param cutoffNumStdDevs: neighbors further away than this get zero probability
+        :param groupIds: optional (N,) array, if specified points can only move to other
+        points with the same group id, e.g. points on the same link
+        """
+        self.positions = np.array(positions, dtype=float)
+        self.variance = variance
+        self.cutoffRadius = cutoffNumStdDevs*np.sqrt(variance)
+        self.kdTree = scipy.spatial.cKDTree(self.positions)
+        self.buildTransitionTable(groupIds)
+
+    def buildTransitionTable(self, groupIds=None):
+        numPoints = len(self.positions)
+        neighborLists = self.kdTree.query_ball_point(self.positions, self.cutoffRadius)
+
+        indptr = np.zeros(numPoints + 1, dtype=int)
+        indicesList = []
+        cumulativeWeightsList = []
+
+        for i, neighbors in enumerate(neighborLists):
+            neighbors = np.sort(np.array(neighbors, dtype=int))
+            if groupIds is not None:
+                neighbors = neighbors[groupIds[neighbors] == groupIds[i]]
+
+            distanceSquared = np.sum((self.positions[neighbors] - self.positions[i])**2, axis=1)
+            weights = np.exp(-1.0/(2*self.variance)*distanceSquared)
+            cumulativeWeights = np.cumsum(weights)/np.sum(weights)
+
+            # make sure the last entry is exactly 1 so that row i lives in (i, i+1]
+            cumulativeWeights[-1] = 1.0
+
+            indicesList.append(neighbors)
+            cumulativeWeightsList.append(i + cumulativeWeights)
+            indptr[i+1] = indptr[i] + len(neighbors)
+
+        self.indptr = indptr
+        self.indices = np.concatenate(indicesList)
+
+        # cumulative weights of row i are offset by i so the whole table is sorted
+        # and a single searchsorted samples all the rows at once
+        self.cumulativeWeights = np.concatenate(cumulativeWeightsList)
+
+    def getNumNeighbors(self):
+        return np.diff(self.indptr)
+
+    def sample(self, idx):
+        """
+        Draws the next contact point for each index in idx
+        :param idx: (n,) array of current contact point indices
+        :return: (n,) array of new contact point indices
+        """
+        idx = np.asarray(idx, dtype=int)
+        u = np.random.uniform(size=idx.shape)
+        tablePosition = np.searchsorted(self.cumulativeWeights, idx + u, side='right')
+
+        # guards against u being numerically indistinguishable from 1
+        tablePosition = np.minimum(tablePosition, self.indptr[idx+1] - 1)
+        return self.indices[tablePosition]
+
+    def findNearest(self, points):
+        """
+        :param points: (n,3) array of locations
+        :return: (n,) array of indices of the nearest contact point in the table
+        """
+        _, idx = self.kdTree.query(np.atleast_2d(points))
+        return idx
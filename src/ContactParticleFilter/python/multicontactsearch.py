@@ -0,0 +1,182 @@
+import numpy as np
+import heapq
+
+NUM_FRICTION_CONE_BASIS_VECTORS = 4
+
+
+class MultiContactSearch(object):
+    """
+    Finds the contact point combinations (one contact point per active link) with the
+    smallest squared error, solving the QP for only part of the combinations. It never
+    solves more QP's than exhaustive enumeration, the only QP's solved are those of
+    combinations that can't be ruled out.
+
+    The QP for a combination is min_{alpha >= 0} ||r - H alpha||_W^2, the squared W-distance
+    from the residual r to the cone spanned by the combination's columns. The lower bounds
+    come from the dual of that problem: if a direction w has <h, w>_W <= 0 for every
+    column h of a combination, then every point x of its cone has <x, w>_W <= 0 and
+
+        ||r - x||_W >= <r - x, w>_W/||w||_W >= <r, w>_W/||w||_W
+
+    so (<r, w>_W/||w||_W)^2 is a lower bound for that combination. Checking a direction
+    against a combination is a few inner products per candidate, no QP. The directions
+    used are r itself (bound ||r||^2, for combinations that can't reduce the error at all)
+    and the optimal residuals r - H alpha of the combinations solved so far. For an optimal
+    residual the bound equals that combination's squared error, so solving a bad
+    combination rules out all the combinations that can't do better in its direction.
+
+    Combinations are solved in batches, lowest bound first, ties broken by how well the
+    candidates line up with the residual. Combinations whose bound is above the k-th best
+    squared error found so far are pruned, so the top k combinations are the same as with
+    exhaustive enumeration. How much gets pruned depends on the problem, see
+    debugInfo['multiContactSearchNumQPs'] in contactfilter.py.
+
+    The QP's are not warm started. Seeding the NNLS solver with the alpha values of the
+    solved combination that shares the most contact points took 2-8% more active set
+    iterations than a cold start on problems like the ones in test_multicontactsearch.py, the
+    parent's passive set mostly has to be unwound again.
+    """
+
+    def __init__(self, qpSolver, solverType, topK=1, batchSize=32, tol=1e-9):
+        """
+        :param qpSolver: qpsolver.QPSolver, the QP's are solved with the same solver as
+        the rest of the measurement update so that the ranking matches
+        :param solverType: one of the solver types supported by qpSolver
+        :param topK: number of combinations to return
+        :param batchSize: number of combinations solved in one batched QP
+        :param tol: relative tolerance used when comparing lower bounds to the k-th best
+        and when checking <h, w>_W <= 0, keeps us from pruning on round off
+        """
+        self.qpSolver = qpSolver
+        self.solverType = solverType
+        self.topK = topK
+        self.batchSize = batchSize
+        self.tol = tol
+
+    def solve(self, residual, weightMatrix, H):
+        """
+        :param H: (numProblems, nv, numVars)
+        :return: squaredError (numProblems,), alpha (numProblems, numVars)
+        """
+        numProblems, nv, numVars = np.shape(H)
+        numContacts = numVars//NUM_FRICTION_CONE_BASIS_VECTORS
+        solnData = self.qpSolver.solveBatch(numContacts, residual, H, weightMatrix, solverType=self.solverType)
+        self.numQPs += numProblems
+        return np.maximum(solnData['objectiveValue'], 0.0), solnData['alphaVals'].reshape(numProblems, numVars)
+
+    def computeDirectionBounds(self, residual, weightMatrix, directions):
+        """
+        :param directions: (P, nv)
+        :return: (<r, w>_W/||w||_W)^2 for each direction w, 0 where <r, w>_W <= 0
+        """
+        Wd = np.dot(directions, weightMatrix)
+        inner = np.dot(Wd, residual)
+        normSquared = np.einsum('pv,pv->p', Wd, directions)
+        bounds = np.zeros(len(directions))
+        useful = (inner > 0) & (normSquared > 0)
+        bounds[useful] = inner[useful]**2/normSquared[useful]
+        return bounds
+
+    def computePolarMasks(self, linkHW, linkColumnNorms, weightMatrix, directions):
+        """
+        :return: list with one (n_l, P) boolean array per link, True if all the columns of
+        the candidate have <h, w>_W <= 0
+        """
+        directionNorms = np.sqrt(np.maximum(np.einsum('pv,vw,pw->p', directions, weightMatrix, directions), 0.0))
+        masks = []
+        for HW, columnNorms in zip(linkHW, linkColumnNorms):
+            inner = np.einsum('njv,pv->njp', HW, directions)
+            scale = self.tol*columnNorms[:,:,np.newaxis]*directionNorms[np.newaxis,np.newaxis,:]
+            masks.append(np.all(inner <= scale, axis=1))
+        return masks
+
+    def search(self, residual, weightMatrix, linkH):
+        """
+        :param residual: (nv,)
+        :param weightMatrix: (nv, nv)
+        :param linkH: list with one (n_l, nv, 4) array per active link, the jacobian to
+        friction cone of each candidate contact point on that link
+        :return: dict with 'combinations', a list of index tuples (one index per link) sorted
+        by squared error, 'squaredError' for each of them, 'numQPs' and 'numCombinations'
+        """
+        self.numQPs = 0
+        numLinks = len(linkH)
+        shape = tuple(len(H) for H in linkH)
+        numCombinations = int(np.prod(shape))
+
+        # H^T W for every candidate, (n_l, 4, nv), and the W-norms of the columns
+        linkHW = [np.einsum('nvj,vw->njw', H, weightMatrix) for H in linkH]
+        linkColumnNorms = [np.sqrt(np.maximum(np.einsum('njv,nvj->nj', HW, H), 0.0)) for HW, H in zip(linkHW, linkH)]
+
+        # tie breaking, how well the best column of each candidate lines up with the residual
+        score = np.zeros(shape)
+        for l in xrange(numLinks):
+            alignment = np.max(np.dot(linkHW[l], residual)/np.maximum(linkColumnNorms[l], 1e-12), axis=1)
+            score += np.reshape(alignment, [-1 if i == l else 1 for i in xrange(numLinks)])
+        score = score.reshape(-1)
+
+        # leaves found so far, a max heap on squared error holding the top k
+        topK = []
+
+        def threshold():
+            if len(topK) < self.topK:
+                return np.inf
+            kthBest = -topK[0][0]
+            return kthBest + self.tol*max(kthBest, 1.0)
+
+        unresolved = np.arange(numCombinations)
+        lowerBound = np.zeros(numCombinations)
+        directions = residual[np.newaxis]
+
+        while len(unresolved) > 0:
+            # tighten the bounds with the new directions, only directions whose bound is
+            # above the threshold can prune anything
+            directionBounds = self.computeDirectionBounds(residual, weightMatrix, directions)
+            useful = directionBounds > threshold()
+            if np.any(useful):
+                directions = directions[useful]
+                directionBounds = directionBounds[useful]
+                masks = self.computePolarMasks(linkHW, linkColumnNorms, weightMatrix, directions)
+                idx = np.unravel_index(unresolved, shape)
+                valid = np.ones((len(unresolved), len(directions)), dtype=bool)
+                for l in xrange(numLinks):
+                    valid &= masks[l][idx[l]]
+                bound = np.max(np.where(valid, directionBounds[np.newaxis], 0.0), axis=1)
+                lowerBound = np.maximum(lowerBound, bound)
+
+            keep = lowerBound <= threshold()
+            unresolved = unresolved[keep]
+            lowerBound = lowerBound[keep]
+            if len(unresolved) == 0:
+                break
+
+            order = np.lexsort((-score[unresolved], lowerBound))
+            batch = order[:self.batchSize]
+            batchCombinations = unresolved[batch]
+
+            idx = np.unravel_index(batchCombinations, shape)
+            H = np.concatenate([linkH[l][idx[l]] for l in xrange(numLinks)], axis=2)
+            squaredError, alpha = self.solve(residual, weightMatrix, H)
+
+            for i, flatIdx in enumerate(batchCombinations):
+                combination = tuple(int(idx[l][i]) for l in xrange(numLinks))
+                if len(topK) < self.topK:
+                    heapq.heappush(topK, (-squaredError[i], combination))
+                elif squaredError[i] < -topK[0][0]:
+                    heapq.heapreplace(topK, (-squaredError[i], combination))
+
+            # the optimal residuals of the solved combinations are the next directions
+            directions = residual[np.newaxis] - np.einsum('bvj,bj->bv', H, alpha)
+
+            solved = np.ones(len(unresolved), dtype=bool)
+            solved[batch] = False
+            unresolved = unresolved[solved]
+            lowerBound = lowerBound[solved]
+
+        results = sorted([(-negSquaredError, combination) for negSquaredError, combination in topK])
+        d = dict()
+        d['combinations'] = [combination for _, combination in results]
+        d['squaredError'] = np.array([squaredError for squaredError, _ in results])
+        d['numQPs'] = self.numQPs
+        d['numCombinations'] = numCombinations
+        return d
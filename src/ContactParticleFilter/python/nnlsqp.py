@@ -0,0 +1,195 @@
+import numpy as np
+NUM_FRICTION_CONE_BASIS_VECTORS = 4
+
+
+class NNLSQP:
+    """
+    Solves the CPF QP
+
+        min_{alpha >= 0} (residual - H alpha)^T W (residual - H alpha)
+
+    which is a nonnegative least squares problem. Uses the Lawson-Hanson active set
+    method on the normal equations, vectorized across many problems with the same
+    number of contacts. Doesn't need any external solver or license.
+    """
+
+    def __init__(self, numContactsList=[1], maxIterFactor=5, tol=1e-10):
+        """
+        :param numContactsList: not needed, any number of contacts is supported.
+        Kept so that the constructor matches the other solvers
+        :param maxIterFactor: max number of active set iterations is maxIterFactor*numVars
+        :param tol: relative tolerance on the gradient, a variable is only added to the passive
+        set if that decreases the squared error by more than about tol^2 times the squared
+        residual
+        """
+        self.numContactsList = numContactsList
+        self.maxIterFactor = maxIterFactor
+        self.tol = tol
+
+    def solve(self, numContacts, residual, H_list, W):
+        H = np.concatenate(H_list, axis=1)
+        batchSolnData = self.solveBatch(numContacts, residual, H[np.newaxis,:,:], W)
+
+        d = {}
+        d['alphaVals'] = {}
+        for i in xrange(0,numContacts):
+            for j in xrange(0,NUM_FRICTION_CONE_BASIS_VECTORS):
+                d['alphaVals'][i,j] = batchSolnData['alphaVals'][0,i,j]
+
+        d['objectiveValue'] = batchSolnData['objectiveValue'][0]
+        d['numIterations'] = batchSolnData['numIterations']
+        return d
+
+    def solveBatch(self, numContacts, residual, H, W, initialAlpha=None):
+        """
+        :param H: (numProblems, nv, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS)
+        :param initialAlpha: optional warm start, anything with numProblems*numVars
+        nonnegative entries
+        :return: dict with 'alphaVals' (numProblems, numContacts, NUM_FRICTION_CONE_BASIS_VECTORS)
+        and 'objectiveValue' (numProblems,). The objective includes the constant term, i.e.
+        it is the squared error of the residual, same as gurobi
+        """
+        numProblems, nv, numVars = np.shape(H)
+
+        # normal equations, Q = H^T W H, c = H^T W residual
+        WH = np.einsum('vw,nwj->nvj', W, H)
+        Q = np.einsum('nvi,nvj->nij', H, WH)
+        c = np.einsum('v,nvj->nj', residual, WH)
+
+        alpha, numIterations = self.solveNormalEquations(Q, c, initialAlpha=initialAlpha)
+
+        # from the error itself rather than the normal equations, which would cancel
+        # when the error is small compared to the residual
+        error = residual[np.newaxis,:] - np.einsum('nvj,nj->nv', H, alpha)
+        objectiveValue = np.einsum('nv,vw,nw->n', error, W, error)
+
+        d = dict()
+        d['alphaVals'] = alpha.reshape(numProblems, numContacts, NUM_FRICTION_CONE_BASIS_VECTORS)
+        d['objectiveValue'] = objectiveValue
+        d['numIterations'] = numIterations
+        return d
+
+    def solveNormalEquations(self, Q, c, initialAlpha=None):
+        """
+        Lawson-Hanson active set method for min_{x >= 0} x^T Q x - 2 c^T x.
+        Each problem in the batch runs its own active set iteration, they are just
+        stepped forward together so that the linear solves can be batched.
+        :param Q: (numProblems, n, n)
+        :param c: (numProblems, n)
+        :return: x (numProblems, n), number of iterations
+        """
+        numProblems, n = np.shape(c)
+        rows = np.arange(numProblems)
+
+        # the gradient of a variable is <h, r - H x>_W, compare it to the norm of its column
+        # times |<h, r>_W|/||h||_W maximized over the columns, which is at most ||r||_W.
+        # This doesn't depend on the scale of H or r, and stops once adding any variable
+        # decreases the error by less than tol^2 ||r||_W^2
+        columnNorms = np.sqrt(np.maximum(np.diagonal(Q, axis1=1, axis2=2), 0.0))
+        projectionNorms = np.where(columnNorms > 0, np.abs(c)/np.where(columnNorms > 0, columnNorms, 1.0), 0.0)
+        tol = self.tol*columnNorms*np.max(projectionNorms, axis=1)[:,np.newaxis]
+
+        if initialAlpha is None:
+            x = np.zeros((numProblems, n))
+            passive = np.zeros((numProblems, n), dtype=bool)
+        else:
+            x = np.maximum(np.reshape(initialAlpha, (numProblems, n)), 0.0)
+            passive = x > 0
+
+        done = np.zeros(numProblems, dtype=bool)
+
+        # variables that came out <= 0 right after they were added, see below
+        rejected = np.zeros((numProblems, n), dtype=bool)
+
+        # with a warm start we first need to solve on the given passive set
+        needsInnerStep = np.any(passive, axis=1)
+
+        numIterations = 0
+        for numIterations in xrange(1, self.maxIterFactor*n + 1):
+
+            # outer loop: add the variable with the largest (positive) gradient to the passive set
+            added = -np.ones(numProblems, dtype=int)
+            outer = ~done & ~needsInnerStep
+            if np.any(outer):
+                w = c - np.einsum('nij,nj->ni', Q, x)
+                w = np.where(passive | rejected | ~(w > tol), -np.inf, w/np.maximum(columnNorms, 1e-300))
+                jMax = np.argmax(w, axis=1)
+                wMax = w[rows, jMax]
+
+                converged = outer & ~(wMax > 0)
+                done = done | converged
+                addVar = outer & ~converged
+                passive[rows[addVar], jMax[addVar]] = True
+                added = np.where(addVar, jMax, -1)
+
+            active = ~done
+            if not np.any(active):
+                break
+
+            # unconstrained solve restricted to the passive set
+            s = self.solvePassiveSet(Q[active], c[active], passive[active])
+            xActive = x[active]
+            passiveActive = passive[active]
+
+            # in exact arithmetic the variable that was just added comes out positive. If it
+            # doesn't, the passive set is numerically rank deficient and its gradient was round
+            # off. Take it back out and try the next best variable instead, like Lawson and
+            # Hanson do, rather than stepping back and forth between the same passive sets
+            activeRows = np.nonzero(active)[0]
+            addedActive = added[active]
+            wasAdded = addedActive >= 0
+            wrongWay = wasAdded & (s[np.arange(len(s)), np.maximum(addedActive, 0)] <= 0)
+            if np.any(wrongWay):
+                passiveActive[wrongWay, addedActive[wrongWay]] = False
+                rejected[activeRows[wrongWay], addedActive[wrongWay]] = True
+                s[wrongWay] = xActive[wrongWay]
+
+            # x is about to change, the rejected variables get another chance
+            rejected[activeRows[wasAdded & ~wrongWay]] = False
+
+            feasible = np.all(~passiveActive | (s > 0), axis=1)
+
+            # inner loop: step towards s until we hit the boundary, then drop those variables
+            ratio = np.where(passiveActive & (s <= 0), xActive/np.maximum(xActive - s, 1e-300), np.inf)
+            stepSize = np.minimum(np.min(ratio, axis=1), 1.0)
+            stepSize[feasible] = 1.0
+            xActive = xActive + stepSize[:,np.newaxis]*(s - xActive)
+
+            # the variables that blocked the step leave the passive set
+            infeasible = ~feasible
+            blocking = (ratio <= stepSize[:,np.newaxis]) | (xActive <= 0)
+            passiveActive[infeasible] = passiveActive[infeasible] & ~blocking[infeasible]
+            xActive[~passiveActive] = 0.0
+
+            x[active] = xActive
+            passive[active] = passiveActive
+            needsInnerStep[active] = infeasible
+
+        return x, numIterations
+
+    @staticmethod
+    def solvePassiveSet(Q, c, passive):
+        """
+        Solves Q_PP s_P = c_P with s = 0 outside of the passive set P, for each problem
+        in the batch. Variables outside of P get an identity row so that everything
+        can be done in one batched np.linalg.solve.
+        """
+        numProblems, n = np.shape(c)
+        mask = passive[:,:,np.newaxis] & passive[:,np.newaxis,:]
+        Qp = np.where(mask, Q, 0.0)
+
+        # small regularization relative to each variable's own diagonal entry since the
+        # friction cone basis vectors are linearly dependent
+        diagonal = np.diagonal(Q, axis1=1, axis2=2)
+        reg = np.where(passive & (diagonal > 0), 1e-12*diagonal, 1.0)
+        diagonalIdx = np.arange(n)
+        QpReg = Qp.copy()
+        QpReg[:, diagonalIdx, diagonalIdx] += reg
+
+        # one step of iterative refinement against the unregularized system removes the
+        # bias of the regularization when the passive set is (nearly) rank deficient
+        cp = np.where(passive, c, 0.0)
+        s = np.linalg.solve(QpReg, cp[:,:,np.newaxis])[:,:,0]
+        correction = cp - np.einsum('nij,nj->ni', Qp, s)
+        s += np.linalg.solve(QpReg, correction[:,:,np.newaxis])[:,:,0]
+        return s
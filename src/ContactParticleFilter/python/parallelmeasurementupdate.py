@@ -0,0 +1,115 @@
+import numpy as np
+import multiprocessing
+
+import qpsolver
+import batchmeasurementupdate
+
+
+# state owned by each worker process, created once in initializeWorker
+workerState = None
+
+
+def initializeWorker(options, numContactsList):
+    """
+    Runs once in each worker process. Every worker gets its own drake model and QP
+    solver, nothing is shared with the main process.
+    """
+    global workerState
+    from pythondrakemodel import PythonDrakeModel
+
+    drakeModel = PythonDrakeModel(options['robot']['floatingBaseType'], options['robot']['urdf'])
+    numJoints = drakeModel.numJoints
+    weightMatrix = np.eye(numJoints)
+    covarianceMatrixInverse = np.linalg.inv(options['measurementModel']['var']*np.eye(numJoints))
+
+    qpSolver = qpsolver.QPSolver(numContactsList, options)
+    batchMeasurementUpdate = batchmeasurementupdate.BatchMeasurementUpdate(qpSolver, weightMatrix,
+                                                                          covarianceMatrixInverse,
+                                                                          options['solver']['solverType'])
+    workerState = {'drakeModel': drakeModel, 'batchMeasurementUpdate': batchMeasurementUpdate}
+
+
+def computeLikelihoodsWorker(args):
+    """
+    Batch measurement update for one chunk of problems, runs in a worker process.
+    Only numpy arrays are passed back and forth, the ContactFilterPoints stay in the
+    main process.
+    """
+    q, residual, bodyIds, J_alpha, rotatedFrictionCones = args
+    drakeModel = workerState['drakeModel']
+    drakeModel.setJointPositions(q)
+
+    numProblems, numContacts = np.shape(bodyIds)
+    linkJacobians = np.zeros((numProblems, numContacts, 6, drakeModel.numJoints))
+    for i in xrange(numProblems):
+        for j in xrange(numContacts):
+            linkJacobians[i,j] = drakeModel.getLinkJacobian(bodyIds[i,j])
+
+    H = batchmeasurementupdate.stackJacobianToFrictionCone(linkJacobians, J_alpha)
+    return workerState['batchMeasurementUpdate'].computeLikelihoods(residual, H, rotatedFrictionCones)
+
+
+class ParallelMeasurementUpdate(object):
+    """
+    Splits batch measurement updates into chunks and farms them out to a persistent
+    pool of worker processes. Results are always merged in the order the problems were
+    submitted, so the output doesn't depend on how the chunks were scheduled.
+    """
+
+    def __init__(self, options, numContactsList, numWorkers=None, chunkSize=50):
+        """
+        :param options: CPF config dict, passed to the workers
+        :param numWorkers: number of worker processes, defaults to the number of cores
+        :param chunkSize: max number of QP's sent to a worker in one go
+        """
+        if numWorkers is None:
+            numWorkers = multiprocessing.cpu_count()
+
+        self.numWorkers = numWorkers
+        self.chunkSize = chunkSize
+        self.pool = multiprocessing.Pool(processes=numWorkers, initializer=initializeWorker,
+                                         initargs=(options, numContactsList))
+
+    def submit(self, q, residual, bodyIds, J_alpha, rotatedFrictionCones):
+        """
+        Starts the batch measurement update in the workers without waiting for it.
+        :param q: robot pose
+        :param bodyIds: (numProblems, numContacts) body id of each contact point
+        :param J_alpha: (numProblems, numContacts, 6, NUM_FRICTION_CONE_BASIS_VECTORS)
+        :param rotatedFrictionCones: (numProblems, numContacts, 3, NUM_FRICTION_CONE_BASIS_VECTORS)
+        :return: handle to pass to collect
+        """
+        q = np.asarray(q)
+        numProblems = len(bodyIds)
+        asyncResultList = []
+        for start in xrange(0, numProblems, self.chunkSize):
+            chunk = slice(start, start + self.chunkSize)
+            args = (q, residual, bodyIds[chunk], J_alpha[chunk], rotatedFrictionCones[chunk])
+            asyncResultList.append(self.pool.apply_async(computeLikelihoodsWorker, (args,)))
+
+        return asyncResultList
+
+    @staticmethod
+    def collect(asyncResultList):
+        """
+        Waits for the chunks and merges them back together
+        :return: same dict as BatchMeasurementUpdate.computeLikelihoods, solveTime is
+        summed over the chunks
+        """
+        batchDataList = [asyncResult.get() for asyncResult in asyncResultList]
+
+        d = dict()
+        for key in batchDataList[0]:
+            if key == 'solveTime':
+                d[key] = sum(batchData[key] for batchData in batchDataList)
+            else:
+                d[key] = np.concatenate([batchData[key] for batchData in batchDataList])
+
+        return d
+
+    def computeLikelihoods(self, q, residual, bodyIds, J_alpha, rotatedFrictionCones):
+        return self.collect(self.submit(q, residual, bodyIds, J_alpha, rotatedFrictionCones))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
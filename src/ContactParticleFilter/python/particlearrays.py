@@ -0,0 +1,361 @@
+import numpy as np
+import cpf_lcmtypes
+
+MOST_LIKELY_ROW = -2
+HISTORICAL_MOST_LIKELY_ROW = -1
+
+
+class ContactPointView(object):
+    """
+    Lightweight stand in for a ContactFilterPoint that reads from the contact point
+    arrays of a ParticleSetArrays. Two views are equal if they point at the same row,
+    so they can be used as dict keys just like ContactFilterPoint objects.
+    """
+    __slots__ = ('particleSetArrays', 'idx')
+
+    def __init__(self, particleSetArrays, idx):
+        self.particleSetArrays = particleSetArrays
+        self.idx = idx
+
+    @property
+    def linkName(self):
+        return self.particleSetArrays.linkNames[self.particleSetArrays.linkIds[self.idx]]
+
+    @property
+    def bodyId(self):
+        return self.particleSetArrays.bodyIds[self.idx]
+
+    @property
+    def contactLocation(self):
+        return self.particleSetArrays.contactLocation[self.idx]
+
+    @property
+    def contactNormal(self):
+        return self.particleSetArrays.contactNormal[self.idx]
+
+    def __eq__(self, other):
+        return (type(other) is ContactPointView and other.particleSetArrays is self.particleSetArrays
+                and other.idx == self.idx)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.particleSetArrays), self.idx))
+
+
+class ParticleView(object):
+    """
+    Object view of a single particle in a ParticleSetArrays, exposes the same cfp and
+    solnData attributes as a ContactFilterParticle. Writes to the arrays are not
+    supported through the view.
+    """
+    __slots__ = ('particleSetArrays', 'idx')
+
+    def __init__(self, particleSetArrays, idx):
+        self.particleSetArrays = particleSetArrays
+        self.idx = idx
+
+    @property
+    def cfp(self):
+        return ContactPointView(self.particleSetArrays, self.particleSetArrays.cfpIdx[self.idx])
+
+    @property
+    def weight(self):
+        return self.particleSetArrays.weights[self.idx]
+
+    @property
+    def squaredError(self):
+        return self.particleSetArrays.squaredError[self.idx]
+
+    @property
+    def force(self):
+        return self.particleSetArrays.force[self.idx]
+
+    @property
+    def solnData(self):
+        if not self.particleSetArrays.hasSolnData[self.idx]:
+            return None
+        return {'force': self.force, 'squaredError': self.squaredError}
+
+
+class ParticleSetArrays(object):
+    """
+    Struct of arrays storage for a single contact particle set. Contact points are
+    stored once in (M,.) arrays and each particle just holds an index into them, so
+    resampling only copies integers and floats instead of creating new particle objects.
+    The last two particle rows hold the most likely and historical most likely particles.
+    """
+
+    def __init__(self, capacity=100, contactPointCapacity=None, color=[0,0,1]):
+        """
+        :param capacity: number of particles to preallocate, grows when needed
+        :param contactPointCapacity: number of contact points to preallocate, defaults to capacity
+        """
+        if contactPointCapacity is None:
+            contactPointCapacity = capacity
+
+        self.color = color
+        self.linkNames = []
+        self.linkIdFromName = dict()
+
+        # contact point arrays, contactLocation and contactNormal are in link frame
+        self.numContactPoints = 0
+        self.linkIds = np.zeros(contactPointCapacity, dtype=int)
+        self.bodyIds = np.zeros(contactPointCapacity, dtype=int)
+        self.contactLocation = np.zeros((contactPointCapacity, 3))
+        self.contactNormal = np.zeros((contactPointCapacity, 3))
+
+        # particle arrays, two extra rows for the most likely particles
+        self.numParticles = 0
+        self.cfpIdx = np.zeros(capacity + 2, dtype=int)
+        self.weights = np.ones(capacity + 2)
+        self.squaredError = np.zeros(capacity + 2)
+        self.force = np.zeros((capacity + 2, 3))
+        self.hasSolnData = np.zeros(capacity + 2, dtype=bool)
+
+        self.hasMostLikely = False
+        self.hasHistoricalMostLikely = False
+
+    def getParticleCapacity(self):
+        return len(self.cfpIdx) - 2
+
+    def getNumberOfParticles(self):
+        return self.numParticles
+
+    def getLinkId(self, linkName):
+        if linkName not in self.linkIdFromName:
+            self.linkIdFromName[linkName] = len(self.linkNames)
+            self.linkNames.append(linkName)
+        return self.linkIdFromName[linkName]
+
+    def reserveContactPoints(self, numContactPoints):
+        capacity = len(self.linkIds)
+        if numContactPoints <= capacity:
+            return
+
+        newCapacity = max(numContactPoints, 2*capacity)
+        self.linkIds = growArray(self.linkIds, newCapacity)
+        self.bodyIds = growArray(self.bodyIds, newCapacity)
+        self.contactLocation = growArray(self.contactLocation, newCapacity)
+        self.contactNormal = growArray(self.contactNormal, newCapacity)
+
+    def reserveParticles(self, numParticles):
+        capacity = self.getParticleCapacity()
+        if numParticles <= capacity:
+            return
+
+        newCapacity = max(numParticles, 2*capacity)
+
+        # the most likely rows live at the end, move them along
+        for name in ['cfpIdx', 'weights', 'squaredError', 'force', 'hasSolnData']:
+            oldArray = getattr(self, name)
+            newArray = growArray(oldArray, newCapacity + 2)
+            newArray[-2:] = oldArray[-2:]
+            setattr(self, name, newArray)
+
+    def addContactPoint(self, linkName, bodyId, contactLocation, contactNormal):
+        """
+        :return: index of the new contact point
+        """
+        idx = self.numContactPoints
+        self.reserveContactPoints(idx + 1)
+        self.linkIds[idx] = self.getLinkId(linkName)
+        self.bodyIds[idx] = bodyId
+        self.contactLocation[idx] = contactLocation
+        self.contactNormal[idx] = contactNormal
+        self.numContactPoints += 1
+        return idx
+
+    def addParticle(self, cfpIdx, weight=1.0):
+        """
+        :return: index of the new particle
+        """
+        idx = self.numParticles
+        self.reserveParticles(idx + 1)
+        self.cfpIdx[idx] = cfpIdx
+        self.weights[idx] = weight
+        self.hasSolnData[idx] = False
+        self.numParticles += 1
+        return idx
+
+    def setSolnData(self, idx, squaredError, force):
+        self.squaredError[idx] = squaredError
+        self.force[idx] = force
+        self.hasSolnData[idx] = True
+
+    def resample(self, idx):
+        """
+        Replaces the particles with particles[idx], weights are reset to 1
+        :param idx: (n,) array of particle indices, e.g. from resampling.resample
+        """
+        idx = np.asarray(idx, dtype=int)
+        numParticles = len(idx)
+        self.reserveParticles(numParticles)
+        self.cfpIdx[:numParticles] = self.cfpIdx[idx]
+        self.squaredError[:numParticles] = self.squaredError[idx]
+        self.force[:numParticles] = self.force[idx]
+        self.hasSolnData[:numParticles] = self.hasSolnData[idx]
+        self.weights[:numParticles] = 1.0
+        self.numParticles = numParticles
+
+    def copyParticleRow(self, sourceIdx, destinationIdx):
+        self.cfpIdx[destinationIdx] = self.cfpIdx[sourceIdx]
+        self.weights[destinationIdx] = self.weights[sourceIdx]
+        self.squaredError[destinationIdx] = self.squaredError[sourceIdx]
+        self.force[destinationIdx] = self.force[sourceIdx]
+        self.hasSolnData[destinationIdx] = self.hasSolnData[sourceIdx]
+
+    def setMostLikelyParticle(self, idx):
+        self.copyParticleRow(idx, MOST_LIKELY_ROW)
+        self.hasMostLikely = True
+
+    def setHistoricalMostLikelyParticle(self, idx):
+        self.copyParticleRow(idx, HISTORICAL_MOST_LIKELY_ROW)
+        self.hasHistoricalMostLikely = True
+
+    @property
+    def particleList(self):
+        return [ParticleView(self, idx) for idx in xrange(self.numParticles)]
+
+    @property
+    def mostLikelyParticle(self):
+        if not self.hasMostLikely:
+            return None
+        return ParticleView(self, MOST_LIKELY_ROW)
+
+    @property
+    def historicalMostLikely(self):
+        if not self.hasHistoricalMostLikely:
+            return {'particle': None}
+        return {'particle': ParticleView(self, HISTORICAL_MOST_LIKELY_ROW)}
+
+    def addParticleFromObject(self, particle, cfpIdxFromCFP):
+        """
+        Adds a ContactFilterParticle, the contact point is only added once per cfp object
+        :param cfpIdxFromCFP: dict cfp -> contact point index, updated in place
+        :return: index of the new particle
+        """
+        cfp = particle.cfp
+        if cfp not in cfpIdxFromCFP:
+            cfpIdxFromCFP[cfp] = self.addContactPoint(cfp.linkName, cfp.bodyId, cfp.contactLocation,
+                                                      cfp.contactNormal)
+
+        idx = self.addParticle(cfpIdxFromCFP[cfp], weight=particle.importanceWeight*particle.proposalData['weight'])
+        if particle.solnData is not None:
+            self.setSolnData(idx, particle.solnData['squaredError'], particle.solnData['force'])
+        return idx
+
+    @staticmethod
+    def fromParticleSet(particleSet):
+        """
+        Builds the array representation of a SingleContactParticleSet
+        """
+        numParticles = particleSet.getNumberOfParticles()
+        particleSetArrays = ParticleSetArrays(capacity=max(numParticles, 1), color=particleSet.color)
+        cfpIdxFromCFP = dict()
+
+        for particle in particleSet.particleList:
+            particleSetArrays.addParticleFromObject(particle, cfpIdxFromCFP)
+
+        # the most likely particles are added as regular particles and then moved into their rows
+        numParticles = particleSetArrays.numParticles
+        if particleSet.mostLikelyParticle is not None:
+            idx = particleSetArrays.addParticleFromObject(particleSet.mostLikelyParticle, cfpIdxFromCFP)
+            particleSetArrays.setMostLikelyParticle(idx)
+
+        historicalMostLikelyParticle = particleSet.historicalMostLikely['particle']
+        if historicalMostLikelyParticle is not None:
+            idx = particleSetArrays.addParticleFromObject(historicalMostLikelyParticle, cfpIdxFromCFP)
+            particleSetArrays.setHistoricalMostLikelyParticle(idx)
+
+        particleSetArrays.numParticles = numParticles
+        return particleSetArrays
+
+    def getForceForEncoding(self, rows):
+        # same convention as ContactFilter.encodeParticle, use the normal if we don't have a force
+        contactNormal = self.contactNormal[self.cfpIdx[rows]]
+        return np.where(self.hasSolnData[rows][:,np.newaxis], self.force[rows], contactNormal)
+
+    def encodeParticleRows(self, utime, rows):
+        cfpIdx = self.cfpIdx[rows]
+        linkNames = [self.linkNames[linkId] for linkId in self.linkIds[cfpIdx]]
+        contactLocation = self.contactLocation[cfpIdx].tolist()
+        contactNormal = self.contactNormal[cfpIdx].tolist()
+        contactForce = self.getForceForEncoding(rows).tolist()
+
+        msgList = [None]*len(rows)
+        for i in xrange(len(rows)):
+            msg = cpf_lcmtypes.CPF_particle_t()
+            msg.utime = utime
+            msg.link_name = linkNames[i]
+            msg.contact_location = contactLocation[i]
+            msg.contact_normal = contactNormal[i]
+            msg.contact_force = contactForce[i]
+            msgList[i] = msg
+
+        return msgList
+
+    def encode(self, utime):
+        """
+        :return: CPF_particle_set_t
+        """
+        if not (self.hasMostLikely and self.hasHistoricalMostLikely):
+            raise ValueError("need most likely and historical most likely particles to encode a particle set")
+
+        rows = np.concatenate((np.arange(self.numParticles), [MOST_LIKELY_ROW, HISTORICAL_MOST_LIKELY_ROW]))
+        particleMsgList = self.encodeParticleRows(utime, rows)
+
+        msg = cpf_lcmtypes.CPF_particle_set_t()
+        msg.utime = utime
+        msg.num_particles = self.numParticles
+        msg.particle_list = particleMsgList[:-2]
+        msg.most_likely_particle = particleMsgList[-2]
+        msg.historical_most_likely_particle = particleMsgList[-1]
+        msg.color = self.color
+        return msg
+
+    @staticmethod
+    def decode(msg):
+        """
+        :param msg: CPF_particle_set_t
+        :return: ParticleSetArrays, particles with the same link and location share a contact point
+        """
+        particleMsgList = list(msg.particle_list) + [msg.most_likely_particle, msg.historical_most_likely_particle]
+        numRows = len(particleMsgList)
+
+        particleSetArrays = ParticleSetArrays(capacity=max(msg.num_particles, 1), color=msg.color)
+        linkIds = np.array([particleSetArrays.getLinkId(p.link_name) for p in particleMsgList], dtype=int)
+        contactLocation = np.array([p.contact_location for p in particleMsgList], dtype=float)
+        contactNormal = np.array([p.contact_normal for p in particleMsgList], dtype=float)
+        contactForce = np.array([p.contact_force for p in particleMsgList], dtype=float)
+
+        # dedup the contact points on (link, location)
+        keys = np.column_stack((linkIds, contactLocation))
+        _, uniqueRows, cfpIdx = np.unique(keys.view(np.dtype((np.void, keys.dtype.itemsize*keys.shape[1]))),
+                                         return_index=True, return_inverse=True)
+
+        numContactPoints = len(uniqueRows)
+        particleSetArrays.reserveContactPoints(numContactPoints)
+        particleSetArrays.linkIds[:numContactPoints] = linkIds[uniqueRows]
+        particleSetArrays.contactLocation[:numContactPoints] = contactLocation[uniqueRows]
+        particleSetArrays.contactNormal[:numContactPoints] = contactNormal[uniqueRows]
+        particleSetArrays.numContactPoints = numContactPoints
+
+        # bodyIds aren't sent over lcm
+        particleSetArrays.bodyIds[:numContactPoints] = -1
+
+        rows = np.concatenate((np.arange(msg.num_particles), [MOST_LIKELY_ROW, HISTORICAL_MOST_LIKELY_ROW]))
+        particleSetArrays.cfpIdx[rows] = cfpIdx.ravel()[:numRows]
+        particleSetArrays.force[rows] = contactForce
+        particleSetArrays.hasSolnData[rows] = True
+        particleSetArrays.numParticles = msg.num_particles
+        particleSetArrays.hasMostLikely = True
+        particleSetArrays.hasHistoricalMostLikely = True
+        return particleSetArrays
+
+
+def growArray(array, newLength):
+    newArray = np.zeros((newLength,) + array.shape[1:], dtype=array.dtype)
+    newArray[:len(array)] = array
+    return newArray
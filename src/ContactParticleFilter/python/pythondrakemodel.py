@@ -7,6 +7,7 @@ import numpy as np
 import PythonQt
 import os
 import os.path
+import collections
 
 
 
@@ -23,6 +24,72 @@ class FloatingBaseType:
         return self.floatingJointTypeString
 
 
+# caches link jacobians for the last few robot poses. The link jacobian only depends
+# on (q, bodyId) so it can be shared by everyone using the same robot model, keying it
+# by q means models at different poses don't evict each other's entries
+class JacobianCache(object):
+
+    def __init__(self, maxNumPoses=4):
+        """
+        :param maxNumPoses: number of poses to keep link jacobians for, the least
+        recently used pose is dropped first
+        """
+        self.maxNumPoses = maxNumPoses
+        self.linkJacobians = collections.OrderedDict() # pose key -> {bodyId: linkJacobian}
+        self.numHits = 0
+        self.numMisses = 0
+
+    @staticmethod
+    def getPoseKey(q):
+        return np.asarray(q, dtype=float).tobytes()
+
+    def getLinkJacobiansAtPose(self, poseKey):
+        # move the pose to the end, it is the most recently used now
+        linkJacobians = self.linkJacobians.pop(poseKey, None)
+        if linkJacobians is None:
+            linkJacobians = dict()
+            if len(self.linkJacobians) >= self.maxNumPoses:
+                self.linkJacobians.popitem(last=False)
+
+        self.linkJacobians[poseKey] = linkJacobians
+        return linkJacobians
+
+    def getLinkJacobian(self, poseKey, bodyId):
+        """
+        :param poseKey: see getPoseKey
+        :return: cached link jacobian, or None if it isn't in the cache
+        """
+        linkJacobian = self.getLinkJacobiansAtPose(poseKey).get(bodyId)
+        if linkJacobian is None:
+            self.numMisses += 1
+        else:
+            self.numHits += 1
+        return linkJacobian
+
+    def addLinkJacobian(self, poseKey, bodyId, linkJacobian):
+        self.getLinkJacobiansAtPose(poseKey)[bodyId] = linkJacobian
+
+    def getStatistics(self):
+        return {'numHits': self.numHits, 'numMisses': self.numMisses}
+
+    def getHitRate(self):
+        numLookups = self.numHits + self.numMisses
+        if numLookups == 0:
+            return None
+        return 1.0*self.numHits/numLookups
+
+
+# one cache per robot model, shared across all PythonDrakeModel instances
+# (ContactFilter, TwoStepEstimator, ExternalForce) that load the same urdf
+jacobianCaches = dict()
+
+def getJacobianCache(floatingJointTypeString, filename):
+    key = (floatingJointTypeString, filename)
+    if key not in jacobianCaches:
+        jacobianCaches[key] = JacobianCache()
+    return jacobianCaches[key]
+
+
 # helper class that wraps ddDrakeModel
 class PythonDrakeModel(object):
 
@@ -31,6 +98,9 @@ class PythonDrakeModel(object):
         self.jointNameToIdxMap = self.getJointNameToIdxMap()
         self.jointIdxToNameMap = self.getJointIdxToNameMap()
         self.jointNames = self.model.getJointNames()
+        self.q = None
+        self.poseKey = None
+        self.jacobianCache = getJacobianCache(floatingJointTypeString, filename)
 
     # filename should be relative to drake source director
     def loadRobotModelFromURDFFilename(self, floatingBaseTypeString, filename):
@@ -96,7 +166,36 @@ class PythonDrakeModel(object):
         return data
 
 
-    # make sure you call setJointPositions(q) on the ddDrakeModel BEFORE you
+    # use this rather than calling setJointPositions on the ddDrakeModel directly,
+    # otherwise the jacobian cache doesn't know that the pose changed
+    def setJointPositions(self, q):
+        """
+        Does kinematics at pose q, skipped if we are already at q
+        """
+        if (self.q is None) or not np.array_equal(self.q, q):
+            self.q = np.array(q, dtype=float)
+            self.poseKey = JacobianCache.getPoseKey(self.q)
+            self.model.setJointPositions(self.q)
+
+    # make sure you call setJointPositions(q) BEFORE you call this method
+    def getLinkJacobian(self, bodyId):
+        """
+        Geometric jacobian of body bodyId expressed in body frame, i.e.
+        geometricJacobian(0, bodyId, bodyId, 0, False). Looked up in the jacobian
+        cache first.
+        """
+
+        if self.q is None:
+            raise ValueError("must call setJointPositions before getLinkJacobian")
+
+        linkJacobian = self.jacobianCache.getLinkJacobian(self.poseKey, bodyId)
+        if linkJacobian is None:
+            linkJacobian = self.geometricJacobian(0, bodyId, bodyId, 0, False)
+            self.jacobianCache.addLinkJacobian(self.poseKey, bodyId, linkJacobian)
+
+        return linkJacobian
+
+    # make sure you call setJointPositions(q) BEFORE you
     # call this method
     def geometricJacobian(self, base_body_or_frame_ind, end_effector_body_or_frame_id,
                           expressed_in_body_or_frame_ind, gradient_order, in_terms_of_qdot=False):
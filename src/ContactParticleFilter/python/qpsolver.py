@@ -8,7 +8,7 @@ NUM_FRICTION_CONE_BASIS_VECTORS = 4
 
 
 # General interface that can be used by the CPF to solve the QP problems.
-# Have the option of using either Gurobi or ForcesPro
+# Have the option of using Gurobi, ForcesPro or the license free NNLS solver
 class QPSolver:
 
     def __init__(self, numContactsList, config):
@@ -23,12 +23,15 @@ class QPSolver:
         if self.config['solver']['loadAllSolvers']:
             self.initializeForcesPro(numContactsList)
             self.initializeGurobi(numContactsList)
+            self.initializeNNLS(numContactsList)
         elif self.config['solver']['solverType'] == 'gurobi':
             self.initializeGurobi(numContactsList)
         elif self.config['solver']['solverType'] == 'forcespro':
             self.initializeForcesPro(numContactsList)
+        elif self.config['solver']['solverType'] == 'nnls':
+            self.initializeNNLS(numContactsList)
         else:
-            raise ValueError("solver type must be one of gurobi or forcespro")
+            raise ValueError("solver type must be one of gurobi, forcespro or nnls")
 
     def initializeGurobi(self, numContactsList):
         import contactfiltergurobi
@@ -38,17 +41,49 @@ class QPSolver:
         import forcesproqp
         self.forcesPro = forcesproqp.ForcesProQP(numContactsList)
 
+    def initializeNNLS(self, numContactsList):
+        import nnlsqp
+        self.nnls = nnlsqp.NNLSQP(numContactsList)
+
     def solve(self, numContacts, residual, H_list, weightMatrix, solverType='gurobi'):
         solnData = {}
         if solverType == 'gurobi':
             solnData = self.gurobi.solve(numContacts, residual, H_list, weightMatrix)
         elif solverType=='forcespro':
             solnData = self.forcesPro.solve(numContacts, residual, H_list, weightMatrix)
+        elif solverType=='nnls':
+            solnData = self.nnls.solve(numContacts, residual, H_list, weightMatrix)
         else:
-            raise ValueError("solver type must be one of gurobi or forcespro")
+            raise ValueError("solver type must be one of gurobi, forcespro or nnls")
 
         return solnData
 
+    def solveBatch(self, numContacts, residual, H, weightMatrix, solverType='gurobi'):
+        """
+        Solves a batch of QP's that all share the same residual and number of contacts.
+        :param H: numpy array of shape (numProblems, nv, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS)
+        :return: dict with 'alphaVals' of shape (numProblems, numContacts, NUM_FRICTION_CONE_BASIS_VECTORS)
+        and 'objectiveValue' of shape (numProblems,)
+        """
+        # the nnls solver is vectorized across problems, the others solve them one at a time
+        if solverType == 'nnls':
+            return self.nnls.solveBatch(numContacts, residual, H, weightMatrix)
+
+        numProblems = np.shape(H)[0]
+        alphaVals = np.zeros((numProblems, numContacts, NUM_FRICTION_CONE_BASIS_VECTORS))
+        objectiveValue = np.zeros(numProblems)
+
+        for k in xrange(0, numProblems):
+            H_list = np.hsplit(H[k], numContacts)
+            solnData = self.solve(numContacts, residual, H_list, weightMatrix, solverType=solverType)
+            for i in xrange(0, numContacts):
+                for j in xrange(0, NUM_FRICTION_CONE_BASIS_VECTORS):
+                    alphaVals[k,i,j] = solnData['alphaVals'][i,j]
+
+            objectiveValue[k] = solnData['objectiveValue']
+
+        return {'alphaVals': alphaVals, 'objectiveValue': objectiveValue}
+
 
     def test(self, numContacts = 1):
         numVars = numContacts*NUM_FRICTION_CONE_BASIS_VECTORS
@@ -0,0 +1,89 @@
+import numpy as np
+
+# Resampling schemes for the particle filter. Each function takes a (normalized)
+# weight array and returns an index array of length numSamples, so that the
+# whole draw is done in one vectorized pass instead of one rv.rvs() per particle.
+# The individual schemes return sorted indices, duplicates of the same particle are
+# adjacent. resample() shuffles them, callers split the resampled list by position.
+
+
+def normalizeWeights(weights):
+    weights = np.asarray(weights, dtype=float)
+    return weights/np.sum(weights)
+
+
+def effectiveSampleSize(weights):
+    """
+    ESS = 1/sum(w_i^2) for normalized weights. Equals the number of particles
+    when the weights are uniform and 1 when all the weight is on a single particle
+    """
+    weights = normalizeWeights(weights)
+    return 1.0/np.sum(weights**2)
+
+
+def searchCumulativeWeights(weights, u):
+    """
+    :param u: sorted array of points in [0,1)
+    :return: for each u the index i with cumsum(w)[i-1] <= u < cumsum(w)[i]
+    """
+    cumulativeWeights = np.cumsum(weights)
+    cumulativeWeights[-1] = 1.0 # guard against round off
+    return np.searchsorted(cumulativeWeights, u, side='right')
+
+
+def multinomialResampling(weights, numSamples):
+    weights = normalizeWeights(weights)
+    u = np.sort(np.random.uniform(size=numSamples))
+    return searchCumulativeWeights(weights, u)
+
+
+def stratifiedResampling(weights, numSamples):
+    weights = normalizeWeights(weights)
+    u = (np.arange(numSamples) + np.random.uniform(size=numSamples))/numSamples
+    return searchCumulativeWeights(weights, u)
+
+
+def systematicResampling(weights, numSamples):
+    weights = normalizeWeights(weights)
+    u = (np.arange(numSamples) + np.random.uniform())/numSamples
+    return searchCumulativeWeights(weights, u)
+
+
+def residualResampling(weights, numSamples):
+    """
+    Deterministically keeps floor(numSamples*w_i) copies of particle i, the remaining
+    samples are drawn from the residual weights using systematic resampling
+    """
+    weights = normalizeWeights(weights)
+    numCopies = np.floor(numSamples*weights).astype(int)
+    deterministicIdx = np.repeat(np.arange(len(weights)), numCopies)
+
+    numResidual = numSamples - len(deterministicIdx)
+    if numResidual == 0:
+        return deterministicIdx
+
+    residualWeights = numSamples*weights - numCopies
+    residualIdx = systematicResampling(residualWeights, numResidual)
+    return np.sort(np.concatenate((deterministicIdx, residualIdx)))
+
+
+RESAMPLING_METHODS = {'multinomial': multinomialResampling,
+                      'stratified': stratifiedResampling,
+                      'systematic': systematicResampling,
+                      'residual': residualResampling}
+
+
+def resample(weights, numSamples, method='systematic'):
+    """
+    :param weights: (N,) nonnegative weights, don't need to be normalized
+    :param numSamples: number of indices to draw
+    :param method: one of multinomial, stratified, systematic, residual
+    :return: (numSamples,) array of indices into weights, in random order
+    """
+    if method not in RESAMPLING_METHODS:
+        raise ValueError("resampling method must be one of " + ", ".join(sorted(RESAMPLING_METHODS.keys())))
+
+    # the schemes return sorted indices, without the shuffle any split of the result by
+    # position (e.g. sampleFromProposalDistributionSingleParticleSet) would always send
+    # the highest index particles to the same part
+    return np.random.permutation(RESAMPLING_METHODS[method](weights, numSamples))
@@ -0,0 +1,85 @@
+import unittest
+import itertools
+import numpy as np
+
+import nnlsqp
+import qpsolver
+import multicontactsearch
+
+
+def makeFrictionCone(normal, mu=0.5):
+    """
+    :return: (3, 4) friction cone basis vectors around the normal
+    """
+    normal = normal/np.linalg.norm(normal)
+    tangent = np.cross(normal, [1, 0, 0] if abs(normal[0]) < 0.9 else [0, 1, 0])
+    tangent = tangent/np.linalg.norm(tangent)
+    bitangent = np.cross(normal, tangent)
+    return np.array([normal + mu*tangent, normal - mu*tangent, normal + mu*bitangent, normal - mu*bitangent]).T
+
+
+def makeProblem(randomState, nv=7, linkJoints=(3, 5, 6), numCandidates=(8, 12, 10), noise=0.05):
+    """
+    Random jacobians along a kinematic chain, a force on a link doesn't act on the joints
+    after it. The residual is generated by one contact per link plus noise.
+    """
+    linkH = []
+    for joint, n in zip(linkJoints, numCandidates):
+        H = []
+        for c in xrange(n):
+            J = randomState.normal(size=(3, nv))
+            J[:, joint+1:] = 0
+            H.append(np.dot(J.T, makeFrictionCone(randomState.normal(size=3))))
+        linkH.append(np.array(H))
+
+    residual = noise*randomState.normal(size=nv)
+    for H in linkH:
+        residual += np.dot(H[randomState.randint(len(H))], randomState.uniform(0, 1, 4))
+
+    return residual, linkH
+
+
+def makeSearch(topK):
+    qpSolver = qpsolver.QPSolver([1, 2, 3], {'solver': {'loadAllSolvers': False, 'solverType': 'nnls'}})
+    return multicontactsearch.MultiContactSearch(qpSolver, 'nnls', topK=topK)
+
+
+def solveExhaustive(residual, weightMatrix, linkH):
+    combinations = list(itertools.product(*[xrange(len(H)) for H in linkH]))
+    H = np.array([np.concatenate([linkH[l][c[l]] for l in xrange(len(linkH))], axis=1) for c in combinations])
+    solnData = nnlsqp.NNLSQP().solveBatch(len(linkH), residual, H, weightMatrix)
+    return np.maximum(solnData['objectiveValue'], 0.0), len(combinations)
+
+
+class MultiContactSearchTest(unittest.TestCase):
+
+    def testMatchesExhaustiveWithFewerQPs(self):
+        randomState = np.random.RandomState(0)
+        weightMatrix = np.eye(7)
+        for trial in xrange(20):
+            topK = randomState.randint(1, 11)
+            numCandidates = tuple(randomState.randint(5, 15, size=3))
+            residual, linkH = makeProblem(randomState, numCandidates=numCandidates)
+
+            searchData = makeSearch(topK).search(residual, weightMatrix, linkH)
+            squaredError, numCombinations = solveExhaustive(residual, weightMatrix, linkH)
+
+            np.testing.assert_allclose(searchData['squaredError'], np.sort(squaredError)[:topK], atol=1e-8)
+            self.assertEqual(searchData['numCombinations'], numCombinations)
+            self.assertLessEqual(searchData['numQPs'], numCombinations)
+
+    def testSingleLink(self):
+        randomState = np.random.RandomState(1)
+        weightMatrix = np.diag(randomState.uniform(0.5, 2.0, size=7))
+        residual, linkH = makeProblem(randomState, linkJoints=(4,), numCandidates=(6,))
+
+        searchData = makeSearch(10).search(residual, weightMatrix, linkH)
+        squaredError, numCombinations = solveExhaustive(residual, weightMatrix, linkH)
+
+        self.assertEqual(len(searchData['combinations']), numCombinations)
+        np.testing.assert_allclose(searchData['squaredError'], np.sort(squaredError), atol=1e-8)
+        self.assertLessEqual(searchData['numQPs'], numCombinations)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import unittest
+import numpy as np
+import scipy.optimize
+
+import nnlsqp
+
+NUM_FRICTION_CONE_BASIS_VECTORS = nnlsqp.NUM_FRICTION_CONE_BASIS_VECTORS
+
+
+def makeWeightMatrix(randomState, nv):
+    L = randomState.normal(size=(nv, nv))
+    return np.dot(L, L.T) + 0.1*np.eye(nv)
+
+
+def makeDiagonalWeightMatrix(randomState, nv):
+    """
+    Powers of 4 on the diagonal, so that its cholesky factor is exact too
+    """
+    return np.diag(4.0**randomState.randint(-1, 2, size=nv))
+
+
+def makeRankDeficientH(randomState, nv, numContacts):
+    """
+    H = A B with A (nv, k), k < nv, and columns scaled by up to a factor 8 either way,
+    some columns duplicated. The entries are small integers times powers of 2, so the
+    columns are linearly dependent exactly, not just up to round off
+    """
+    numVars = numContacts*NUM_FRICTION_CONE_BASIS_VECTORS
+    k = randomState.randint(1, nv)
+    H = np.dot(randomState.randint(-3, 4, size=(nv, k)), randomState.randint(-3, 4, size=(k, numVars))).astype(float)
+    H *= 2.0**randomState.randint(-3, 4, size=numVars)
+    for i in xrange(randomState.randint(0, 3)):
+        H[:, randomState.randint(numVars)] = H[:, randomState.randint(numVars)]
+    return H
+
+
+def solveScipy(residual, H, W):
+    """
+    :return: squared error of the scipy.optimize.nnls solution, recomputed from its alpha
+    """
+    L = np.linalg.cholesky(W)
+    alpha, _ = scipy.optimize.nnls(np.dot(L.T, H), np.dot(L.T, residual), maxiter=100*np.shape(H)[1])
+    error = residual - np.dot(H, alpha)
+    return np.dot(np.dot(error, W), error), alpha
+
+
+class NNLSQPTest(unittest.TestCase):
+
+    def checkSolution(self, residual, H, W, solnData, msg):
+        """
+        alpha >= 0, the KKT conditions hold, the objective is the squared error of alpha and
+        it is no larger than the one scipy.optimize.nnls finds
+        """
+        numProblems = len(H)
+        alpha = solnData['alphaVals'].reshape(numProblems, -1)
+        self.assertTrue(np.all(alpha >= 0), msg=msg)
+
+        for i in xrange(numProblems):
+            error = residual - np.dot(H[i], alpha[i])
+            squaredError = np.dot(np.dot(error, W), error)
+            scale = np.dot(np.dot(residual, W), residual)
+
+            # gradient <h_j, r - H alpha>_W <= 0, and = 0 where alpha_j > 0
+            columnNorms = np.sqrt(np.einsum('vj,vw,wj->j', H[i], W, H[i]))
+            gradient = np.dot(np.dot(error, W), H[i])/np.maximum(columnNorms*np.sqrt(scale), 1e-300)
+            self.assertLess(np.max(gradient), 1e-8, msg=msg)
+            self.assertLess(np.max(np.abs(gradient)*(alpha[i] > 0)), 1e-8, msg=msg)
+
+            scipySquaredError, _ = solveScipy(residual, H[i], W)
+            self.assertAlmostEqual(solnData['objectiveValue'][i]/scale, squaredError/scale, places=8, msg=msg)
+            self.assertLessEqual(squaredError/scale, scipySquaredError/scale + 1e-8, msg=msg)
+
+    def testMatchesScipyNNLS(self):
+        randomState = np.random.RandomState(0)
+        solver = nnlsqp.NNLSQP()
+        for trial in xrange(50):
+            nv = randomState.randint(2, 14)
+            numContacts = randomState.randint(1, 4)
+            numProblems = randomState.randint(1, 10)
+            H = randomState.normal(size=(numProblems, nv, numContacts*NUM_FRICTION_CONE_BASIS_VECTORS))
+            W = makeWeightMatrix(randomState, nv)
+            residual = randomState.normal(size=nv)
+
+            solnData = solver.solveBatch(numContacts, residual, H, W)
+            self.checkSolution(residual, H, W, solnData, msg="trial %d" %(trial))
+
+    def testRankDeficient(self):
+        """
+        Fewer rows than variables and linearly dependent columns, both with the residual
+        inside the cone (the squared error is 0) and with a random residual
+        """
+        randomState = np.random.RandomState(1)
+        solver = nnlsqp.NNLSQP()
+        for trial in xrange(200):
+            nv = 7
+            numContacts = 3
+            numProblems = 8
+            H = np.array([makeRankDeficientH(randomState, nv, numContacts) for i in xrange(numProblems)])
+            W = np.eye(nv)
+
+            # the residual is in the cone of the first problem
+            alpha = np.abs(randomState.normal(size=numContacts*NUM_FRICTION_CONE_BASIS_VECTORS))
+            alpha *= randomState.uniform(size=len(alpha)) < 0.5
+            for residual in [np.dot(H[0], alpha), randomState.normal(size=nv)]:
+                solnData = solver.solveBatch(numContacts, residual, H, W)
+                self.checkSolution(residual, H, W, solnData, msg="trial %d" %(trial))
+
+            solnData = solver.solveBatch(numContacts, np.dot(H[0], alpha), H, W)
+            self.assertLess(solnData['objectiveValue'][0], 1e-10*np.sum(np.dot(H[0], alpha)**2))
+
+    def testWarmStart(self):
+        """
+        Warm starting from any nonnegative alpha, including the optimal one, gives the same
+        squared error as a cold start
+        """
+        randomState = np.random.RandomState(2)
+        solver = nnlsqp.NNLSQP()
+        for trial in xrange(100):
+            nv = 7
+            numContacts = 3
+            numVars = numContacts*NUM_FRICTION_CONE_BASIS_VECTORS
+            H = np.array([makeRankDeficientH(randomState, nv, numContacts), randomState.normal(size=(nv, numVars))])
+            W = makeDiagonalWeightMatrix(randomState, nv)
+            residual = randomState.normal(size=nv)
+
+            coldSolnData = solver.solveBatch(numContacts, residual, H, W)
+            initialAlphas = [np.zeros((2, numVars)),
+                             np.abs(randomState.normal(size=(2, numVars)))*(randomState.uniform(size=(2, numVars)) < 0.5),
+                             coldSolnData['alphaVals'],
+                             np.array([solveScipy(residual, H[i], W)[1] for i in xrange(2)])]
+
+            for initialAlpha in initialAlphas:
+                solnData = solver.solveBatch(numContacts, residual, H, W, initialAlpha=initialAlpha)
+                self.checkSolution(residual, H, W, solnData, msg="trial %d" %(trial))
+                np.testing.assert_allclose(solnData['objectiveValue'], coldSolnData['objectiveValue'],
+                                           rtol=1e-8, atol=1e-10*np.dot(np.dot(residual, W), residual))
+
+
+if __name__ == '__main__':
+    unittest.main()
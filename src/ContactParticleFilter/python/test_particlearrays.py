@@ -0,0 +1,166 @@
+import unittest
+import numpy as np
+
+import cpf_lcmtypes
+from contactfilter import ContactFilter, ContactFilterPoint, ContactFilterParticle, SingleContactParticleSet
+import particlearrays
+
+
+def makeContactFilterPoint(randomState, linkName):
+    contactNormal = randomState.normal(size=3)
+    contactNormal /= np.linalg.norm(contactNormal)
+    return ContactFilterPoint(linkName=linkName, contactLocation=randomState.normal(size=3).tolist(),
+                              contactNormal=contactNormal.tolist(), bodyId=1,
+                              forceMomentTransform=1, rotatedFrictionCone=1, J_alpha=1)
+
+
+def makeParticle(randomState, cfp, hasSolnData):
+    particle = ContactFilterParticle(cfp=cfp)
+    particle.importanceWeight = randomState.uniform(0.5, 2.0)
+    particle.proposalData['weight'] = randomState.uniform(0.5, 2.0)
+    if hasSolnData:
+        particle.solnData = {'force': randomState.normal(size=3), 'squaredError': randomState.uniform()}
+    return particle
+
+
+def makeParticleSet(randomState, numParticles=20, numContactPoints=6):
+    """
+    Particles on a few links, several particles share each contact point and some of
+    them don't have solnData yet
+    """
+    linkNames = ['link_1', 'link_2', 'link_3']
+    cfpList = [makeContactFilterPoint(randomState, linkNames[i % len(linkNames)]) for i in xrange(numContactPoints)]
+
+    particleSet = SingleContactParticleSet(color=[1, 0, 0])
+    for i in xrange(numParticles):
+        cfp = cfpList[randomState.randint(numContactPoints)]
+        particleSet.addParticle(makeParticle(randomState, cfp, hasSolnData=(i % 3 != 0)))
+
+    particleSet.mostLikelyParticle = particleSet.particleList[1]
+    particleSet.historicalMostLikely['particle'] = makeParticle(randomState, cfpList[0], hasSolnData=True)
+    return particleSet
+
+
+class ParticleArraysTest(unittest.TestCase):
+
+    def checkParticleSetArraysMatchesParticles(self, particleSetArrays, particleList):
+        """
+        Rows of particleSetArrays, in particleList order with the two most likely rows last,
+        have the same link, contact point, weight and force as the particle objects. The
+        force of a particle without solnData is encoded as its contact normal.
+        """
+        rows = range(len(particleList) - 2) + [particlearrays.MOST_LIKELY_ROW, particlearrays.HISTORICAL_MOST_LIKELY_ROW]
+        for row, particle in zip(rows, particleList):
+            cfpIdx = particleSetArrays.cfpIdx[row]
+            self.assertEqual(particleSetArrays.linkNames[particleSetArrays.linkIds[cfpIdx]], particle.cfp.linkName)
+            np.testing.assert_allclose(particleSetArrays.contactLocation[cfpIdx], particle.cfp.contactLocation)
+            np.testing.assert_allclose(particleSetArrays.contactNormal[cfpIdx], particle.cfp.contactNormal)
+            self.assertAlmostEqual(particleSetArrays.weights[row],
+                                   particle.importanceWeight*particle.proposalData['weight'])
+
+            if particle.solnData is None:
+                expectedForce = particle.cfp.contactNormal
+            else:
+                expectedForce = particle.solnData['force']
+            np.testing.assert_allclose(particleSetArrays.getForceForEncoding(np.array([row]))[0], expectedForce)
+
+    def checkParticleMsgEqual(self, msg, expectedMsg):
+        self.assertEqual(msg.link_name, expectedMsg.link_name)
+        for name in ['contact_location', 'contact_normal', 'contact_force']:
+            np.testing.assert_allclose(getattr(msg, name), getattr(expectedMsg, name), err_msg=name)
+
+    def testRoundTrip(self):
+        """
+        ParticleSetArrays.fromParticleSet -> encodeParticleSet -> decodeParticleSet gives
+        the same particles as going through the ContactFilterParticle objects
+        """
+        randomState = np.random.RandomState(0)
+        for trial in xrange(10):
+            particleSet = makeParticleSet(randomState)
+            particleList = particleSet.particleList + [particleSet.mostLikelyParticle,
+                                                       particleSet.historicalMostLikely['particle']]
+
+            particleSetArrays = particlearrays.ParticleSetArrays.fromParticleSet(particleSet)
+            self.assertEqual(particleSetArrays.getNumberOfParticles(), particleSet.getNumberOfParticles())
+            self.checkParticleSetArraysMatchesParticles(particleSetArrays, particleList)
+
+            # encoding either representation gives the same message
+            msg = ContactFilter.encodeParticleSet(0, particleSetArrays)
+            expectedMsg = ContactFilter.encodeParticleSet(0, particleSet)
+            self.assertEqual(msg.num_particles, expectedMsg.num_particles)
+            for particleMsg, expectedParticleMsg in zip(msg.particle_list, expectedMsg.particle_list):
+                self.checkParticleMsgEqual(particleMsg, expectedParticleMsg)
+            self.checkParticleMsgEqual(msg.most_likely_particle, expectedMsg.most_likely_particle)
+            self.checkParticleMsgEqual(msg.historical_most_likely_particle, expectedMsg.historical_most_likely_particle)
+
+            # decode what was sent over lcm, both ways
+            msg = cpf_lcmtypes.CPF_particle_set_t.decode(msg.encode())
+            decodedParticleSet = ContactFilter.decodeParticleSet(msg)
+            decodedParticleSetArrays = ContactFilter.decodeParticleSet(msg, useParticleArrays=True)
+            self.assertEqual(type(decodedParticleSetArrays), particlearrays.ParticleSetArrays)
+            self.assertEqual(decodedParticleSetArrays.getNumberOfParticles(), particleSet.getNumberOfParticles())
+
+            decodedParticleList = decodedParticleSet.particleList + [decodedParticleSet.mostLikelyParticle,
+                                                                     decodedParticleSet.historicalMostLikely['particle']]
+            self.checkParticleSetArraysMatchesParticles(decodedParticleSetArrays, decodedParticleList)
+            np.testing.assert_allclose(decodedParticleSetArrays.contactLocation[decodedParticleSetArrays.cfpIdx[:len(particleSet.particleList)]],
+                                       [particle.cfp.contactLocation for particle in particleSet.particleList], rtol=1e-6)
+
+            # particles at the same contact point share a row again
+            numContactPoints = len(set(particle.cfp for particle in particleList))
+            self.assertEqual(decodedParticleSetArrays.numContactPoints, numContactPoints)
+
+    def testResampleCopiesRows(self):
+        """
+        Resampled particles are copies, changing one of them leaves the others and the
+        most likely rows alone
+        """
+        randomState = np.random.RandomState(1)
+        particleSet = makeParticleSet(randomState, numParticles=10)
+        particleSetArrays = particlearrays.ParticleSetArrays.fromParticleSet(particleSet)
+        numContactPoints = particleSetArrays.numContactPoints
+        contactLocation = particleSetArrays.contactLocation[:numContactPoints].copy()
+        mostLikelyForce = particleSetArrays.force[particlearrays.MOST_LIKELY_ROW].copy()
+        historicalMostLikelyForce = particleSetArrays.force[particlearrays.HISTORICAL_MOST_LIKELY_ROW].copy()
+
+        # every particle drawn several times, and more particles than the capacity
+        idx = np.repeat(np.arange(10), 3)
+        randomState.shuffle(idx)
+        forceBefore = particleSetArrays.force[idx].copy()
+        cfpIdxBefore = particleSetArrays.cfpIdx[idx].copy()
+        particleSetArrays.resample(idx)
+
+        self.assertEqual(particleSetArrays.getNumberOfParticles(), len(idx))
+        np.testing.assert_array_equal(particleSetArrays.cfpIdx[:len(idx)], cfpIdxBefore)
+        np.testing.assert_array_equal(particleSetArrays.force[:len(idx)], forceBefore)
+        np.testing.assert_array_equal(particleSetArrays.weights[:len(idx)], np.ones(len(idx)))
+        np.testing.assert_array_equal(particleSetArrays.force[particlearrays.MOST_LIKELY_ROW], mostLikelyForce)
+        np.testing.assert_array_equal(particleSetArrays.force[particlearrays.HISTORICAL_MOST_LIKELY_ROW],
+                                      historicalMostLikelyForce)
+
+        # resampling only copies indices, the contact points aren't duplicated
+        self.assertEqual(particleSetArrays.numContactPoints, numContactPoints)
+
+        # the copies of particle 1, which has solnData
+        copies = np.nonzero(idx == 1)[0]
+        particleSetArrays.setSolnData(copies[0], 5.0, np.array([1.0, 2.0, 3.0]))
+        particleSetArrays.force[copies[1]] *= 2
+
+        np.testing.assert_array_equal(particleSetArrays.force[copies[0]], [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(particleSetArrays.force[copies[1]], 2*forceBefore[copies[1]])
+        np.testing.assert_array_equal(particleSetArrays.force[copies[2]], forceBefore[copies[2]])
+        self.assertNotEqual(particleSetArrays.squaredError[copies[1]], 5.0)
+        np.testing.assert_array_equal(particleSetArrays.force[particlearrays.MOST_LIKELY_ROW], mostLikelyForce)
+        np.testing.assert_array_equal(particleSetArrays.force[particlearrays.HISTORICAL_MOST_LIKELY_ROW],
+                                      historicalMostLikelyForce)
+        np.testing.assert_array_equal(particleSetArrays.contactLocation[:numContactPoints], contactLocation)
+
+        # views of copies point at the same contact point but are different particles
+        particleList = particleSetArrays.particleList
+        self.assertEqual(particleList[copies[0]].cfp, particleList[copies[1]].cfp)
+        self.assertNotEqual(particleList[copies[0]].solnData['squaredError'],
+                            particleList[copies[1]].solnData['squaredError'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+
+import resampling
+
+
+class ResamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+
+    def testExpectedCopies(self):
+        """
+        Each particle is drawn numSamples*w_i times on average
+        """
+        weights = np.array([0.1, 0.2, 0.3, 0.4])
+        numSamples = 100
+        numTrials = 2000
+        for method in sorted(resampling.RESAMPLING_METHODS.keys()):
+            counts = np.zeros(len(weights))
+            for i in xrange(numTrials):
+                idx = resampling.resample(weights, numSamples, method=method)
+                self.assertEqual(len(idx), numSamples)
+                counts += np.bincount(idx, minlength=len(weights))
+
+            np.testing.assert_allclose(counts/numTrials, numSamples*weights, rtol=0.05, err_msg=method)
+
+    def testHeadTailSplitIsUnbiased(self):
+        """
+        sampleFromProposalDistributionSingleParticleSet keeps the first normalFraction of
+        the resampled particles and replaces the rest, with uniform weights every particle
+        has to end up in the kept part equally often
+        """
+        numParticles = 50
+        numKept = 40
+        numTrials = 4000
+        weights = np.ones(numParticles)
+        for method in sorted(resampling.RESAMPLING_METHODS.keys()):
+            keptCounts = np.zeros(numParticles)
+            for i in xrange(numTrials):
+                idx = resampling.resample(weights, numParticles, method=method)
+                keptCounts += np.bincount(idx[:numKept], minlength=numParticles)
+
+            keptFraction = keptCounts/numTrials
+            expected = numKept/float(numParticles)
+            self.assertLess(np.max(np.abs(keptFraction - expected)), 0.1, msg=method)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -108,14 +108,14 @@ class TwoStepEstimator:
 
         # do kinematics on our internal model
         q = self.getCurrentPose()
-        self.drakeModel.model.setJointPositions(q)
+        self.drakeModel.setJointPositions(q)
 
         # stack the jacobians
         jacobianTransposeList = []
 
         for linkName in linkNamesWithContactForce:
             linkId = self.drakeModel.model.findLinkID(linkName)
-            J = self.drakeModel.geometricJacobian(0,linkId,linkId, 0, False)
+            J = self.drakeModel.getLinkJacobian(linkId)
             jacobianTransposeList.append(J.transpose())
 
 
@@ -1,19 +1,47 @@
 #!/usr/bin/python
 
+"""
+Extracts, fuses and (optionally) downsamples all the logs in a folder.
+
+Each stage has its own pool of worker processes, so e.g. the extraction of one
+scene overlaps the fusion of another. The status of every (scene, stage) is kept
+in a json manifest in the logs folder, it is updated as soon as a stage finishes,
+so after a crash just run the script again and it picks up where it left off.
+
+Usage:
+
+    batch_extract_and_fuse_all_scenes.py --num_extract_workers 4 --num_fuse_workers 1 --downsample
+"""
+
+
 import os
 import rospy
 import time
 import gc
+import json
+import argparse
+import traceback
 import multiprocessing as mp
 import resource
 
 
 from fusion_server.fusion import FusionServer
 import fusion_server.tsdf_fusion as tsdf_fusion
+import fusion_server.keyframe_selection as keyframe_selection
 
 import spartan.utils.utils as spartanUtils
 
 
+STAGES = ['extract', 'fuse', 'downsample']
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+MANIFEST_FILENAME = 'batch_manifest.json'
+
+
 def mem():
     print('Memory usage         : % 2.2f MB' % round(
         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,1)
@@ -23,7 +51,7 @@ def already_extracted_rosbag(log_full_path):
     images_dir = os.path.join(log_full_path, 'processed', 'images')
     file_to_check = os.path.join(images_dir, 'camera_info.yaml')
     return os.path.exists(file_to_check)
-        
+
 def already_ran_tsdf_fusion(log_full_path):
     processed_dir = os.path.join(log_full_path, 'processed')
     file_to_check = os.path.join(processed_dir, 'fusion_mesh.ply')
@@ -31,101 +59,336 @@ def already_ran_tsdf_fusion(log_full_path):
 
 def already_downsampled(log_full_path):
     images_dir = os.path.join(log_full_path, 'processed', 'images')
+    if keyframe_selection.has_keyframe_index(images_dir):
+        return True
+
+    # folders downsampled before the keyframe index existed had their
+    # images moved, so consecutive frames are missing
     file_to_check_1 = os.path.join(images_dir, "000000_rgb.png")
     file_to_check_2 = os.path.join(images_dir, "000001_rgb.png")
-    return not (os.path.exists(file_to_check_1) and os.path.exists(file_to_check_2))
+    return os.path.exists(file_to_check_1) and not os.path.exists(file_to_check_2)
 
 def extract_data_from_rosbag(bag_filepath):
-    fs = FusionServer()    
+    fs = FusionServer()
     processed_dir, images_dir = fs.extract_data_from_rosbag(bag_filepath)
 
-def extract_and_fuse_single_scene(log_full_path, downsample=False):
-
-    print "extracting and fusing scene:", log_full_path 
+def extract_scene(log_full_path):
     log = os.path.split(log_full_path)[-1]
+    bag_filepath = os.path.join(log_full_path, 'raw', 'fusion_'+log+'.bag')
 
-    mem()
-
-    if not already_extracted_rosbag(log_full_path):
-        print "extracting", log_full_path
-        bag_filepath = os.path.join(log_full_path, 'raw', 'fusion_'+log+'.bag')
+    print "extracting", log_full_path
+    extract_data_from_rosbag(bag_filepath)
+    print "finished extracting", log_full_path
 
-        # run this memory intensive step in a process, to allow
-        # it to release memory back to the operating system
-        # when finished
-        proc = mp.Process(target=extract_data_from_rosbag, args=(bag_filepath,))
-        proc.start()
-        proc.join()
+def fuse_scene(log_full_path, use_numpy_tsdf_fusion=False):
+    processed_dir = os.path.join(log_full_path, 'processed')
+    images_dir    = os.path.join(processed_dir, 'images')
 
-        print "finished extracting", log_full_path
-        # counter_new_extracted += 1
+    print "running tsdf fusion for", log_full_path
+    if use_numpy_tsdf_fusion:
+        tsdf_fusion.run_tsdf_fusion_numpy(images_dir)
     else:
-        print "already extracted", log_full_path
+        tsdf_fusion.format_data_for_tsdf(images_dir)
+        gc.collect()
+        tsdf_fusion.run_tsdf_fusion_cuda(images_dir)
+    gc.collect()
 
+    print "converting tsdf to ply"
+    tsdf_bin_filename = os.path.join(processed_dir, 'tsdf.bin')
+    tsdf_mesh_filename = os.path.join(processed_dir, 'fusion_mesh.ply')
+    tsdf_fusion.convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename)
 
-    processed_dir = os.path.join(log_full_path, 'processed')
-    images_dir    = os.path.join(processed_dir, 'images')
-    
-    # we need to free some memory
-    gc.collect()
-    mem()
+def downsample_scene(log_full_path):
+    images_dir = os.path.join(log_full_path, 'processed', 'images')
 
+    print "downsampling image folder", images_dir
+    linear_distance_threshold = 0.03
+    angle_distance_threshold = 10 # in degrees
+    FusionServer.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold)
 
-    if not already_ran_tsdf_fusion(log_full_path):
-        print "preparing for tsdf_fusion for", log_full_path
-        tsdf_fusion.format_data_for_tsdf(images_dir)
-        gc.collect()
+STAGE_FUNCTIONS = {'extract': extract_scene, 'fuse': fuse_scene, 'downsample': downsample_scene}
 
-        print "running tsdf fusion"
-        tsdf_fusion.run_tsdf_fusion_cuda(images_dir)
-        gc.collect()
+# checks whether the output of a stage already exists
+STAGE_FINISHED_CHECKS = {'extract': already_extracted_rosbag,
+                         'fuse': already_ran_tsdf_fusion,
+                         'downsample': already_downsampled}
 
-        print "converting tsdf to ply"
-        tsdf_bin_filename = os.path.join(processed_dir, 'tsdf.bin')
-        tsdf_mesh_filename = os.path.join(processed_dir, 'fusion_mesh.ply')
-        tsdf_fusion.convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename)
-        # counter_new_fused += 1
-    else:
-        print "already ran tsdf_fusion for", log_full_path
-
-    if not already_downsampled(log_full_path) and downsample:
-        fs = FusionServer()
-        print "downsampling image folder"
-        linear_distance_threshold = 0.03
-        angle_distance_threshold = 10 # in degrees
-        fs.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold)
-        # counter_new_downsampled += 1
-    else:
-        print "already downsampled for", log_full_path
+def extract_and_fuse_single_scene(log_full_path, downsample=False, stage_kwargs=None):
+    """
+    Runs the stages for a single scene one after the other in this process, skipping
+    the ones whose output already exists. Doesn't use the manifest.
 
- 
-if __name__ == "__main__":
+    :param stage_kwargs: dict stage -> extra kwargs for that stage's function
+    """
+    if stage_kwargs is None:
+        stage_kwargs = dict()
 
-    start = time.time()
+    stages = ['extract', 'fuse']
+    if downsample:
+        stages.append('downsample')
 
-    fs = FusionServer()
-    
-    logs_proto_path = os.path.join(spartanUtils.getSpartanSourceDir(), 'data_volume', 'pdc', 'logs_special', 'static_scenes')
+    print "extracting and fusing scene:", log_full_path
 
-    logs_proto_list = sorted(os.listdir(logs_proto_path))
+    for stage in stages:
+        if STAGE_FINISHED_CHECKS[stage](log_full_path):
+            print "already ran %s for %s" %(stage, log_full_path)
+            continue
 
-    counter_new_extracted   = 0
-    counter_new_fused       = 0
-    counter_new_downsampled = 0
+        mem()
+        STAGE_FUNCTIONS[stage](log_full_path, **stage_kwargs.get(stage, dict()))
 
-    for log in logs_proto_list:
+        # we need to free some memory
+        gc.collect()
 
-        log_full_path = os.path.join(logs_proto_path, log)
 
-        extract_and_fuse_single_scene(log_full_path)
+def run_stage(stage, log_full_path, kwargs):
+    """
+    Runs a single stage for a single scene, this is what the worker processes execute.
+    Exceptions are caught and reported back rather than raised, so that the traceback
+    makes it into the manifest.
+    """
+    start_time = time.time()
+    d = dict()
+    try:
+        STAGE_FUNCTIONS[stage](log_full_path, **kwargs)
+        d['status'] = STATUS_DONE
+    except Exception:
+        d['status'] = STATUS_FAILED
+        d['error'] = traceback.format_exc()
+
+    d['elapsed'] = time.time() - start_time
+    # each worker process runs a single task, so this is the peak for this stage
+    d['max_memory_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    return d
+
+
+class SceneManifest(object):
+    """
+    Persistent per scene, per stage status, stored as json. Only the main
+    process reads or writes it.
+    """
+
+    def __init__(self, filename, stages):
+        self.filename = filename
+        self.stages = stages
+        self.data = dict()
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.data = json.load(f)
+
+    def save(self):
+        # write then rename, so a crash never leaves a half written manifest
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
+
+    def add_scene(self, scene, log_full_path):
+        """
+        Adds a scene, or the stages it is missing. Scenes processed before the
+        manifest existed are detected from their output files, once.
+        """
+        if scene not in self.data:
+            self.data[scene] = dict()
+
+        # a stage only counts as finished if all the ones before it are
+        previous_done = True
+        for stage in self.stages:
+            if stage not in self.data[scene]:
+                status = STATUS_PENDING
+                if previous_done and STAGE_FINISHED_CHECKS[stage](log_full_path):
+                    status = STATUS_DONE
+                self.data[scene][stage] = {'status': status}
+
+            previous_done = previous_done and (self.data[scene][stage]['status'] == STATUS_DONE)
+
+    def reset_interrupted(self):
+        """
+        Stages that were running when the last run crashed start over
+        """
+        for scene, stages in self.data.iteritems():
+            for stage, d in stages.iteritems():
+                if d['status'] == STATUS_RUNNING:
+                    d['status'] = STATUS_PENDING
+
+    def get_status(self, scene, stage):
+        return self.data[scene][stage]['status']
+
+    def set_status(self, scene, stage, status, **kwargs):
+        d = {'status': status}
+        d.update(kwargs)
+        self.data[scene][stage] = d
+        self.save()
+
+
+class BatchScheduler(object):
+    """
+    Pipelines the stages across scenes. Each stage has its own process pool, a scene
+    is handed to the next stage's pool as soon as it finishes the previous one.
+    """
+
+    def __init__(self, logs_path, stages=STAGES, num_workers=None, stage_kwargs=None, poll_interval=1.0):
+        """
+        :param num_workers: dict stage -> number of worker processes
+        :param stage_kwargs: dict stage -> extra kwargs for that stage's function
+        """
+        if num_workers is None:
+            num_workers = dict()
+
+        if stage_kwargs is None:
+            stage_kwargs = dict()
+
+        self.logs_path = logs_path
+        self.stages = stages
+        self.num_workers = num_workers
+        self.stage_kwargs = stage_kwargs
+        self.poll_interval = poll_interval
+
+        self.manifest = SceneManifest(os.path.join(logs_path, MANIFEST_FILENAME), stages)
+        self.stats = dict()
+        for stage in stages:
+            self.stats[stage] = {'num_done': 0, 'num_failed': 0, 'busy_time': 0.0, 'max_memory_mb': 0.0}
+
+    def get_scenes(self):
+        scenes = []
+        for log in sorted(os.listdir(self.logs_path)):
+            if os.path.isdir(os.path.join(self.logs_path, log)):
+                scenes.append(log)
+        return scenes
+
+    def next_stage(self, scene):
+        """
+        :return: first stage of scene that isn't done, None if it is finished or a stage failed
+        """
+        for stage in self.stages:
+            status = self.manifest.get_status(scene, stage)
+            if status == STATUS_DONE:
+                continue
+            if status == STATUS_PENDING:
+                return stage
+            return None
+        return None
+
+    def submit(self, scene):
+        stage = self.next_stage(scene)
+        if stage is None:
+            return None
+
+        log_full_path = os.path.join(self.logs_path, scene)
+        args = (stage, log_full_path, self.stage_kwargs.get(stage, dict()))
+        async_result = self.pools[stage].apply_async(run_stage, args)
+        self.manifest.set_status(scene, stage, STATUS_RUNNING)
+        print "submitted %s for %s" %(stage, scene)
+        return (scene, stage, async_result)
+
+    def run(self):
+        scenes = self.get_scenes()
+        for scene in scenes:
+            self.manifest.add_scene(scene, os.path.join(self.logs_path, scene))
+        self.manifest.reset_interrupted()
+        self.manifest.save()
+
+        # maxtasksperchild=1, every task gets a fresh process so its memory
+        # goes back to the OS as soon as it is done
+        self.pools = dict()
+        for stage in self.stages:
+            self.pools[stage] = mp.Pool(processes=self.num_workers.get(stage, 1), maxtasksperchild=1)
+
+        start_time = time.time()
+        running = []
+        try:
+            for scene in scenes:
+                task = self.submit(scene)
+                if task is not None:
+                    running.append(task)
+
+            while len(running) > 0:
+                time.sleep(self.poll_interval)
+                still_running = []
+                for scene, stage, async_result in running:
+                    if not async_result.ready():
+                        still_running.append((scene, stage, async_result))
+                        continue
+
+                    result = async_result.get()
+                    self.record_result(scene, stage, result)
+                    task = self.submit(scene)
+                    if task is not None:
+                        still_running.append(task)
+
+                running = still_running
+        finally:
+            for pool in self.pools.values():
+                pool.close()
+                pool.join()
+
+        self.print_summary(time.time() - start_time)
+
+    def record_result(self, scene, stage, result):
+        status = result.pop('status')
+        self.manifest.set_status(scene, stage, status, **result)
+
+        stats = self.stats[stage]
+        stats['busy_time'] += result['elapsed']
+        stats['max_memory_mb'] = max(stats['max_memory_mb'], result['max_memory_mb'])
+        if status == STATUS_DONE:
+            stats['num_done'] += 1
+            print "finished %s for %s in %.1f seconds" %(stage, scene, result['elapsed'])
+        else:
+            stats['num_failed'] += 1
+            print "%s FAILED for %s:\n%s" %(stage, scene, result['error'])
+
+    def print_summary(self, elapsed):
+        print "SUMMARY:"
+        for stage in self.stages:
+            stats = self.stats[stage]
+            scenes_per_hour = 0.0
+            if elapsed > 0:
+                scenes_per_hour = stats['num_done']*3600.0/elapsed
+            print "%-12s done: %3d  failed: %3d  busy time: %8.1f s  throughput: %6.2f scenes/hour  max memory: %8.1f MB" \
+                %(stage, stats['num_done'], stats['num_failed'], stats['busy_time'], scenes_per_hour,
+                  stats['max_memory_mb'])
+
+        num_failed = sum(self.stats[stage]['num_failed'] for stage in self.stages)
+        if num_failed > 0:
+            print "%d stages failed, see %s" %(num_failed, self.manifest.filename)
 
 
-    print "finished extracting and fusing all logs in logs_proto"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logs_dir", type=str, default=None,
+                        help="folder containing the logs, defaults to data_volume/pdc/logs_special/static_scenes")
+    parser.add_argument("--num_extract_workers", type=int, default=max(1, mp.cpu_count()/2))
+    parser.add_argument("--num_fuse_workers", type=int, default=1,
+                        help="the cuda tsdf fusion uses the gpu, only increase this with --numpy_tsdf_fusion")
+    parser.add_argument("--numpy_tsdf_fusion", action='store_true', help="use the cpu tsdf fusion")
+    parser.add_argument("--downsample", action='store_true', help="also downsample the images by pose difference")
+    parser.add_argument("--retry_failed", action='store_true', help="rerun stages that failed last time")
+    args = parser.parse_args()
 
-    print "SUMMARY:"
-    # print "number new logs extracted:  ", counter_new_extracted
-    # print "number new logs fused:      ", counter_new_fused
-    # print "number new logs downsampled:", counter_new_downsampled
+    start = time.time()
+
+    logs_proto_path = args.logs_dir
+    if logs_proto_path is None:
+        logs_proto_path = os.path.join(spartanUtils.getSpartanSourceDir(), 'data_volume', 'pdc', 'logs_special', 'static_scenes')
+
+    stages = ['extract', 'fuse']
+    if args.downsample:
+        stages.append('downsample')
+
+    num_workers = {'extract': args.num_extract_workers, 'fuse': args.num_fuse_workers, 'downsample': 1}
+    stage_kwargs = {'fuse': {'use_numpy_tsdf_fusion': args.numpy_tsdf_fusion}}
+
+    scheduler = BatchScheduler(logs_proto_path, stages=stages, num_workers=num_workers, stage_kwargs=stage_kwargs)
+    if args.retry_failed:
+        for scene, scene_stages in scheduler.manifest.data.iteritems():
+            for stage, d in scene_stages.iteritems():
+                if d['status'] == STATUS_FAILED:
+                    d['status'] = STATUS_PENDING
+
+    scheduler.run()
+
+    print "finished extracting and fusing all logs in", logs_proto_path
 
     end = time.time()
     hours, rem = divmod(end-start, 3600)
@@ -133,8 +396,3 @@ if __name__ == "__main__":
     time_string = "{:0>2}:{:0>2}:{:05.2f}".format(int(hours),int(minutes),seconds)
     print "total time:               ",  time_string
     print "(hours, minutes, seconds with two decimals)"
-
-
-
-
-
@@ -10,6 +10,9 @@ import copy
 import numpy as np
 import cv2
 import shutil
+import collections
+import threading
+import Queue
 
 
 # ply reader
@@ -21,19 +24,29 @@ import tf2_ros
 import rospy
 import rosbag
 from cv_bridge import CvBridge
+import sensor_msgs.msg
+import geometry_msgs.msg
 
 
 # spartan
 import spartan.utils.utils as spartanUtils
 import spartan.utils.ros_utils as rosUtils
+from spartan.utils.image_writer import ImageWriter
+from spartan.utils.tf_pose_table import TFPoseTable
 
 # ros srv
 import fusion_server.srv
+import fusion_server.msg
 from fusion_server.srv import *
 from fusion_server.numpy_pc2 import array_to_xyz_pointcloud2f
 import fusion_server.tsdf_fusion as tsdf_fusion
+import fusion_server.keyframe_selection as keyframe_selection
 
 
+# written to the processed dir once the images have been extracted and downsampled, see
+# FusionServer.capture_scene_and_fuse_online
+IMAGES_READY_FILENAME = 'images_ready'
+
 
 # this function taken from here:
 # https://answers.ros.org/question/10714/start-and-stop-rosbag-within-a-python-script/
@@ -153,94 +166,62 @@ class ImageCapture(object):
     def load_ros_bag(self, ros_bag_filename):
         self.ros_bag = rosbag.Bag(ros_bag_filename, "r")
 
-    def process_ros_bag(self, bag, output_dir, rgb_only=False):
-
-        image_topics = []
-        for key, topic in self.topics_dict.iteritems():
-            image_topics.append(topic)
+    def process_ros_bag(self, bag, output_dir, rgb_only=False, rgb_buffer_size=30,
+        num_writer_threads=4, png_compression=3):
+        """
+        Extracts synchronized rgb and depth images from the bag in a single streaming pass.
 
+        Only the last rgb_buffer_size rgb messages are kept around for timestamp matching.
+        Each depth image is matched to the first rgb image with timestamp >= its own
+        timestamp and the pair is written to disk as soon as that rgb image has been seen,
+        so memory usage doesn't grow with the length of the log. Depth images that don't
+        get a match within rgb_buffer_size depth images, or before the end of the bag,
+        are skipped.
 
-        # load all the images
-        rgb_data = dict()
-        rgb_data['msgs'] = []
-        rgb_data['cv_img'] = []
-        rgb_data['timestamps'] = []
+        :param: rgb_buffer_size, number of rgb messages kept in the ring buffer
+        :ptype: int
 
+        :param: num_writer_threads, number of threads used to encode and write the pngs
+        :ptype: int
 
+        :param: png_compression, png compression level, 0 (fastest) to 9 (smallest)
+        :ptype: int
+        """
 
-        depth_data = dict()
-        depth_data['msgs'] = []
-        depth_data['cv_img'] = []
-        depth_data['timestamps'] = []
-        depth_data['camera_to_world'] = []
+        image_topics = []
+        for key, topic in self.topics_dict.iteritems():
+            image_topics.append(topic)
 
         print "image_topics: ", image_topics
 
-        # extract TF information
-        tf_t = rosUtils.setup_tf_transformer_from_ros_bag(bag, cache_time_secs=3600)
-
-        log_rate = 100
-
-        counter = 0
-        for topic, msg, t in bag.read_messages(topics=image_topics):
-            counter += 1
-
-            # skip the first 30 images due to transform errors . . . 
-            # if counter < 30:
-            #     continue
-
-            if counter % log_rate == 0:
-                print "processing image message %d" %(counter)
-
-
-            data = None
-            if "rgb" in topic:
-                cv_img = self.cv_bridge.imgmsg_to_cv2(msg, desired_encoding=self.rgb_encoding)
-                data = rgb_data
-            elif "depth" in topic:
-                cv_img = rosUtils.depth_image_to_cv2_uint16(msg, bridge=self.cv_bridge)
-                data = depth_data
-
-                try:
-                    # rot ix (x,y,z,w)
-                    (trans, rot) = tf_t.lookupTransform(self.world_frame, self.camera_frame, msg.header.stamp)
-                except:
-                    print "wasn't able to get transform for image message %d, skipping" %(counter)
-                    continue
-
-
-                depth_data['camera_to_world'].append((trans, rot))
-                
+        # camera to world poses for the whole bag, cached beside the bag so
+        # later extractions don't need to replay tf
+        pose_table = TFPoseTable.from_ros_bag_cached(bag, self.world_frame, self.camera_frame)
 
-            # save the relevant data
-            data['msgs'].append(msg)
-            data['cv_img'].append(cv_img)
-            data['timestamps'].append(msg.header.stamp.to_nsec())
-
-        print "Extracted %d rgb images" %(len(rgb_data['msgs']))
-        print "Extracted %d depth images" %(len(depth_data['msgs']))
-        
-
-        rgb_data['timestamps'] = np.array(rgb_data['timestamps'])
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
 
-        # synchronize the images
-        synchronized_rgb_imgs = []
-        for idx, stamp in enumerate(depth_data['timestamps']):
-            rgb_idx = ImageCapture.lookup_synchronized_image(stamp, rgb_data['timestamps'])
-            synchronized_rgb_imgs.append(rgb_data['cv_img'][rgb_idx])
-            if idx % log_rate == 0:
-                print "depth image %d matched to rgb image %d" %(idx, rgb_idx)
+        log_rate = 100
 
+        # (timestamp, msg) of the most recent rgb images
+        rgb_buffer = collections.deque(maxlen=rgb_buffer_size)
 
-        # save to a file
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
+        # depth images, in order, that are still waiting for a matching rgb image
+        # (timestamp, msg, trans, rot)
+        pending_depth = collections.deque()
 
+        image_writer = ImageWriter(num_threads=num_writer_threads,
+            max_queue_size=4*num_writer_threads, png_compression=png_compression)
 
         pose_data = dict()
+        camera_info_msg = None
+        num_rgb_msgs = 0
+        num_depth_msgs = 0
+        num_unmatched_depth_msgs = 0
 
-        for idx, depth_img in enumerate(depth_data['cv_img']):
-            rgb_img = synchronized_rgb_imgs[idx]
+        def write_synchronized_images(depth_frame, rgb_msg):
+            stamp, depth_msg, trans, rot = depth_frame
+            idx = len(pose_data)
 
             rgb_filename = "%06i_%s.png" % (idx, "rgb")
             rgb_filename_full = os.path.join(output_dir, rgb_filename)
@@ -250,33 +231,87 @@ class ImageCapture(object):
 
             if idx % log_rate == 0:
                 print "writing image %d to file %s" %(idx, rgb_filename)
-            
-            cv2.imwrite(rgb_filename_full, rgb_img)
+
+            rgb_img = self.cv_bridge.imgmsg_to_cv2(rgb_msg, desired_encoding=self.rgb_encoding)
+            image_writer.write(rgb_filename_full, rgb_img)
             if not rgb_only:
-                cv2.imwrite(depth_filename_full, depth_img)
+                depth_img = rosUtils.depth_image_to_cv2_uint16(depth_msg, bridge=self.cv_bridge)
+                image_writer.write(depth_filename_full, depth_img)
 
             pose_data[idx] = dict()
-            d = pose_data[idx] 
-            trans, rot = depth_data['camera_to_world'][idx]
+            d = pose_data[idx]
             quat_wxyz = [rot[3], rot[0], rot[1], rot[2]]
             transform_dict = spartanUtils.dictFromPosQuat(trans, quat_wxyz)
             d['camera_to_world'] = transform_dict
-            d['timestamp'] = depth_data['timestamps'][idx]
+            d['timestamp'] = stamp
             d['rgb_image_filename'] = rgb_filename
             d['depth_image_filename'] = depth_filename
 
+        def write_matched_depth_images():
+            # resolve in order so the image indices follow the depth timestamps
+            while len(pending_depth) > 0:
+                stamp = pending_depth[0][0]
+                rgb_msg = ImageCapture.lookup_buffered_image(stamp, rgb_buffer)
+                if rgb_msg is None:
+                    break
+                write_synchronized_images(pending_depth.popleft(), rgb_msg)
 
+        extraction_done = False
+        try:
+            topics = image_topics + [self.camera_info_topic]
+            counter = 0
+            for topic, msg, t in bag.read_messages(topics=topics):
 
-        spartanUtils.saveToYaml(pose_data, os.path.join(output_dir,'pose_data.yaml'))
+                if topic == self.camera_info_topic:
+                    if camera_info_msg is None:
+                        camera_info_msg = msg
+                    continue
 
-        # extract the camera info msg
+                counter += 1
+                if counter % log_rate == 0:
+                    print "processing image message %d" %(counter)
 
-        camera_info_msg = None
-        for topic, msg, t in bag.read_messages(topics=self.camera_info_topic):
-            camera_info_msg = msg
-            break
+                if "rgb" in topic:
+                    num_rgb_msgs += 1
+                    rgb_buffer.append((msg.header.stamp.to_nsec(), msg))
+                elif "depth" in topic:
+                    # rot ix (x,y,z,w)
+                    camera_to_world = pose_table.lookup_transform(msg.header.stamp)
+                    if camera_to_world is None:
+                        print "wasn't able to get transform for image message %d, skipping" %(counter)
+                        continue
+                    (trans, rot) = camera_to_world
+
+                    num_depth_msgs += 1
+                    pending_depth.append((msg.header.stamp.to_nsec(), msg, trans, rot))
+
+                write_matched_depth_images()
+
+                # the rgb stream stalled, give up on the oldest depth image rather
+                # than holding on to an unbounded number of them
+                if len(pending_depth) > rgb_buffer_size:
+                    stamp = pending_depth.popleft()[0]
+                    num_unmatched_depth_msgs += 1
+                    print "wasn't able to find an rgb image for depth image with timestamp %d, skipping" %(stamp)
+
+            # no rgb image at or after these exists
+            num_unmatched_depth_msgs += len(pending_depth)
+            pending_depth.clear()
+
+            extraction_done = True
+        finally:
+            # all the images need to be on disk before pose_data.yaml refers to them,
+            # and the writer threads have to stop even if the extraction failed. Don't
+            # mask an exception that is already propagating.
+            image_writer.close(raise_errors=extraction_done)
+
+        print "Extracted %d rgb images" %(num_rgb_msgs)
+        print "Extracted %d depth images" %(num_depth_msgs)
+        print "Skipped %d depth images without a matching rgb image" %(num_unmatched_depth_msgs)
 
-        
+        spartanUtils.saveToYaml(pose_data, os.path.join(output_dir,'pose_data.yaml'))
+
+        # extract the camera info msg
         camera_info_dict = rosUtils.camera_info_dict_from_camera_info_msg(camera_info_msg)
         
         # NOTE: currently the batch_extract_and_fuse_all_scenes.py
@@ -297,12 +332,220 @@ class ImageCapture(object):
 
         """
         idx = np.searchsorted(timestamps, query_time)
-        return min(idx, np.size(timestamps))
+        return min(idx, np.size(timestamps) - 1)
+
+    @staticmethod
+    def lookup_buffered_image(query_time, buffered_images):
+        """
+        Parameters:
+            query_time: int
+                the time you want to find a match for
+            buffered_images: iterable of (timestamp, msg)
+
+        Returns the msg with the smallest timestamp >= query_time, None if
+        there isn't one (yet)
+        """
+        match = None
+        for stamp, msg in buffered_images:
+            if stamp >= query_time and (match is None or stamp < match[0]):
+                match = (stamp, msg)
+
+        if match is None:
+            return None
+        return match[1]
+
+
+class OnlineFusion(object):
+    """
+    Fuses the depth images into a TSDF while the scan is running, rather than after
+    the bag has been written and extracted.
+
+    Depth images are queued by the subscriber callback and handled in order on a
+    worker thread. For each image the worker waits for the camera to world transform
+    at its timestamp, skips it unless it passes the pose difference threshold w.r.t.
+    the last fused frame (same rule as the greedy keyframe selection), and otherwise
+    integrates it. Every publish_period seconds the surface points fused so far are
+    handed to publish_callback.
+
+    Example:
+
+        online_fusion = OnlineFusion(depth_topic, camera_info_topic, camera_frame, world_frame, tf_buffer)
+        online_fusion.start()
+        # ... move the robot through the scan ...
+        online_fusion.stop()
+        online_fusion.join()
+        online_fusion.save(output_dir)
+    """
+
+    def __init__(self, depth_topic, camera_info_topic, camera_frame, world_frame, tf_buffer,
+        linear_distance_threshold=0.03, angle_distance_threshold=10, tsdf_fusion_kwargs=None,
+        publish_callback=None, publish_period=2.0, tf_timeout=1.0, max_queue_size=300):
+        """
+        :param: tf_buffer, tf2_ros.Buffer that is listening to /tf
+        :ptype: tf2_ros.Buffer
+
+        :param: angle_distance_threshold, in degrees
+        :ptype: float
+
+        :param: tsdf_fusion_kwargs, voxel grid settings, same keywords as tsdf_fusion.run_tsdf_fusion_numpy
+        :ptype: dict
+
+        :param: publish_callback, called with an (N,3) array of the surface points fused so far
+        :ptype: function
+
+        :param: max_queue_size, depth images waiting for the worker, newer images are dropped
+        when the queue is full
+        :ptype: int
+        """
+        self.depth_topic = depth_topic
+        self.camera_info_topic = camera_info_topic
+        self.camera_frame = camera_frame
+        self.world_frame = world_frame
+        self.tf_buffer = tf_buffer
+        self.linear_distance_threshold = linear_distance_threshold
+        self.angle_distance_threshold = angle_distance_threshold
+        self.publish_callback = publish_callback
+        self.publish_period = publish_period
+        self.tf_timeout = tf_timeout
+
+        self.tsdf_fusion_kwargs = dict(voxel_grid_origin=[0.4, -0.3, -0.2], voxel_size=0.0025,
+            voxel_grid_dim=[240, 320, 280])
+        if tsdf_fusion_kwargs is not None:
+            self.tsdf_fusion_kwargs.update(tsdf_fusion_kwargs)
+
+        self.cv_bridge = CvBridge()
+        self.queue = Queue.Queue(maxsize=max_queue_size)
+        self.subscriber = rosUtils.SimpleSubscriber(self.depth_topic, sensor_msgs.msg.Image,
+            externalCallback=self.onDepthImage)
+
+        self.integrator = None
+        self.worker_thread = None
+
+    def start(self):
+        """
+        Waits for the camera info, then subscribes to the depth images
+        """
+        camera_info_msg = rospy.wait_for_message(self.camera_info_topic, sensor_msgs.msg.CameraInfo, timeout=10.0)
+        K = np.reshape(np.asarray(camera_info_msg.K, dtype=np.float64), (3,3))
+        self.integrator = tsdf_fusion.TSDFIntegrator(K, **self.tsdf_fusion_kwargs)
+
+        self.last_keyframe_pose = None
+        self.keyframe_timestamps = []
+        self.num_depth_msgs = 0
+        self.num_dropped = 0
+        self.num_missing_transform = 0
+        self.last_publish_time = time.time()
+
+        self.worker_thread = threading.Thread(target=self._worker, name="OnlineFusion")
+        self.worker_thread.daemon = True
+        self.worker_thread.start()
+        self.subscriber.start()
+
+    def onDepthImage(self, msg):
+        self.num_depth_msgs += 1
+        try:
+            self.queue.put_nowait(msg)
+        except Queue.Full:
+            self.num_dropped += 1
+
+    def _worker(self):
+        while True:
+            msg = self.queue.get()
+            if msg is None:
+                return
+
+            try:
+                self.process_depth_image(msg)
+
+                if self.publish_callback is not None and time.time() - self.last_publish_time > self.publish_period:
+                    self.last_publish_time = time.time()
+                    self.publish_callback(self.integrator.get_surface_points())
+            except Exception as e:
+                rospy.logerr("online fusion failed on depth image: %s", e)
+
+    def lookup_camera_to_world(self, stamp):
+        """
+        :return: (position, quaternion (w,x,y,z)) of the camera in the world frame, None
+        if the transform isn't available within tf_timeout
+        """
+        try:
+            transform_stamped = self.tf_buffer.lookup_transform(self.world_frame, self.camera_frame, stamp,
+                rospy.Duration(self.tf_timeout))
+        except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+            return None
+
+        pos, quat = rosUtils.poseFromROSTransformMsg(transform_stamped.transform)
+        return np.asarray(pos), np.asarray(quat)
+
+    def is_keyframe(self, position, quaternion):
+        if self.last_keyframe_pose is None:
+            return True
+
+        linear_distance, angle_distance = keyframe_selection.compute_pose_distances(position, quaternion,
+            self.last_keyframe_pose[0], self.last_keyframe_pose[1])
+        return linear_distance > self.linear_distance_threshold or angle_distance > self.angle_distance_threshold
+
+    def process_depth_image(self, msg):
+        """
+        Integrates the depth image if its pose passes the pose difference threshold
+        :return: True if the image was fused
+        """
+        pose = self.lookup_camera_to_world(msg.header.stamp)
+        if pose is None:
+            self.num_missing_transform += 1
+            return False
+
+        position, quaternion = pose
+        if not self.is_keyframe(position, quaternion):
+            return False
+
+        # same millimeter quantization as the extracted depth pngs
+        depth_img = rosUtils.depth_image_to_cv2_uint16(msg, bridge=self.cv_bridge)
+        depth = tsdf_fusion.depth_image_to_meters(depth_img)
+        camera_to_world = spartanUtils.homogenous_transform_from_dict(spartanUtils.dictFromPosQuat(position, quaternion))
+        self.integrator.integrate(depth, camera_to_world)
+
+        self.last_keyframe_pose = pose
+        self.keyframe_timestamps.append(msg.header.stamp.to_nsec())
+        return True
+
+    def stop(self):
+        """
+        Unsubscribes from the depth images, the ones already received are still fused,
+        call join to wait for them
+        """
+        self.subscriber.stop()
+        self.queue.put(None)
+
+    def join(self):
+        """
+        Waits until all the depth images received before stop have been fused
+        """
+        self.worker_thread.join()
+        self.integrator.close()
+
+        print "online fusion received %d depth images, fused %d" %(self.num_depth_msgs, len(self.keyframe_timestamps))
+        if self.num_dropped > 0 or self.num_missing_transform > 0:
+            print "dropped %d depth images, %d had no transform" %(self.num_dropped, self.num_missing_transform)
+
+    def get_surface_points(self):
+        return self.integrator.get_surface_points()
+
+    def save(self, output_dir):
+        """
+        Writes tsdf.bin and fusion_pointcloud.ply to output_dir
+        :return: tsdf.bin filename
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        return self.integrator.save(output_dir)
 
 
 class FusionType:
     ELASTIC_FUSION = 0
     TSDF_FUSION = 1
+    TSDF_FUSION_NUMPY = 2 # cpu only, doesn't need the tsdf-fusion executable
+    TSDF_FUSION_ONLINE = 3 # TSDF_FUSION_NUMPY, but fused during the scan
 
 class FusionServer(object):
 
@@ -311,6 +554,7 @@ class FusionServer(object):
         self.bagging = False
         self.rosbag_proc = None
         self.tfBuffer = None
+        self.extraction_thread = None
         storedPosesFile = os.path.join(spartanUtils.getSpartanSourceDir(), 'src', 'catkin_projects', 'station_config','RLG_iiwa_1','stored_poses.yaml')
         self.storedPoses = spartanUtils.getDictFromYamlFilename(storedPosesFile)
         self.robotService = rosUtils.RobotService(self.storedPoses['header']['joint_names'])
@@ -351,6 +595,15 @@ class FusionServer(object):
 
         self.config['fusion_type'] = FusionType.TSDF_FUSION
 
+        # pose difference threshold used to downsample the image folder, and to
+        # select the frames to fuse with FusionType.TSDF_FUSION_ONLINE
+        self.config['downsample'] = dict()
+        self.config['downsample']['linear_distance_threshold'] = 0.03
+        self.config['downsample']['angle_distance_threshold'] = 10 # in degrees
+
+        # period in seconds at which the partial reconstruction is published during online fusion
+        self.config['online_fusion_publish_period'] = 2.0
+
         self.topics_to_bag = [
             "/tf",
             "/tf_static",
@@ -508,9 +761,8 @@ class FusionServer(object):
 
     def convert_ply_to_pointcloud2(self, plydata):
 
-        cloud_arr = np.zeros((len(plydata.elements[0].data), 3))
-        for i in xrange(len(plydata.elements[0].data)):
-            cloud_arr[i] = list(plydata.elements[0].data[i])[:3]
+        vertex_data = plydata.elements[0].data
+        cloud_arr = np.column_stack([vertex_data[name] for name in vertex_data.dtype.names[:3]])
 
         return array_to_xyz_pointcloud2f(cloud_arr)
 
@@ -556,7 +808,7 @@ class FusionServer(object):
                                                   maxJointDegreesPerSecond=self.config['speed']['scan'])
             rospy.sleep(self.config['sleep_time_at_each_pose'])
 
-    def capture_scene(self):
+    def capture_scene(self, online_fusion=None):
         """
         This "moves around and captures all of the data needed for fusion". I.e., it:
 
@@ -568,6 +820,10 @@ class FusionServer(object):
 
         This is not a service handler itself, but intended to be modularly called by service handlers.
 
+        :param: online_fusion, if not None it is started together with the bagging and stopped
+        at the end of the scan, the depth images are fused while the robot is moving
+        :ptype: OnlineFusion
+
         :return: bag_filepath, the full path to where the rosbag (fusion-*.bag) was saved
         :rtype: string
 
@@ -588,9 +844,15 @@ class FusionServer(object):
         except rospy.ServiceException, e:
             print "Service call failed: %s"%e
 
+        if online_fusion is not None:
+            online_fusion.start()
+
         # Move robot
         self.move_robot_through_scan_poses()
 
+        if online_fusion is not None:
+            online_fusion.stop()
+
         # Stop bagging with own srv call
         try:
             stop_bagging_fusion_data = rospy.ServiceProxy('stop_bagging_fusion_data', StopBaggingFusionData)
@@ -621,9 +883,8 @@ class FusionServer(object):
         depth_topic = self.topics_dict['depth']
         camera_info_topic = self.topics_dict['camera_info']
 
-        log_dir = os.path.dirname(os.path.dirname(bag_filepath))
-        processed_dir = os.path.join(log_dir, 'processed')
-        images_dir = os.path.join(processed_dir, save_folder_name)
+        processed_dir = self.get_processed_dir(bag_filepath)
+        images_dir = os.path.join(processed_dir, 'images')
 
         if rgb_only:
             images_dir = os.path.join(processed_dir, 'images')
@@ -649,9 +910,115 @@ class FusionServer(object):
         rospy.loginfo("handle_capture_scene finished!")
         return response
 
+    def get_processed_dir(self, bag_filepath):
+        log_dir = os.path.dirname(os.path.dirname(bag_filepath))
+        return os.path.join(log_dir, 'processed')
+
+    def downsample_images_dir(self, images_dir):
+        linear_distance_threshold = self.config['downsample']['linear_distance_threshold']
+        angle_distance_threshold = self.config['downsample']['angle_distance_threshold']
+        FusionServer.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold)
+
+    def extract_and_downsample_data_from_rosbag(self, bag_filepath):
+        """
+        Extracts and downsamples the images, then writes the IMAGES_READY_FILENAME marker
+        to the processed dir so that readers of the data folder know they are complete
+        """
+        processed_dir, images_dir = self.extract_data_from_rosbag(bag_filepath)
+        print "downsampling image folder"
+        self.downsample_images_dir(images_dir)
+
+        open(os.path.join(processed_dir, IMAGES_READY_FILENAME), 'w').close()
+        rospy.loginfo("images in %s are ready", processed_dir)
+
+    def wait_for_extraction(self):
+        """
+        Blocks until the images of the last online capture have been extracted
+        """
+        if self.extraction_thread is None:
+            return
+
+        print "waiting for the previous image extraction to finish"
+        self.extraction_thread.join()
+        self.extraction_thread = None
+
+    def get_world_frame_transform_stamped(self):
+        """
+        Identity transform to the world frame, for point clouds that are already
+        in world coordinates
+        """
+        transform_stamped = geometry_msgs.msg.TransformStamped()
+        transform_stamped.header.frame_id = self.config['world_frame']
+        transform_stamped.transform.rotation.w = 1.0
+        return transform_stamped
+
+    def publish_points_to_rviz(self, points):
+        """
+        Publishes an (N,3) array of world frame points to rviz
+        """
+        self.publish_pointcloud_to_rviz(array_to_xyz_pointcloud2f(points), self.get_world_frame_transform_stamped())
+
+    def make_online_fusion(self):
+        return OnlineFusion(self.topics_dict['depth'], self.topics_dict['camera_info'],
+            self.config['camera_frame'], self.config['world_frame'], self.tfBuffer,
+            linear_distance_threshold=self.config['downsample']['linear_distance_threshold'],
+            angle_distance_threshold=self.config['downsample']['angle_distance_threshold'],
+            publish_callback=self.publish_points_to_rviz,
+            publish_period=self.config['online_fusion_publish_period'])
+
+    def capture_scene_and_fuse_online(self):
+        """
+        Fuses the depth images while the robot is scanning, see OnlineFusion. The mesh is
+        ready as soon as the last depth images have been fused, the bag is still recorded
+        and the images are extracted from it and downsampled in a background thread.
+
+        The response is returned before that thread finishes, so the images in
+        fusion_output.data_folder arrive later, the IMAGES_READY_FILENAME marker is written
+        there once they are complete. The next capture waits for the thread first.
+
+        :return: CaptureSceneAndFuseResponse
+        """
+        self.wait_for_extraction()
+
+        online_fusion = self.make_online_fusion()
+        bag_filepath = self.capture_scene(online_fusion=online_fusion)
+
+        print "waiting for online fusion to finish"
+        online_fusion.join()
+
+        processed_dir = self.get_processed_dir(bag_filepath)
+        tsdf_bin_filename = online_fusion.save(processed_dir)
+
+        print "converting tsdf to ply"
+        tsdf_mesh_filename = os.path.join(processed_dir, 'fusion_mesh.ply')
+        tsdf_fusion.convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename)
+
+        # the surface points are in the world frame
+        fusion_output = fusion_server.msg.FusionOutput()
+        fusion_output.data_folder = processed_dir
+        fusion_output.pointcloud_filepath = os.path.join(processed_dir, 'fusion_pointcloud.ply')
+        fusion_output.point_cloud = array_to_xyz_pointcloud2f(online_fusion.get_surface_points())
+        fusion_output.point_cloud_to_world_stamped = self.get_world_frame_transform_stamped()
+
+        self.cache['fusion_output'] = fusion_output
+        self.cache['point_cloud_to_world_stamped'] = fusion_output.point_cloud_to_world_stamped
+        self.publish_pointcloud_to_rviz(fusion_output.point_cloud, fusion_output.point_cloud_to_world_stamped)
+
+        # the images aren't needed for the mesh, don't make the caller wait for them
+        self.extraction_thread = threading.Thread(target=self.extract_and_downsample_data_from_rosbag,
+            args=(bag_filepath,), name="extract_data_from_rosbag")
+        self.extraction_thread.start()
+
+        rospy.loginfo("handle_capture_scene_and_fuse finished, the images in %s arrive later, %s is written there once they are ready",
+            processed_dir, IMAGES_READY_FILENAME)
+        return CaptureSceneAndFuseResponse(fusion_output)
+
     def handle_capture_scene_and_fuse(self, req):
         print "handling capture_scene_and_fuse"
 
+        if self.config['fusion_type'] == FusionType.TSDF_FUSION_ONLINE:
+            return self.capture_scene_and_fuse_online()
+
         # Capture scene
         bag_filepath = self.capture_scene()
 
@@ -674,13 +1041,17 @@ class FusionServer(object):
 
             response = CaptureSceneAndFuseResponse(elastic_fusion_output)
             
-        elif self.config['fusion_type'] == FusionType.TSDF_FUSION:
+        elif self.config['fusion_type'] in (FusionType.TSDF_FUSION, FusionType.TSDF_FUSION_NUMPY):
 
-            print "formatting data for tsdf fusion"
-            tsdf_fusion.format_data_for_tsdf(images_dir)
+            if self.config['fusion_type'] == FusionType.TSDF_FUSION:
+                print "formatting data for tsdf fusion"
+                tsdf_fusion.format_data_for_tsdf(images_dir)
 
-            print "running tsdf fusion"
-            tsdf_fusion.run_tsdf_fusion_cuda(images_dir)
+                print "running tsdf fusion"
+                tsdf_fusion.run_tsdf_fusion_cuda(images_dir)
+            else:
+                print "running tsdf fusion"
+                tsdf_fusion.run_tsdf_fusion_numpy(images_dir)
 
             print "converting tsdf to ply"
             tsdf_bin_filename = os.path.join(processed_dir, 'tsdf.bin')
@@ -696,9 +1067,7 @@ class FusionServer(object):
 
         # downsample data (this should be specifiable by an arg)
         print "downsampling image folder"
-        linear_distance_threshold = 0.03
-        angle_distance_threshold = 10 # in degrees
-        FusionServer.downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold)
+        self.downsample_images_dir(images_dir)
 
 
         rospy.loginfo("handle_capture_scene_and_fuse finished!")
@@ -759,83 +1128,23 @@ class FusionServer(object):
 
 
     @staticmethod
-    def downsample_by_pose_difference_threshold(images_dir_full_path, linear_distance_threshold, rotation_angle_threshold):
+    def downsample_by_pose_difference_threshold(images_dir_full_path, linear_distance_threshold, rotation_angle_threshold,
+        method='greedy'):
         """
-        Downsamples poses and keeps only those that are sufficiently apart
+        Downsamples poses and keeps only those that are sufficiently apart. The kept frames
+        are written to a keyframe index (keyframes.yaml) in the images folder, the images
+        themselves aren't touched, see fusion_server.keyframe_selection
         :param images_dir_full_path:
         :type images_dir_full_path:
         :param linear_distance_threshold: threshold on the translation, in meters
         :type linear_distance_threshold:
         :param rotation_angle_threshold: threshold on the angle between the rotations, in degrees
         :type rotation_angle_threshold:
-        :return:
+        :param method: 'greedy' or 'coverage'
+        :type method: str
+        :return: list of kept frames
         :rtype:
         """
-        pose_yaml = os.path.join(images_dir_full_path, "pose_data.yaml")
-        pose_dict = spartanUtils.getDictFromYamlFilename(pose_yaml)
-
-        images_dir_temp_path = os.path.join(os.path.dirname(images_dir_full_path), 'images_temp')
-        if not os.path.isdir(images_dir_temp_path):
-            os.makedirs(images_dir_temp_path)
-        
-        
-        previous_pose_pos = FusionServer.get_numpy_position_from_pose(pose_dict[0])
-        previous_pose_quat = FusionServer.get_quaternion_from_pose(pose_dict[0])
-
         print "Using downsampling by pose difference threshold... "
-        print "Previously: ", len(pose_dict), " images"
-
-        num_kept_images    = 0
-        num_deleted_images = 0
-
-        for i in range(0,len(pose_dict)):
-            single_frame_data = pose_dict[i]
-            this_pose_pos = FusionServer.get_numpy_position_from_pose(pose_dict[i])
-            this_pose_quat = FusionServer.get_quaternion_from_pose(pose_dict[i])
-
-            linear_distance = np.linalg.norm(this_pose_pos - previous_pose_pos)
-
-            rotation_distance = spartanUtils.compute_angle_between_quaternions(this_pose_quat,
-                previous_pose_quat)
-
-
-            if i == 0:
-                keep_image = True
-                num_kept_images += 1
-            elif (linear_distance > linear_distance_threshold) or (np.rad2deg(rotation_distance) > rotation_angle_threshold):
-                previous_pose_pos = this_pose_pos
-                previous_pose_quat = this_pose_quat
-                num_kept_images += 1
-            else:
-                # delete pose from forward kinematics
-                del pose_dict[i]
-                continue
-
-            # if we have gotten here, then move the images over to the new directory
-
-            rgb_filename = os.path.join(images_dir_full_path, single_frame_data['rgb_image_filename'])
-            rgb_filename_temp = os.path.join(images_dir_temp_path, single_frame_data['rgb_image_filename'])
-
-            shutil.move(rgb_filename, rgb_filename_temp)
-
-            depth_filename = os.path.join(images_dir_full_path, single_frame_data['depth_image_filename'])
-            depth_filename_temp = os.path.join(images_dir_temp_path, single_frame_data['depth_image_filename'])
-            shutil.move(depth_filename, depth_filename_temp)
-                # # delete pose from posegraph
-                # del posegraph_list[i-num_deleted_images]
-                # num_deleted_images += 1
-
-        
-        # write downsamples pose_data.yaml (forward kinematics)
-        spartanUtils.saveToYaml(pose_dict, os.path.join(images_dir_temp_path,'pose_data.yaml'))
-
-        # remove old images
-        shutil.move(os.path.join(images_dir_full_path, 'camera_info.yaml'), os.path.join(images_dir_temp_path, 'camera_info.yaml'))
-        shutil.rmtree(images_dir_full_path)
-
-        print "renaming %s to %s " %(images_dir_temp_path, images_dir_full_path)
-
-        # rename temp images to images
-        os.rename(images_dir_temp_path, images_dir_full_path)
-
-        print "After: ", num_kept_images, " images"
+        return keyframe_selection.downsample_by_pose_difference_threshold(images_dir_full_path,
+            linear_distance_threshold, rotation_angle_threshold, method=method)
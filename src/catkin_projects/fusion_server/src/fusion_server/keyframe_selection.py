@@ -0,0 +1,196 @@
+#!/usr/bin/python
+"""
+Keyframe selection for the extracted image folders.
+
+Instead of moving the images of the kept frames into a new folder, the
+selection is written to a small index file (keyframes.yaml) next to
+pose_data.yaml. Code that reads an image folder should go through
+load_pose_data, which only returns the keyframes if an index exists.
+"""
+
+import os
+import numpy as np
+
+import spartan.utils.utils as spartanUtils
+
+
+KEYFRAME_INDEX_FILENAME = "keyframes.yaml"
+
+
+def get_positions_and_quaternions(pose_data):
+    """
+    :param pose_data: dict idx -> pose, as in pose_data.yaml
+    :return: sorted idx list, positions (N,3), quaternions (N,4) (w,x,y,z)
+    """
+    indices = sorted(pose_data.keys())
+    positions = np.zeros((len(indices), 3))
+    quaternions = np.zeros((len(indices), 4))
+    for i, idx in enumerate(indices):
+        camera_to_world = pose_data[idx]['camera_to_world']
+        translation = camera_to_world['translation']
+        quat = spartanUtils.getQuaternionFromDict(camera_to_world)
+        positions[i] = [translation['x'], translation['y'], translation['z']]
+        quaternions[i] = [quat['w'], quat['x'], quat['y'], quat['z']]
+
+    return indices, positions, quaternions
+
+
+def compute_angle_between_quaternions(q, r):
+    """
+    Vectorized version of spartanUtils.compute_angle_between_quaternions, broadcasts
+    over the leading dimensions of q (...,4) and r (...,4)
+    :return: angle in radians
+    """
+    d = np.sum(q*r, axis=-1)
+    return 2*np.arccos(np.clip(2*d**2 - 1, -1.0, 1.0))
+
+
+def compute_pose_distances(positions, quaternions, reference_position, reference_quaternion):
+    """
+    :return: linear distances (N,) in meters and rotation distances (N,) in degrees
+    from every pose to the reference pose
+    """
+    linear_distance = np.linalg.norm(positions - reference_position, axis=-1)
+    angle_distance = np.rad2deg(compute_angle_between_quaternions(quaternions, reference_quaternion))
+    return linear_distance, angle_distance
+
+
+def select_keyframes_greedy(positions, quaternions, linear_distance_threshold, angle_distance_threshold):
+    """
+    Walks through the poses in order and keeps a pose if it is further than either
+    threshold from the last kept pose. The first pose is always kept. Same result
+    as the original FusionServer.downsample_by_pose_difference_threshold, but each step
+    jumps straight to the next keyframe with a single vectorized comparison.
+
+    :param angle_distance_threshold: in degrees
+    :return: array of positions into the pose arrays
+    """
+    num_poses = len(positions)
+    if num_poses == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    keyframes = [0]
+    while True:
+        last = keyframes[-1]
+        linear_distance, angle_distance = compute_pose_distances(positions[last+1:], quaternions[last+1:],
+                                                                 positions[last], quaternions[last])
+        far = (linear_distance > linear_distance_threshold) | (angle_distance > angle_distance_threshold)
+        if not np.any(far):
+            break
+        keyframes.append(last + 1 + int(np.argmax(far)))
+
+    return np.array(keyframes, dtype=np.int64)
+
+
+def select_keyframes_coverage(positions, quaternions, linear_distance_threshold, angle_distance_threshold):
+    """
+    Picks a small set of keyframes such that every pose is within both thresholds of
+    some keyframe (greedy set cover). Unlike the greedy selection this doesn't depend on
+    the order the poses were visited in, revisiting the same viewpoint doesn't add
+    keyframes.
+
+    :param angle_distance_threshold: in degrees
+    :return: sorted array of positions into the pose arrays
+    """
+    num_poses = len(positions)
+    if num_poses == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # covers[i,j] is True if keyframe i would cover pose j
+    linear_distance, angle_distance = compute_pose_distances(positions[:, np.newaxis], quaternions[:, np.newaxis],
+                                                             positions[np.newaxis], quaternions[np.newaxis])
+    covers = (linear_distance <= linear_distance_threshold) & (angle_distance <= angle_distance_threshold)
+
+    uncovered = np.ones(num_poses, dtype=bool)
+    keyframes = []
+    while np.any(uncovered):
+        # ties go to the earliest pose
+        num_covered = np.sum(covers[:, uncovered], axis=1)
+        best = int(np.argmax(num_covered))
+        keyframes.append(best)
+        uncovered &= ~covers[best]
+
+    return np.sort(np.array(keyframes, dtype=np.int64))
+
+
+KEYFRAME_SELECTION_METHODS = {'greedy': select_keyframes_greedy,
+                              'coverage': select_keyframes_coverage}
+
+
+def select_keyframes(pose_data, linear_distance_threshold, angle_distance_threshold, method='greedy'):
+    """
+    :param pose_data: dict idx -> pose, as in pose_data.yaml
+    :param angle_distance_threshold: in degrees
+    :return: sorted list of the pose_data keys that were kept
+    """
+    if method not in KEYFRAME_SELECTION_METHODS:
+        raise ValueError("keyframe selection method must be one of " + ", ".join(sorted(KEYFRAME_SELECTION_METHODS.keys())))
+
+    indices, positions, quaternions = get_positions_and_quaternions(pose_data)
+    keyframes = KEYFRAME_SELECTION_METHODS[method](positions, quaternions, linear_distance_threshold,
+                                                    angle_distance_threshold)
+    return [indices[i] for i in keyframes]
+
+
+def get_keyframe_index_filename(images_dir):
+    return os.path.join(images_dir, KEYFRAME_INDEX_FILENAME)
+
+
+def save_keyframe_index(images_dir, keyframes, **kwargs):
+    """
+    Writes the kept frames, plus whatever settings were passed in kwargs,
+    to keyframes.yaml in images_dir
+    """
+    d = dict(kwargs)
+    d['keyframes'] = [int(idx) for idx in keyframes]
+    spartanUtils.saveToYaml(d, get_keyframe_index_filename(images_dir))
+
+
+def load_keyframe_index(images_dir):
+    """
+    :return: list of kept frames, None if the folder hasn't been downsampled
+    """
+    filename = get_keyframe_index_filename(images_dir)
+    if not os.path.exists(filename):
+        return None
+    return spartanUtils.getDictFromYamlFilename(filename)['keyframes']
+
+
+def has_keyframe_index(images_dir):
+    return os.path.exists(get_keyframe_index_filename(images_dir))
+
+
+def load_pose_data(images_dir, use_keyframe_index=True):
+    """
+    Reads pose_data.yaml, restricted to the keyframes if the folder has a keyframe index
+    :param use_keyframe_index: if False always return all the frames
+    :return: dict idx -> pose
+    """
+    pose_data = spartanUtils.getDictFromYamlFilename(os.path.join(images_dir, "pose_data.yaml"))
+    if not use_keyframe_index:
+        return pose_data
+
+    keyframes = load_keyframe_index(images_dir)
+    if keyframes is None:
+        return pose_data
+
+    return dict((idx, pose_data[idx]) for idx in keyframes)
+
+
+def downsample_by_pose_difference_threshold(images_dir, linear_distance_threshold, angle_distance_threshold,
+                                            method='greedy'):
+    """
+    Selects keyframes from all the frames in images_dir and writes the keyframe index,
+    no images are moved or deleted. Running it again replaces the previous index.
+
+    :param angle_distance_threshold: in degrees
+    :return: list of kept frames
+    """
+    pose_data = load_pose_data(images_dir, use_keyframe_index=False)
+    keyframes = select_keyframes(pose_data, linear_distance_threshold, angle_distance_threshold, method=method)
+    save_keyframe_index(images_dir, keyframes, method=method, linear_distance_threshold=linear_distance_threshold,
+                        angle_distance_threshold=angle_distance_threshold, num_frames=len(pose_data))
+
+    print "Previously: ", len(pose_data), " images"
+    print "After: ", len(keyframes), " images"
+    return keyframes
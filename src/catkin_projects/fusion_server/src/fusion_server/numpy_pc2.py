@@ -118,29 +118,53 @@ def arr_to_fields(cloud_arr):
         fields.append(pf)
     return fields
 
+# cache of numpy dtypes, keyed on the point layout of the message
+_dtype_cache = dict()
+
+def get_pointcloud2_dtype(cloud_msg, remove_padding=True):
+    '''Returns the numpy record datatype for the points of this cloud, cached per field layout
+    so that a stream of clouds with the same layout only builds it once.
+
+    With remove_padding the dtype only has the named fields, at their offsets, with the
+    itemsize set to the point step. Otherwise the padding shows up as dummy uint8 fields.
+    '''
+    key = (tuple((f.name, f.offset, f.datatype, f.count) for f in cloud_msg.fields), cloud_msg.point_step,
+           bool(cloud_msg.is_bigendian), remove_padding)
+    dtype = _dtype_cache.get(key)
+    if dtype is not None:
+        return dtype
+
+    byte_order = '>' if cloud_msg.is_bigendian else '<'
+    if remove_padding:
+        dtype = np.dtype({'names': [f.name for f in cloud_msg.fields],
+                          'formats': [pftype_to_nptype[f.datatype].newbyteorder(byte_order) for f in cloud_msg.fields],
+                          'offsets': [f.offset for f in cloud_msg.fields],
+                          'itemsize': cloud_msg.point_step})
+    else:
+        dtype = np.dtype([(name, np.dtype(t).newbyteorder(byte_order)) for name, t in pointcloud2_to_dtype(cloud_msg)])
+
+    _dtype_cache[key] = dtype
+    return dtype
+
 def pointcloud2_to_array(cloud_msg, split_rgb=False, remove_padding=True):
     ''' Converts a rospy PointCloud2 message to a numpy recordarray
 
     Reshapes the returned array to have shape (height, width), even if the height is 1.
 
-    The reason for using np.fromstring rather than struct.unpack is speed... especially
-    for large point clouds, this will be <much> faster.
+    The array is a view straight over cloud_msg.data, nothing is copied (so it is read
+    only if cloud_msg.data is). Padding at the end of each row is skipped using strides.
     '''
     # construct a numpy record type equivalent to the point type of this cloud
-    dtype_list = pointcloud2_to_dtype(cloud_msg)
+    dtype = get_pointcloud2_dtype(cloud_msg, remove_padding=remove_padding)
 
     # parse the cloud into an array
-    cloud_arr = np.fromstring(cloud_msg.data, dtype_list)
-
-    # remove the dummy fields that were added
-    if remove_padding:
-        cloud_arr = cloud_arr[
-            [fname for fname, _type in dtype_list if not (fname[:len(DUMMY_FIELD_PREFIX)] == DUMMY_FIELD_PREFIX)]]
+    cloud_arr = np.ndarray(shape=(cloud_msg.height, cloud_msg.width), dtype=dtype, buffer=cloud_msg.data,
+                           strides=(cloud_msg.row_step, cloud_msg.point_step))
 
     if split_rgb:
         cloud_arr = split_rgb_field(cloud_arr)
 
-    return np.reshape(cloud_arr, (cloud_msg.height, cloud_msg.width))
+    return cloud_arr
 
 def array_to_xyz_pointcloud2f(cloud_arr, stamp=None, frame_id=None, merge_rgb=False):
     """ convert an Nx3 float array to an xyz point cloud.
@@ -229,6 +253,21 @@ def array_to_pointcloud2(cloud_arr, stamp=None, frame_id=None, merge_rgb=False):
     cloud_msg.data = cloud_arr.tostring()
     return cloud_msg
 
+def get_field_bytes(cloud_arr, field_name):
+    '''Returns a uint8 view, shape cloud_arr.shape + (field size,), of the raw bytes of
+    one field. No copy, writing to it writes to cloud_arr.
+    '''
+    field_type, field_offset = cloud_arr.dtype.fields[field_name][:2]
+    bytes_dtype = np.dtype({'names': ['bytes'], 'formats': [(np.uint8, (field_type.itemsize,))],
+                            'offsets': [field_offset], 'itemsize': cloud_arr.dtype.itemsize})
+    return cloud_arr.view(bytes_dtype)['bytes']
+
+def get_rgb_view(cloud_arr):
+    '''Returns a (..., 3) uint8 view of the r, g and b channels packed in the float32 'rgb'
+    field, no copy. The packed value is (r << 16) | (g << 8) | b, little endian.
+    '''
+    return get_field_bytes(cloud_arr, 'rgb')[..., 2::-1]
+
 def merge_rgb_fields(cloud_arr):
     '''Takes an array with named np.uint8 fields 'r', 'g', and 'b', and returns an array in
     which they have been merged into a single np.float32 'rgb' field. The first byte of this
@@ -236,31 +275,26 @@ def merge_rgb_fields(cloud_arr):
 
     This is the way that pcl likes to handle RGB colors for some reason.
     '''
-    r = np.asarray(cloud_arr['r'], dtype=np.uint32)
-    g = np.asarray(cloud_arr['g'], dtype=np.uint32)
-    b = np.asarray(cloud_arr['b'], dtype=np.uint32)
-    rgb_arr = np.array((r << 16) | (g << 8) | (b << 0), dtype=np.uint32)
-
-    # not sure if there is a better way to do this. i'm changing the type of the array
-    # from uint32 to float32, but i don't want any conversion to take place -jdb
-    rgb_arr.dtype = np.float32
-
     # create a new array, without r, g, and b, but with rgb float32 field
     new_dtype = []
     for field_name in cloud_arr.dtype.names:
-        field_type, field_offset = cloud_arr.dtype.fields[field_name]
+        field_type, field_offset = cloud_arr.dtype.fields[field_name][:2]
         if field_name not in ('r', 'g', 'b'):
             new_dtype.append((field_name, field_type))
     new_dtype.append(('rgb', np.float32))
-    new_cloud_arr = np.zeros(cloud_arr.shape, new_dtype)
+    new_cloud_arr = np.empty(cloud_arr.shape, new_dtype)
 
-    # fill in the new array
+    # fill in the new array, the colors are written straight into the bytes of the rgb field
     for field_name in new_cloud_arr.dtype.names:
-        if field_name == 'rgb':
-            new_cloud_arr[field_name] = rgb_arr
-        else:
+        if field_name != 'rgb':
             new_cloud_arr[field_name] = cloud_arr[field_name]
 
+    rgb_bytes = get_field_bytes(new_cloud_arr, 'rgb')
+    rgb_bytes[..., 2] = cloud_arr['r']
+    rgb_bytes[..., 1] = cloud_arr['g']
+    rgb_bytes[..., 0] = cloud_arr['b']
+    rgb_bytes[..., 3] = 0
+
     return new_cloud_arr
 
 def split_rgb_field(cloud_arr):
@@ -269,51 +303,70 @@ def split_rgb_field(cloud_arr):
 
     (pcl stores rgb in packed 32 bit floats)
     '''
-    rgb_arr = cloud_arr['rgb'].copy()
-    rgb_arr.dtype = np.uint32
-    r = np.asarray((rgb_arr >> 16) & 255, dtype=np.uint8)
-    g = np.asarray((rgb_arr >> 8) & 255, dtype=np.uint8)
-    b = np.asarray(rgb_arr & 255, dtype=np.uint8)
+    rgb = get_rgb_view(cloud_arr)
 
     # create a new array, without rgb, but with r, g, and b fields
     new_dtype = []
     for field_name in cloud_arr.dtype.names:
-        field_type, field_offset = cloud_arr.dtype.fields[field_name]
+        field_type, field_offset = cloud_arr.dtype.fields[field_name][:2]
         if not field_name == 'rgb':
             new_dtype.append((field_name, field_type))
     new_dtype.append(('r', np.uint8))
     new_dtype.append(('g', np.uint8))
     new_dtype.append(('b', np.uint8))
-    new_cloud_arr = np.zeros(cloud_arr.shape, new_dtype)
+    new_cloud_arr = np.empty(cloud_arr.shape, new_dtype)
 
     # fill in the new array
     for field_name in new_cloud_arr.dtype.names:
         if field_name == 'r':
-            new_cloud_arr[field_name] = r
+            new_cloud_arr[field_name] = rgb[..., 0]
         elif field_name == 'g':
-            new_cloud_arr[field_name] = g
+            new_cloud_arr[field_name] = rgb[..., 1]
         elif field_name == 'b':
-            new_cloud_arr[field_name] = b
+            new_cloud_arr[field_name] = rgb[..., 2]
         else:
             new_cloud_arr[field_name] = cloud_arr[field_name]
     return new_cloud_arr
 
+def get_xyz_view(cloud_array):
+    '''Returns a (..., 3) float32 view of the x, y and z fields, without copying. Requires
+    x, y and z to be consecutive float32 fields (the usual layout), returns None otherwise.
+    '''
+    fields = cloud_array.dtype.fields
+    if not all(name in fields for name in ('x', 'y', 'z')):
+        return None
+
+    x_type, x_offset = fields['x'][:2]
+    float32 = np.dtype(np.float32)
+    for i, name in enumerate(('x', 'y', 'z')):
+        field_type, field_offset = fields[name][:2]
+        if field_type != float32 or field_offset != x_offset + 4*i:
+            return None
+
+    xyz_dtype = np.dtype({'names': ['xyz'], 'formats': [(np.float32, (3,))], 'offsets': [x_offset],
+                          'itemsize': cloud_array.dtype.itemsize})
+    return cloud_array.view(xyz_dtype)['xyz']
+
 def get_xyz_points(cloud_array, remove_nans=True, dtype=np.float):
     '''Pulls out x, y, and z columns from the cloud recordarray, and returns
-    a 3xN matrix.
+    a Nx3 matrix.
+
+    If dtype is float32 and remove_nans is False this is a view into cloud_array, no copy.
     '''
-    # remove crap points
+    points = get_xyz_view(cloud_array)
+    if points is None:
+        # pull out x, y, and z values
+        points = np.empty(list(cloud_array.shape) + [3], dtype=dtype)
+        points[...,0] = cloud_array['x']
+        points[...,1] = cloud_array['y']
+        points[...,2] = cloud_array['z']
+
+    # remove crap points, one mask for all three coordinates
     if remove_nans:
-        mask = np.isfinite(cloud_array['x']) & np.isfinite(cloud_array['y']) & np.isfinite(cloud_array['z'])
-        cloud_array = cloud_array[mask]
-
-    # pull out x, y, and z values
-    points = np.zeros(list(cloud_array.shape) + [3], dtype=dtype)
-    points[...,0] = cloud_array['x']
-    points[...,1] = cloud_array['y']
-    points[...,2] = cloud_array['z']
+        mask = np.isfinite(points).all(axis=-1)
+        points = points[mask]
 
-    return points
+    return points.astype(dtype, copy=False)
 
-def pointcloud2_to_xyz_array(cloud_msg, remove_nans=True):
-    return get_xyz_points(pointcloud2_to_array(cloud_msg))
+def pointcloud2_to_xyz_array(cloud_msg, remove_nans=True, dtype=np.float):
+    return get_xyz_points(pointcloud2_to_array(cloud_msg), remove_nans=remove_nans, dtype=dtype)
@@ -8,9 +8,13 @@ import yaml
 import time
 from skimage import measure
 from plyfile import PlyData, PlyElement
-import array
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import cv2
 
 import spartan.utils.utils as spartan_utils
+from fusion_server.tsdf_volume import TSDFVolume
+import fusion_server.keyframe_selection as keyframe_selection
 
 
 def format_data_for_tsdf(image_folder):
@@ -40,14 +44,10 @@ def format_data_for_tsdf(image_folder):
 
     ### HANDLE POSES
 
-    pose_data_yaml = os.path.join(image_folder, "pose_data.yaml")
-    with open(pose_data_yaml, 'r') as stream:
-        try:
-            pose_data_dict = yaml.load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
+    # only the keyframes if the folder has been downsampled
+    pose_data_dict = keyframe_selection.load_pose_data(image_folder)
 
-    print pose_data_dict[0]
+    print pose_data_dict[min(pose_data_dict)]
 
     for i in pose_data_dict:
         # print i
@@ -123,102 +123,363 @@ def run_tsdf_fusion_cuda(image_folder, output_dir=None, voxel_grid_origin_x=0.4,
 
 
 
-def convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename):
+def get_camera_intrinsics_matrix(image_folder):
     """
-    Converts the tsdf binary file to a mesh file in ply format
+    Reads the 3x3 camera matrix K from camera_info.yaml
+    """
+    camera_info_yaml = os.path.join(image_folder, "camera_info.yaml")
+    camera_info = spartan_utils.getDictFromYamlFilename(camera_info_yaml)
+    return np.reshape(np.asarray(camera_info['camera_matrix']['data'], dtype=np.float64), (3,3))
 
-    The indexing in the tsdf is
-    (x,y,z) <--> (x + y * dim_x + z * dim_x * dim_y)
+
+def read_depth_image(depth_image_filename, max_depth=6.0):
     """
-    start_time = time.time()
-    fin = open(tsdf_bin_filename, "rb")
+    Reads a uint16 depth png (millimeters) and returns depth in meters, readings
+    beyond max_depth are set to zero (invalid), same as the tsdf-fusion executable
+    """
+    depth = cv2.imread(depth_image_filename, cv2.IMREAD_ANYDEPTH)
+    if depth is None:
+        raise IOError("couldn't read depth image %s" %(depth_image_filename))
 
-    tsdfHeader = array.array("f")  # f is the typecode for float32
-    tsdfHeader.fromfile(fin, 8)
-    # print tsdfHeader
-    # print type(tsdfHeader)
+    return depth_image_to_meters(depth, max_depth=max_depth)
 
-    voxelGridDim = tsdfHeader[0:3]
-    voxelGridDim = np.asarray(voxelGridDim, dtype=np.int)
-    voxelGridOrigin = tsdfHeader[3:6]
-    voxelSize = tsdfHeader[6]
-    truncMargin = tsdfHeader[7]
 
-    dim_x = voxelGridDim[0]
-    dim_y = voxelGridDim[1]
-    dim_z = voxelGridDim[2]
+def depth_image_to_meters(depth, max_depth=6.0):
+    """
+    Converts a uint16 depth image (millimeters) to depth in meters, readings
+    beyond max_depth are set to zero (invalid)
+    """
+    depth = depth.astype(np.float32)/1000.0
+    depth[depth > max_depth] = 0
+    return depth
 
 
-    headerSize = 8
-    tsdf_vec = np.fromfile(tsdf_bin_filename, np.float32)
-    tsdf_vec = tsdf_vec[headerSize:]
-    tsdf = np.reshape(tsdf_vec, voxelGridDim, order='F') # reshape using Fortran order
+def integrate_depth_image_into_slab(tsdf_slab, weight_slab, z_start, depth, K, world_to_camera,
+    voxel_grid_origin, voxel_size, trunc_margin):
+    """
+    Integrates a single depth image into a slab of the voxel grid, in place.
 
-    # for loop version of the above reshape operation
-    # for x in xrange(0, dim_x):
-    #     for y in xrange(0, dim_y):
-    #         for z in xrange(0, dim_z):
-    #             idx = x + y * dim_x + z * dim_x * dim_y
-    #             tsdf[x,y,z] = tsdf_vec[idx]
+    The slab arrays are indexed [z,y,x] and hold voxels z_start, z_start+1, ... of the
+    full grid. This is the same update as the Integrate kernel of the tsdf-fusion
+    executable, vectorized over all the voxels in the slab.
+    """
+    num_z, dim_y, dim_x = tsdf_slab.shape
+    R = world_to_camera[:3,:3]
+    t = world_to_camera[:3,3]
+
+    # camera frame location of voxel (x,y,z) is
+    # R*(origin + voxel_size*(x,y,z)) + t, split into per axis terms so that we
+    # can broadcast instead of building the full (num_z, dim_y, dim_x, 3) array
+    x_idx = np.arange(dim_x, dtype=np.float32)
+    y_idx = np.arange(dim_y, dtype=np.float32)
+    z_idx = np.arange(z_start, z_start + num_z, dtype=np.float32)
+    offset = (R.dot(voxel_grid_origin) + t).astype(np.float32)
+    scaled_R = (voxel_size*R).astype(np.float32)
+
+    pt_cam = []
+    for i in xrange(3):
+        pt_cam.append(scaled_R[i,0]*x_idx[np.newaxis, np.newaxis, :]
+                      + scaled_R[i,1]*y_idx[np.newaxis, :, np.newaxis]
+                      + (scaled_R[i,2]*z_idx + offset[i])[:, np.newaxis, np.newaxis])
+
+    pt_cam_z = pt_cam[2]
+    valid = pt_cam_z > 0
+    pt_cam_z_safe = np.where(valid, pt_cam_z, 1.0)
+
+    height, width = depth.shape
+    pix_x = np.rint(K[0,0]*(pt_cam[0]/pt_cam_z_safe) + K[0,2])
+    pix_y = np.rint(K[1,1]*(pt_cam[1]/pt_cam_z_safe) + K[1,2])
+    valid &= (pix_x >= 0) & (pix_x < width) & (pix_y >= 0) & (pix_y < height)
+
+    # only touch the voxels that project into the image
+    idx = np.nonzero(valid)
+    depth_val = depth[pix_y[idx].astype(np.int64), pix_x[idx].astype(np.int64)]
+    diff = depth_val - pt_cam_z[idx]
+    update = (depth_val > 0) & (diff > -trunc_margin)
+
+    idx = tuple(i[update] for i in idx)
+    dist = np.minimum(1.0, diff[update]/trunc_margin)
+
+    weight_old = weight_slab[idx]
+    weight_new = weight_old + 1.0
+    tsdf_slab[idx] = (tsdf_slab[idx]*weight_old + dist)/weight_new
+    weight_slab[idx] = weight_new
+
+
+def save_tsdf_bin(tsdf_bin_filename, tsdf, voxel_grid_origin, voxel_size, trunc_margin):
+    """
+    Writes the tsdf in the same format as the tsdf-fusion executable, an 8 float
+    header (dims, origin, voxel size, truncation margin) followed by the tsdf
+    values with x varying fastest. tsdf is indexed [z,y,x]
+    """
+    dim_z, dim_y, dim_x = tsdf.shape
+    header = np.array([dim_x, dim_y, dim_z, voxel_grid_origin[0], voxel_grid_origin[1],
+        voxel_grid_origin[2], voxel_size, trunc_margin], dtype=np.float32)
 
+    with open(tsdf_bin_filename, 'wb') as f:
+        header.tofile(f)
+        np.ascontiguousarray(tsdf, dtype=np.float32).tofile(f)
 
-    print "tsdf.shape:", tsdf.shape
-    print "voxelGridDim: ", voxelGridDim
-    print "voxeGridOrigin: ", voxelGridOrigin
-    print "tsdf.shape:", tsdf.shape
 
-    verts, faces, normals, values = measure.marching_cubes_lewiner(tsdf, spacing=[voxelSize]*3, level=0)
+def get_tsdf_surface_points(tsdf, weight, voxel_grid_origin, voxel_size, tsdf_threshold=0.2):
+    """
+    World locations of the observed voxels close to the surface, tsdf is indexed [z,y,x]
+    :return: (N,3) float32 array
+    """
+    z, y, x = np.nonzero((np.abs(tsdf) < tsdf_threshold) & (weight > 0))
+    points = np.empty((len(x), 3), dtype=np.float32)
+    points[:,0] = voxel_grid_origin[0] + voxel_size*x
+    points[:,1] = voxel_grid_origin[1] + voxel_size*y
+    points[:,2] = voxel_grid_origin[2] + voxel_size*z
+    return points
 
 
-    print "type(verts): ", type(verts)
-    print "verts.shape: ", verts.shape
-    print "faces.shape:", faces.shape
+class TSDFIntegrator(object):
+    """
+    A tsdf voxel grid that depth images are integrated into one at a time. The grid
+    is split into slabs along z which are integrated on a thread pool, numpy releases
+    the GIL for the bulk of the work.
 
-    print "np.max(verts[:,0]): ", np.max(verts[:,0])
-    print "np.min(verts[:,0]): ", np.min(verts[:, 0])
+    Used by run_tsdf_fusion_numpy, and by FusionServer to fuse the depth images
+    while the scan is still running. Not thread safe, integrate and the methods that
+    read the grid should be called from the same thread.
+    """
 
+    def __init__(self, K, voxel_grid_origin, voxel_size, voxel_grid_dim, num_threads=None, slab_size=16):
+        """
+        :param K: 3x3 camera matrix
+        :param voxel_grid_origin: world location of voxel (0,0,0)
+        :param voxel_grid_dim: (dim_x, dim_y, dim_z)
+        :param num_threads: number of threads, defaults to the number of cores
+        :param slab_size: number of z layers in each slab
+        """
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+
+        self.K = np.asarray(K, dtype=np.float64)
+        self.voxel_grid_origin = np.asarray(voxel_grid_origin, dtype=np.float64)
+        self.voxel_size = voxel_size
+        self.trunc_margin = voxel_size*5
+        self.slab_size = slab_size
+        self.num_frames_integrated = 0
+
+        # indexed [z,y,x], so that the C order layout matches tsdf.bin
+        dim_x, dim_y, dim_z = voxel_grid_dim
+        self.tsdf = np.ones((dim_z, dim_y, dim_x), dtype=np.float32)
+        self.weight = np.zeros_like(self.tsdf)
+        self.slab_starts = range(0, dim_z, slab_size)
+
+        self.pool = ThreadPool(num_threads)
+
+    def integrate(self, depth, camera_to_world):
+        """
+        :param depth: depth image in meters, zero where invalid
+        :param camera_to_world: 4x4 homogeneous transform
+        """
+        world_to_camera = np.linalg.inv(camera_to_world)
+
+        def integrate_slab(z_start):
+            z_slice = slice(z_start, z_start + self.slab_size)
+            integrate_depth_image_into_slab(self.tsdf[z_slice], self.weight[z_slice], z_start, depth, self.K,
+                world_to_camera, self.voxel_grid_origin, self.voxel_size, self.trunc_margin)
+
+        self.pool.map(integrate_slab, self.slab_starts)
+        self.num_frames_integrated += 1
+
+    def get_surface_points(self, tsdf_threshold=0.2):
+        """
+        :return: (N,3) world locations of the voxels close to the surface seen so far
+        """
+        return get_tsdf_surface_points(self.tsdf, self.weight, self.voxel_grid_origin, self.voxel_size,
+            tsdf_threshold=tsdf_threshold)
+
+    def get_tsdf_volume(self):
+        """
+        :return: TSDFVolume view of the grid, for meshing
+        """
+        return TSDFVolume(self.tsdf.T, self.voxel_grid_origin, self.voxel_size, self.trunc_margin)
+
+    def save(self, output_dir):
+        """
+        Writes tsdf.bin and fusion_pointcloud.ply to output_dir, same as the tsdf-fusion executable
+        :return: tsdf.bin filename
+        """
+        tsdf_bin_filename = os.path.join(output_dir, 'tsdf.bin')
+        save_tsdf_bin(tsdf_bin_filename, self.tsdf, self.voxel_grid_origin, self.voxel_size, self.trunc_margin)
+        save_tsdf_point_cloud_ply(os.path.join(output_dir, 'fusion_pointcloud.ply'), self.tsdf, self.weight,
+            self.voxel_grid_origin, self.voxel_size)
+        return tsdf_bin_filename
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def save_tsdf_point_cloud_ply(ply_filename, tsdf, weight, voxel_grid_origin, voxel_size,
+    tsdf_threshold=0.2):
+    """
+    Saves the voxels close to the surface as a point cloud, same as the tsdf.ply
+    written by the tsdf-fusion executable
+    """
+    points = get_tsdf_surface_points(tsdf, weight, voxel_grid_origin, voxel_size, tsdf_threshold=tsdf_threshold)
 
-    print "verts[0,:] = ", verts[0,:]
-    print "faces[0,:] = ", faces[0,:]
+    verts_tuple = np.zeros((len(points),), dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
+    verts_tuple['x'] = points[:,0]
+    verts_tuple['y'] = points[:,1]
+    verts_tuple['z'] = points[:,2]
+
+    el_verts = PlyElement.describe(verts_tuple, 'vertex')
+    PlyData([el_verts], byte_order='<').write(ply_filename)
 
-    # transform from voxel coordinates to camera coordinates
-    # note x and y are flipped in the output of marching_cubes
-    mesh_points = np.zeros_like(verts)
-    # mesh_points = verts
-    mesh_points[:,0] = voxelGridOrigin[0] + verts[:,0]
-    mesh_points[:,1] = voxelGridOrigin[1] + verts[:,1]
-    mesh_points[:,2] = voxelGridOrigin[2] + verts[:,2]
 
-    # permute faces to get visualization
-    # faces = np.flip(faces, 1)
+def run_tsdf_fusion_numpy(image_folder, output_dir=None, voxel_grid_origin_x=0.4,
+    voxel_grid_origin_y=-0.3, voxel_grid_origin_z=-0.2, voxel_size=0.0025,
+    voxel_grid_dim_x=240, voxel_grid_dim_y=320, voxel_grid_dim_z=280, fast_tsdf_settings=False,
+    num_threads=None, slab_size=16):
+    """
+    CPU version of run_tsdf_fusion_cuda, integrates the depth images (keyframes) in image_folder
+    in process, no GPU or format_data_for_tsdf needed. Reads pose_data.yaml, camera_info.yaml
+    and the depth pngs directly and writes tsdf.bin and fusion_pointcloud.ply to output_dir.
 
+    The voxel grid is split into slabs along z which are integrated on a thread pool,
+    numpy releases the GIL for the bulk of the work.
 
-    # try writing to the ply file
-    print "converting numpy arrays to format for ply file"
-    ply_conversion_start_time = time.time()
+    :param num_threads: number of threads, defaults to the number of cores
+    :param slab_size: number of z layers in each slab
+    """
+    if output_dir is None:
+        output_dir = os.path.dirname(image_folder)
+        print "output_dir: ", output_dir
+
+    if fast_tsdf_settings:
+        voxel_size = 0.005
+        voxel_grid_dim_x = 200
+        voxel_grid_dim_y = 200
+        voxel_grid_dim_z = 150
+
+    voxel_grid_origin = np.array([voxel_grid_origin_x, voxel_grid_origin_y, voxel_grid_origin_z])
+    voxel_grid_dim = (voxel_grid_dim_x, voxel_grid_dim_y, voxel_grid_dim_z)
+
+    K = get_camera_intrinsics_matrix(image_folder)
+    # only the keyframes if the folder has been downsampled
+    pose_data_dict = keyframe_selection.load_pose_data(image_folder)
+
+    start_time = time.time()
+    integrator = TSDFIntegrator(K, voxel_grid_origin, voxel_size, voxel_grid_dim, num_threads=num_threads,
+        slab_size=slab_size)
+    try:
+        for counter, i in enumerate(sorted(pose_data_dict)):
+            camera_to_world = spartan_utils.homogenous_transform_from_dict(pose_data_dict[i]['camera_to_world'])
+            depth_image_filename = os.path.join(image_folder, pose_data_dict[i]['depth_image_filename'])
+            integrator.integrate(read_depth_image(depth_image_filename), camera_to_world)
+
+            if counter % 100 == 0:
+                print "fused frame %d" %(counter)
+    finally:
+        integrator.close()
 
-    num_verts = verts.shape[0]
-    num_faces = faces.shape[0]
+    elapsed = time.time() - start_time
 
-    verts_tuple = np.zeros((num_verts,), dtype=[('x', 'f4'), ('y', 'f4'),
-                                                ('z', 'f4')])
-    faces_tuple = np.zeros((num_faces,), dtype=[('vertex_indices', 'i4', (3,))])
+    integrator.save(output_dir)
 
-    for i in xrange(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
+    print "tsdf-fusion took %d seconds" %(elapsed)
 
-    for i in xrange(0, num_faces):
-        faces_tuple[i] = faces[i, :].tolist()
 
+def save_mesh_to_ply(ply_filename, verts, faces, normals=None):
+    """
+    Writes a triangle mesh as a binary little endian ply file. The structured
+    arrays are filled with whole column assignments, no per element loops.
+
+    :param verts: (N,3) vertex locations
+    :param faces: (M,3) vertex indices of each triangle
+    :param normals: optional (N,3) per vertex normals
+    """
+    vertex_dtype = [('x', 'f4'), ('y', 'f4'), ('z', 'f4')]
+    if normals is not None:
+        vertex_dtype += [('nx', 'f4'), ('ny', 'f4'), ('nz', 'f4')]
 
+    verts_tuple = np.zeros((verts.shape[0],), dtype=vertex_dtype)
+    verts_tuple['x'] = verts[:,0]
+    verts_tuple['y'] = verts[:,1]
+    verts_tuple['z'] = verts[:,2]
+
+    if normals is not None:
+        verts_tuple['nx'] = normals[:,0]
+        verts_tuple['ny'] = normals[:,1]
+        verts_tuple['nz'] = normals[:,2]
+
+    faces_tuple = np.zeros((faces.shape[0],), dtype=[('vertex_indices', 'i4', (3,))])
+    faces_tuple['vertex_indices'] = faces
 
-    # save it out
-    # try to save it
     el_verts = PlyElement.describe(verts_tuple, 'vertex')
     el_faces = PlyElement.describe(faces_tuple, 'face')
 
-    ply_data = PlyData([el_verts, el_faces])
-    print "saving mesh to %s" %(tsdf_mesh_filename)
-    ply = ply_data.write(tsdf_mesh_filename)
+    ply_data = PlyData([el_verts, el_faces], byte_order='<')
+    print "saving mesh to %s" %(ply_filename)
+    ply_data.write(ply_filename)
+
+
+def convert_tsdf_to_ply(tsdf_bin_filename, tsdf_mesh_filename, include_normals=False, lod_step_size=None,
+    bounding_box=None, chunk_size=None):
+    """
+    Converts the tsdf binary file to a mesh file in ply format
+
+    The indexing in the tsdf is
+    (x,y,z) <--> (x + y * dim_x + z * dim_x * dim_y)
+
+    tsdf.bin is memory mapped, only the part of the grid being meshed is read.
+
+    :param include_normals: also write the per vertex normals from marching cubes
+    :param lod_step_size: if not None, additionally write a decimated mesh, extracted with
+    this marching cubes step size (in voxels), to <tsdf_mesh_filename>_lod<step>.ply
+    :param bounding_box: optional (min_point, max_point) in world coordinates, only the
+    part of the grid inside this box is meshed
+    :param chunk_size: if not None, run marching cubes on chunks of this many voxels
+    along x and stitch them together, bounds the peak memory for large grids
+    """
+    start_time = time.time()
+
+    tsdf_volume = TSDFVolume.from_file(tsdf_bin_filename)
+
+    print "tsdf.shape:", tsdf_volume.shape
+    print "voxeGridOrigin: ", tsdf_volume.voxel_grid_origin
+
+    if bounding_box is not None:
+        tsdf_volume = tsdf_volume.crop(bounding_box[0], bounding_box[1])
+        print "cropped tsdf.shape:", tsdf_volume.shape
+
+    marching_cubes_start_time = time.time()
+    if chunk_size is None:
+        mesh_points, faces, normals = tsdf_volume.extract_mesh()
+    else:
+        mesh_points, faces, normals = tsdf_volume.extract_mesh_chunked(chunk_size=chunk_size)
+    print "marching cubes took", time.time() - marching_cubes_start_time
+
+    print "verts.shape: ", mesh_points.shape
+    print "faces.shape:", faces.shape
+
+    # try writing to the ply file
+    print "converting numpy arrays to format for ply file"
+    ply_conversion_start_time = time.time()
+
+    if not include_normals:
+        normals = None
+
+    save_mesh_to_ply(tsdf_mesh_filename, mesh_points, faces, normals=normals)
+    print "converting to ply format and writing to file took", time.time() - ply_conversion_start_time
+
+    if lod_step_size is not None:
+        lod_volume = tsdf_volume.downsample(lod_step_size)
+        if chunk_size is None:
+            mesh_points, faces, normals = lod_volume.extract_mesh()
+        else:
+            mesh_points, faces, normals = lod_volume.extract_mesh_chunked(chunk_size=chunk_size)
+
+        if not include_normals:
+            normals = None
+
+        lod_mesh_filename = "%s_lod%d.ply" %(os.path.splitext(tsdf_mesh_filename)[0], lod_step_size)
+        print "decimated mesh has %d vertices and %d faces" %(mesh_points.shape[0], faces.shape[0])
+        save_mesh_to_ply(lod_mesh_filename, mesh_points, faces, normals=normals)
 
-    print "converting to ply format and writing to file took", time.time() - start_time
+    print "convert_tsdf_to_ply took", time.time() - start_time
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+import numpy as np
+from skimage import measure
+
+
+TSDF_HEADER_SIZE = 8 # number of float32's in the tsdf.bin header
+
+
+class TSDFVolume(object):
+    """
+    A tsdf voxel grid indexed [x,y,z], with the grid origin, voxel size and truncation
+    margin from the tsdf.bin header.
+
+    TSDFVolume.from_file memory maps tsdf.bin rather than reading it, crop and downsample
+    return new TSDFVolume's that are views into the same data, so nothing is loaded
+    until marching cubes actually touches it.
+    """
+
+    def __init__(self, tsdf, voxel_grid_origin, voxel_size, trunc_margin):
+        """
+        :param tsdf: (dim_x, dim_y, dim_z) array
+        :param voxel_grid_origin: world location of voxel (0,0,0)
+        """
+        self.tsdf = tsdf
+        self.voxel_grid_origin = np.asarray(voxel_grid_origin, dtype=np.float64)
+        self.voxel_size = float(voxel_size)
+        self.trunc_margin = float(trunc_margin)
+
+    @staticmethod
+    def from_file(tsdf_bin_filename):
+        """
+        Memory maps tsdf.bin, the file layout is an 8 float header
+        (dims, origin, voxel size, truncation margin) followed by the tsdf
+        values with x varying fastest
+        """
+        header = np.fromfile(tsdf_bin_filename, dtype=np.float32, count=TSDF_HEADER_SIZE)
+        voxel_grid_dim = header[0:3].astype(np.int64)
+        voxel_grid_origin = header[3:6]
+        voxel_size = header[6]
+        trunc_margin = header[7]
+
+        # x varies fastest, so the file is a C order [z,y,x] array, the
+        # transpose is an [x,y,z] view of it
+        dim_x, dim_y, dim_z = voxel_grid_dim
+        tsdf = np.memmap(tsdf_bin_filename, dtype=np.float32, mode='r',
+                         offset=TSDF_HEADER_SIZE*np.dtype(np.float32).itemsize, shape=(dim_z, dim_y, dim_x))
+
+        return TSDFVolume(tsdf.T, voxel_grid_origin, voxel_size, trunc_margin)
+
+    @property
+    def shape(self):
+        return self.tsdf.shape
+
+    def world_to_voxel(self, point):
+        """
+        :return: (continuous) voxel coordinates of a world point
+        """
+        return (np.asarray(point) - self.voxel_grid_origin)/self.voxel_size
+
+    def voxel_to_world(self, voxel):
+        return self.voxel_grid_origin + self.voxel_size*np.asarray(voxel)
+
+    def crop(self, min_point, max_point):
+        """
+        Sub volume containing the axis aligned box [min_point, max_point], in world
+        coordinates. No data is copied.
+        """
+        start = np.floor(self.world_to_voxel(min_point)).astype(np.int64)
+        stop = np.ceil(self.world_to_voxel(max_point)).astype(np.int64) + 1
+        start = np.clip(start, 0, self.shape)
+        stop = np.clip(stop, start, self.shape)
+
+        if np.any(stop - start < 2):
+            raise ValueError("crop box [%s, %s] doesn't overlap the voxel grid" %(min_point, max_point))
+
+        tsdf = self.tsdf[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+        return TSDFVolume(tsdf, self.voxel_to_world(start), self.voxel_size, self.trunc_margin)
+
+    def downsample(self, step):
+        """
+        Keeps every step'th voxel along each axis. No data is copied.
+        """
+        tsdf = self.tsdf[::step, ::step, ::step]
+        return TSDFVolume(tsdf, self.voxel_grid_origin, self.voxel_size*step, self.trunc_margin)
+
+    def _marching_cubes(self, tsdf, level=0):
+        """
+        Marching cubes in voxel units, None if the surface doesn't pass through tsdf
+        """
+        tsdf = np.ascontiguousarray(tsdf, dtype=np.float32)
+        if not (np.min(tsdf) <= level <= np.max(tsdf)):
+            return None
+
+        verts, faces, normals, values = measure.marching_cubes_lewiner(tsdf, level=level)
+        return verts, faces, normals
+
+    def extract_mesh(self, level=0):
+        """
+        Runs marching cubes over the whole volume
+        :return: verts (N,3) in world coordinates, faces (M,3), normals (N,3)
+        """
+        result = self._marching_cubes(self.tsdf, level=level)
+        if result is None:
+            return np.zeros((0,3)), np.zeros((0,3), dtype=np.int64), np.zeros((0,3))
+
+        verts, faces, normals = result
+        return self.voxel_to_world(verts), faces, normals
+
+    def extract_mesh_chunked(self, chunk_size=64, level=0):
+        """
+        Runs marching cubes on chunks of chunk_size voxels along x, only one chunk is in
+        memory at a time. Neighbouring chunks share their boundary voxel plane, so the
+        vertices on the seam come out identical from both chunks and are merged, the
+        result is a single connected mesh, the same as extract_mesh.
+
+        :return: verts (N,3) in world coordinates, faces (M,3), normals (N,3)
+        """
+        dim_x = self.shape[0]
+        verts_list = []
+        faces_list = []
+        normals_list = []
+        num_verts = 0
+
+        for start in xrange(0, dim_x - 1, chunk_size):
+            stop = min(start + chunk_size, dim_x - 1)
+            result = self._marching_cubes(self.tsdf[start:stop+1], level=level)
+            if result is None:
+                continue
+
+            verts, faces, normals = result
+            verts[:,0] += start
+            verts_list.append(verts)
+            faces_list.append(faces + num_verts)
+            normals_list.append(normals)
+            num_verts += len(verts)
+
+        if num_verts == 0:
+            return np.zeros((0,3)), np.zeros((0,3), dtype=np.int64), np.zeros((0,3))
+
+        verts = np.concatenate(verts_list)
+        faces = np.concatenate(faces_list)
+        normals = np.concatenate(normals_list)
+
+        # merge the duplicate vertices on the seams, in voxel units the seam vertices
+        # are bit for bit identical so an exact match is enough
+        verts, unique_idx, inverse = np.unique(verts, axis=0, return_index=True, return_inverse=True)
+        faces = np.reshape(inverse, -1)[faces]
+        normals = normals[unique_idx]
+
+        return self.voxel_to_world(verts), faces, normals
@@ -1,4 +1,6 @@
 import os
+import threading
+import collections
 import numpy as np
 import yaml
 
@@ -32,6 +34,106 @@ import robot_control.control_utils as controlUtils
 
 
 
+class IkSolutionCache(object):
+    """
+    LRU cache of recent successful IK results. The key is the target pose together with
+    the requested seed and nominal poses, rounded to resolution, so repeated requests for
+    the same grasp or scan pose don't solve again. Results of warm started solves are
+    kept under separate keys, see makeKey. Also finds the closest solved target to warm
+    start a new solve from.
+    """
+
+    def __init__(self, maxSize=256, resolution=1e-6, angleWeight=0.1):
+        """
+        :param angleWeight: meters per radian when comparing targets, see getClosestSolution
+        """
+        self.maxSize = maxSize
+        self.resolution = resolution
+        self.angleWeight = angleWeight
+        self.lock = threading.Lock()
+
+        # key -> (position, quaternion, ikResult), least recently used first
+        self.entries = collections.OrderedDict()
+
+    @staticmethod
+    def canonicalQuaternion(quat):
+        """
+        q and -q are the same rotation, pick the one with w >= 0
+        """
+        quat = np.asarray(quat, dtype=np.float64)
+        if quat[0] < 0:
+            quat = -quat
+        return quat
+
+    def makeKey(self, pos, quat, seedPose=None, nominalPose=None, warmStarted=False):
+        """
+        :param warmStarted: True for results seeded from getClosestSolution instead of
+        seedPose. They depend on what was solved before, so a request that didn't ask for
+        a warm start never gets one of them.
+        """
+        def roundArray(a):
+            if a is None:
+                return None
+            return tuple(np.round(np.asarray(a, dtype=np.float64)/self.resolution).astype(np.int64))
+
+        return (roundArray(pos), roundArray(IkSolutionCache.canonicalQuaternion(quat)), roundArray(seedPose),
+                roundArray(nominalPose), warmStarted)
+
+    @staticmethod
+    def copyResult(ikResult):
+        return dict(info=ikResult['info'], endPose=np.array(ikResult['endPose']))
+
+    def get(self, key):
+        """
+        :return: a copy of the cached IK result, None if there isn't one
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            return IkSolutionCache.copyResult(entry[2])
+
+    def put(self, key, pos, quat, ikResult):
+        """
+        Only successful results are cached, a failed solve is tried again next time
+        """
+        if ikResult['info'] != 1:
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (np.array(pos, dtype=np.float64), IkSolutionCache.canonicalQuaternion(quat),
+                                 IkSolutionCache.copyResult(ikResult))
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def getClosestSolution(self, pos, quat):
+        """
+        Successful solution whose target is closest to (pos, quat), distance is the
+        position distance plus angleWeight times the rotation angle between the targets
+        :return: joint positions, None if nothing has been solved
+        """
+        with self.lock:
+            entries = list(self.entries.itervalues())
+
+        if len(entries) == 0:
+            return None
+
+        positions = np.array([entry[0] for entry in entries])
+        quaternions = np.array([entry[1] for entry in entries])
+        distance = np.linalg.norm(positions - np.asarray(pos), axis=1)
+        dot = np.abs(np.dot(quaternions, IkSolutionCache.canonicalQuaternion(quat)))
+        distance += self.angleWeight*2*np.arccos(np.clip(dot, 0.0, 1.0))
+
+        return np.array(entries[int(np.argmin(distance))][2]['endPose'])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 class IkService(object):
 
     def __init__(self, robotSystem):
@@ -42,6 +144,13 @@ class IkService(object):
 
         self.config = dict()
         self.config['ikservice_name'] = "robot_control/IkService"
+        self.config['ik_batch_service_name'] = "robot_control/IkBatchService"
+        self.config['cache_size'] = 256
+
+        self.ikCache = IkSolutionCache(maxSize=self.config['cache_size'])
+
+        # the ikPlanner isn't thread safe and rospy handles every service call on its own thread
+        self.ikLock = threading.Lock()
 
     def runIK(self, targetFrame, startPose=None, graspToHandLinkFrame=None, positionTolerance=0.0, angleToleranceInDegrees=0.0, seedPoseName='q_nom', seedPose=None, nominalPose=None):
 
@@ -107,6 +216,43 @@ class IkService(object):
 
         return returnData
 
+    def solveIK(self, pose, seedPose=None, nominalPose=None, warmStart=False):
+        """
+        runIK with a cache in front of it
+
+        :param pose: geometry_msgs/Pose
+        :param warmStart: if there is no seedPose, seed from the closest previously solved target
+        :return: dict with 'info' and 'endPose', same as runIK
+        """
+        pos = [pose.position.x, pose.position.y, pose.position.z]
+        quat = [pose.orientation.w, pose.orientation.x, pose.orientation.y, pose.orientation.z]
+
+        warmStart = warmStart and (seedPose is None)
+
+        # a warm started request can use the result of a plain request, not the other way around
+        keys = [self.ikCache.makeKey(pos, quat, seedPose=seedPose, nominalPose=nominalPose)]
+        if warmStart:
+            keys.append(self.ikCache.makeKey(pos, quat, nominalPose=nominalPose, warmStarted=True))
+
+        for key in keys:
+            ikResult = self.ikCache.get(key)
+            if ikResult is not None:
+                rospy.loginfo("IK result found in cache")
+                return ikResult
+
+        key = keys[0]
+        if warmStart:
+            seedPose = self.ikCache.getClosestSolution(pos, quat)
+            if seedPose is not None:
+                key = keys[1]
+
+        targetFrame = transformUtils.transformFromPose(pos, quat)
+        with self.ikLock:
+            ikResult = self.runIK(targetFrame, seedPose=seedPose, nominalPose=nominalPose)
+
+        self.ikCache.put(key, pos, quat, ikResult)
+        return ikResult
+
     def getPlanningStartPose(self):
         return self.robotSystem.robotStateJointController.q
 
@@ -124,13 +270,29 @@ class IkService(object):
         return jointState
 
     def rosJointStateToDrakeJointPosition(self, joint_state):
-        q = self.getPlanningStartPose()
+        # copy, getPlanningStartPose returns the robot state itself
+        q = np.array(self.getPlanningStartPose())
         q[-self.numJoints:] = joint_state.position
         return q
 
+    def getPerTargetPoses(self, jointStates, numTargets, name):
+        """
+        Optional per target joint states, either none, one for all the targets or one per target
+        :return: list of drake joint positions or None, one per target
+        """
+        if len(jointStates) == 0:
+            return [None]*numTargets
+
+        if len(jointStates) == 1:
+            return [self.rosJointStateToDrakeJointPosition(jointStates[0])]*numTargets
+
+        if len(jointStates) == numTargets:
+            return [self.rosJointStateToDrakeJointPosition(jointState) for jointState in jointStates]
+
+        raise ValueError("expected 0, 1 or %d %s, got %d" %(numTargets, name, len(jointStates)))
+
     def onIkServiceRequest(self, req):
         rospy.loginfo("received an IkService request")
-        targetFrame = IkService.ROSPoseToVtkTransform(req.pose_stamped.pose)
 
         seedPose = None
         if len(req.seed_pose) > 0:
@@ -141,7 +303,7 @@ class IkService(object):
         if len(req.nominal_pose) > 0:
             nominalPose = self.rosJointStateToDrakeJointPosition(req.nominal_pose[0])
 
-        ikResult = self.runIK(targetFrame, seedPose=seedPose, nominalPose=nominalPose)
+        ikResult = self.solveIK(req.pose_stamped.pose, seedPose=seedPose, nominalPose=nominalPose)
 
         rospy.loginfo("IK info = %d", ikResult['info'])
 
@@ -152,10 +314,40 @@ class IkService(object):
 
         return response
 
+    def onIkBatchServiceRequest(self, req):
+        """
+        Solves all the targets in one call. The targets are visited nearest neighbour
+        first and every target without a seed pose is seeded from the closest target
+        solved so far, in this batch or an earlier request.
+        """
+        numTargets = len(req.pose_stamped)
+        rospy.loginfo("received an IkBatchService request with %d targets", numTargets)
+
+        seedPoses = self.getPerTargetPoses(req.seed_pose, numTargets, "seed poses")
+        nominalPoses = self.getPerTargetPoses(req.nominal_pose, numTargets, "nominal poses")
+
+        poses = [poseStamped.pose for poseStamped in req.pose_stamped]
+        positions = np.array([[pose.position.x, pose.position.y, pose.position.z] for pose in poses])
+
+        ikResults = [None]*numTargets
+        for idx in IkService.nearestNeighbourOrder(positions):
+            ikResults[idx] = self.solveIK(poses[idx], seedPose=seedPoses[idx], nominalPose=nominalPoses[idx],
+                                          warmStart=True)
+
+        response = robot_msgs.srv.RunIKBatchResponse()
+        for ikResult in ikResults:
+            response.success.append(ikResult['info'] == 1)
+            response.joint_state.append(self.drakeJointPositionToRosJointState(ikResult['endPose']))
+
+        rospy.loginfo("IK solutions found for %d of %d targets", sum(response.success), numTargets)
+        return response
+
     def advertiseServices(self):
         rospy.loginfo("advertising services")
         self.ikService = rospy.Service(self.config['ikservice_name'],
                                                         robot_msgs.srv.RunIK, self.onIkServiceRequest)
+        self.ikBatchService = rospy.Service(self.config['ik_batch_service_name'],
+                                            robot_msgs.srv.RunIKBatch, self.onIkBatchServiceRequest)
 
 
     # run this in a thread
@@ -179,6 +371,30 @@ class IkService(object):
         targetFrame = transformUtils.transformFromPose(pos,quat)
         return self.runIK(targetFrame)
 
+    @staticmethod
+    def nearestNeighbourOrder(positions):
+        """
+        Greedy tour through the positions starting at the first one, each step goes to
+        the closest position not visited yet
+        :param positions: (N,3) array
+        :return: list of indices
+        """
+        numPositions = len(positions)
+        if numPositions == 0:
+            return []
+
+        visited = np.zeros(numPositions, dtype=bool)
+        order = [0]
+        visited[0] = True
+        for i in xrange(1, numPositions):
+            distance = np.linalg.norm(positions - positions[order[-1]], axis=1)
+            distance[visited] = np.inf
+            idx = int(np.argmin(distance))
+            order.append(idx)
+            visited[idx] = True
+
+        return order
+
     """
     @:param pose: geometry_msgs/Pose
     """